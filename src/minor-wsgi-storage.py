@@ -1,15 +1,116 @@
 #! /usr/bin/python
 # -*- mode: python -*-
 
-from wsgiref.simple_server import make_server
-from bsddb import db
+from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler, ServerHandler
+from SocketServer import ThreadingMixIn
 from optparse import OptionParser
+from contextlib import contextmanager
+from cStringIO import StringIO
 
-import cgi, cgitb, sys, traceback
-import urllib, urllib2
+import cgi, cgitb, sys
+import os, errno, signal, socket, threading, multiprocessing
+import mmap, pickle, cPickle, marshal, struct, time, json, logging, zlib, fcntl, bisect, sha, binascii
+import sdht, sdht_engines
 
-_local_db = None
-_available = True
+# Seconds an idle keep-alive connection is kept open by the storage.
+# Should be longer then the idle timeout of the client pools.
+KEEP_ALIVE_TIMEOUT = 30
+
+# Size of the value data sent in each chunk when handing over records
+# to another storage.
+TRANSFER_CHUNK_BYTES = 1024 * 1024
+
+# Times the records of a chunk written while it was sent are sent
+# again without holding the lock, after that they are sent holding it
+# (see _stream_transfer).
+TRANSFER_RESENDS = 3
+
+# Bytes of shared memory for the handoffs and the routing information
+# when the storage runs several worker processes (see _SharedState).
+# The finger tables of many virtual positions take a few megabytes,
+# pages of the map are only used once they are written.
+SHARED_STATE_BYTES = 16 * 1024 * 1024
+
+# Commands that change the handoffs or the routing information. They
+# hold the lock exclusively, every other command holds it shared.
+EXCLUSIVE_COMMANDS = ('fingers', 'ring', 'transfer_part', 'transfer')
+
+# Linux value of SO_REUSEPORT, the socket module doesn't know it
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+# Commands counted by the stats (see _Stats). Data commands posted as
+# frames are counted apart from the forms, unknown commands as 'other'.
+STATS_COMMANDS = ('check', 'get', 'set', 'mget', 'mset', 'mdelete',
+                  'frame_get', 'frame_set', 'frame_delete', 'ingest',
+                  'transfer_part', 'transfer', 'fingers', 'find_successor',
+                  'stats', 'snapshot', 'load', 'ring', 'cas', 'incr', 'append',
+                  'bloom', 'digest', 'hashes', 'other')
+
+# Buckets of the latency histograms, bucket n counts the requests that
+# took less then 2**n microseconds (the last one also the slower ones)
+HISTOGRAM_BUCKETS = 26
+
+# How writes are flushed to disk (see _GroupCommit): 'async' leaves it
+# to the operating system, 'periodic' syncs every --sync-interval
+# seconds and 'sync' before a write is answered
+DURABILITIES = ('async', 'periodic', 'sync')
+
+# Records written by one group commit at most, a commit starts right
+# away once that many are waiting
+GROUP_COMMIT_RECORDS = 10000
+
+# Bytes of the journal of the keys written (see _Journal) before it
+# is started over, the one before is kept too
+JOURNAL_BYTES = 32 * 1024 * 1024
+
+# Seconds the time of a snapshot is set back, for the writes of other
+# threads and workers that are committed but not journaled yet when
+# the snapshot reads the journal. Their keys are sent again when
+# catching up, which does no harm.
+JOURNAL_MARGIN = 1.0
+
+# Records read from the engine at once for the changes of a snapshot
+SNAPSHOT_BATCH = 1000
+
+# Locks the keys changed by the atomic commands are striped over (see
+# _KeyLocks), by the last byte of the packed key
+KEY_LOCKS = 256
+
+# Bits of the Bloom filter of the keys (see _Bloom) and the positions
+# of a key in it, about 1% false positives for 800000 keys
+BLOOM_BITS = 8 * 1024 * 1024
+BLOOM_HASHES = 7
+
+# Levels of the Merkle tree of digests of the records (see _Digests).
+# Every node has 16 children, the leaves are the 16**4 ranges of keys
+# with the same first four hex digits.
+DIGEST_LEVELS = 4
+
+# Share of the leaves with records that may differ before a transfer
+# comparing digests sends the whole range instead (see _Differences)
+DIGEST_DIFFERENT = 0.03
+
+# Globals the values read by the atomic commands may use (see
+# _plain_loads), everything else is refused
+PLAIN_GLOBALS = {('__builtin__', 'set'): set,
+                 ('__builtin__', 'frozenset'): frozenset}
+
+# Answers of a command that failed
+FAILURES = ('FAILURE', 'BUSY', 'UNKNOWN COMMAND', 'NO ROUTE', 'TOO OLD', 'WRONG TYPE')
+
+_FRAME_COMMANDS = {sdht.FRAME_GET: 'frame_get',
+                   sdht.FRAME_SET: 'frame_set',
+                   sdht.FRAME_DELETE: 'frame_delete'}
+
+_log = logging.getLogger('minor-wsgi-storage')
+
+_engine = None
+
+# The keys written, see _Journal (None without a journal)
+_journal = None
+
+# The file the ring membership is kept in (see the 'ring' command)
+_ring_path = None
 
 def storage_app(environ, start_response):
     """
@@ -19,172 +120,2953 @@ def storage_app(environ, start_response):
     part which handles the flow.
 
     These commands are available:
-    * 'check' - Check if this storage is available or not.
+    * 'check' - Check if this storage is available or not. Answers
+    'OK frame' instead of 'OK' if 'frame' is one of the protocols the
+    client offers.
+    Takes this extra part:
+    'protocols' - Comma separated protocols the client supports
     
-    * 'set' - Simple setting of a key/value in the Berkeley DB.
+    * 'set' - Simple setting of a key/value in the storage engine.
     Needs these extra parts:
     'key' - A string hashed key
     'value' - A serialized value
           
-    * 'get' - Simple getting of a value in the Berkeley DB based on a key.
+    * 'get' - Simple getting of a value in the storage engine based on a key.
     Needs these extra parts:
     'key' - A string hashed key
     
-    * 'transfer_part' - Transfer a choosen part of the Berkeley DB from this storage to another storage.
+    * 'mget' - Get several values in one request. Answers each value
+    as its length, a newline and the value (length -1 if missing).
+    Needs these extra parts:
+    'key' - Hashed keys (repeated)
+
+    * 'mset' - Set several values in one request.
+    Needs these extra parts:
+    'key' - Hashed keys (repeated)
+    'value' - Serialized values (repeated, same order as the keys)
+    Takes this extra part:
+    'replaced' - '1' to answer the manifests of the chunked values
+    replaced (see sdht._manifest) like 'mget', the other keys as
+    missing
+
+    * 'mdelete' - Delete several values in one request.
+    Needs these extra parts:
+    'key' - Hashed keys (repeated)
+    Takes this extra part:
+    'replaced' - '1' to answer the manifests of the chunked values
+    deleted like 'mset' does
+
+    * 'cas', 'incr' and 'append' - Change several values in one
+    request, each read, changed and written atomically (in one
+    transaction of the engine, see _atomic_batch). 'cas' sets a value
+    only if the version (see sdht._version) of the stored value
+    matches, 'incr' adds to an integer and 'append' appends an item to
+    a list (encoded like the sdht encodes values, see sdht.Codec, with
+    one of the codecs that comes with it). Answers each value written like
+    'mget' (as an empty string unless 'written' is '1'), a cas that
+    didn't match as missing, or 'WRONG TYPE' (and nothing is written)
+    if a value isn't an integer or a list of builtin types.
+    Needs these extra parts:
+    'key' - Hashed keys (repeated)
+    'value' - Serialized values (cas), numbers (incr) or serialized
+    items (append), same order as the keys
+    Takes these extra parts:
+    'version' - Versions of the stored values, empty if there must be
+    no value (cas, same order as the keys)
+    'written' - '1' to answer the values written
+
+    * 'transfer_part' - Transfer a choosen part of the records from this storage to another storage.
+    The records are streamed to the other storage in chunks and only
+    deleted here when the other storage has acknowledged them. The
+    storage keeps serving requests meanwhile, requests for keys that
+    have already been handed over are forwarded to the other storage.
+    The response is streamed too, a line 'PROGRESS <records> <bytes>'
+    for each chunk and a last line 'OK <records> <bytes>' (or
+    'FAILURE', or 'BUSY' if another transfer is running).
     Needs these extra parts:
     'other_node_ip' - IP of other node
     'other_node_port' - Port of other node
     'from_key_id' - Starting hash key to transfer
     'to_key_id' - Ending hash key to transfer
+    Takes these extra parts:
+    'copy' - '1' to keep the records here too
+    'since' - Only send the keys written since this time and delete
+    the keys deleted since, the other storage has the rest from a
+    snapshot (everything is sent if the journal doesn't reach back
+    that far)
+    'compare' - '1' to compare the digests of the range with the other
+    storage first and only send the records it doesn't hold (see
+    _Differences)
 
-    * 'transfer' - Transfer the complete Berkeley DB to another storage and make this storage unavailable.
+    * 'transfer' - Transfer all the records to another storage and make this storage unavailable.
+    Streamed and served like 'transfer_part' until it is done.
     Needs these extra parts:
     'other_node_ip' - IP of other node
     'other_node_port' - Port of other node
+
+    * 'snapshot' - Stream the records of this storage (or of one
+    range) as a snapshot (see sdht.Node.snapshot): blocks of
+    compressed packed records ending with the time the snapshot holds
+    every write before. Answers 'BUSY' while a transfer is running and
+    'TOO OLD' if the journal doesn't reach back to 'since'.
+    Takes these extra parts:
+    'from_key_id' - Starting hash key of the range
+    'to_key_id' - Ending hash key of the range
+    'since' - Only the keys written (or deleted) since this time
+
+    * 'fingers' - Set the routing information of this storage. The
+    information of several positions of the storage in the ring (see
+    sdht.Node.positions) can be set at once by repeating 'key_id',
+    'next' and 'fingers' in the same order.
+    Needs these extra parts:
+    'node_ip' - IP of this node as known in the ring
+    'node_port' - Port of this node as known in the ring
+    'next' - 'ip:port' of the next node (empty if it is the only node)
+    'fingers' - Comma separated 'ip:port' of the finger table nodes
+    Positions other then the first are written 'ip:port@key_id'.
+    Takes this extra part:
+    'key_id' - The position in the ring (the hash of 'ip:port' if left
+    out)
+
+    * 'find_successor' - Find where a hashed key belongs. Answers
+    'OWNER ip:port' if this storage is responsible for the key or
+    'HOP ip:port' with the node to ask next.
+    Needs these extra parts:
+    'key' - A string hashed key
+
+    * 'stats' - The counters of the commands executed by the storage
+    (see _Stats.report) as JSON.
+
+    * 'ring' - Get the ring membership (see sdht.membership) last sent
+    by a client, as JSON ('NONE' if there isn't any), or set it. A
+    membership with an older epoch then the one kept is answered
+    'STALE <epoch>'. The membership is kept on disk next to the
+    records and the epoch is sent with every response in the
+    sdht.EPOCH_HEADER header, so clients notice when the ring has
+    changed.
+    Takes this extra part:
+    'membership' - The membership to set (JSON)
+
+    * 'bloom' - Get the Bloom filter of the keys of this storage (see
+    _Bloom): a line 'BLOOM <version> <bits> <hashes>' followed by the
+    bits of the filter, 'SAME' if it is still the version the client
+    has or 'NONE' if the storage keeps no filter. With 'delta' the
+    positions set since the version of the client may be sent instead,
+    a line 'DELTA <version> <bits> <hashes>' followed by the positions
+    as 32 bit integers.
+    Takes these extra parts:
+    'version' - The version of the filter the client has
+    'delta' - '1' if the client takes the positions set since
+
+    * 'digest' - Get the digests of nodes of the Merkle tree of the
+    records of a range (see _Digests), as JSON by prefix. Answers
+    'NONE' if the storage keeps no digests.
+    Needs these extra parts:
+    'from_key_id' - Starting hash key of the range
+    'to_key_id' - Ending hash key of the range
+    'prefix' - The hex digits of a node, empty for the root (repeated)
+
+    * 'hashes' - Get the SHA-1 of every record of ranges (see
+    _record_digest): a line 'HASHES <records>' followed by the packed
+    key and the digest of each record.
+    Needs these extra parts:
+    'from_key_id' - Starting hash key of a range (repeated)
+    'to_key_id' - Ending hash key of a range (repeated, same order)
+
+    Records handed over by another storage are not posted as a form.
+    They are posted as packed records (see sdht._pack_records) with
+    the content type sdht.RECORDS_TYPE and written in one batch. The
+    storage answers 'OK <records>' when they are written.
+
+    A snapshot posted with the content type sdht.SNAPSHOT_TYPE is
+    loaded straight into the engine and answered with 'OK <records>
+    <deleted>'.
+
+    Clients that agreed on frames with 'check' post get, set and delete
+    commands as binary frames (see sdht._pack_frames) with the content
+    type sdht.FRAME_TYPE. Keys and values are sent raw and every frame
+    gets an answer (see sdht._pack_answers), the manifest of the
+    chunked value replaced or deleted by a set or delete frame (an
+    empty string for the other values).
     """
-    
-    global _local_db, _available
+
+    began = time.time()
+    _request.db_seconds = 0.0
+    length = int(environ.get('CONTENT_LENGTH') or 0)
+    content_type = environ.get('CONTENT_TYPE')
+    command = 'other'
+    try:
+        if content_type == sdht.RECORDS_TYPE:
+            # Written exclusively since they may end a handoff (see _ingest)
+            command = 'ingest'
+            data = environ['wsgi.input'].read(length)
+            result = _run(lambda: _ingest(data), True)
+        elif content_type == sdht.SNAPSHOT_TYPE:
+            command = 'load'
+            result = _run(lambda: _load(environ['wsgi.input']), False)
+        elif content_type == sdht.FRAME_TYPE:
+            data = environ['wsgi.input'].read(length)
+            command = data and _FRAME_COMMANDS.get(ord(data[0]), 'other') or 'other'
+            result = _run(lambda: _execute_frames(data), False)
+        else:
+            form = cgi.FieldStorage(fp=environ['wsgi.input'], environ=environ, keep_blank_values=True)
+            command = form.getfirst("cmd", "")
+            result = _run(lambda: _execute(form), command in EXCLUSIVE_COMMANDS)
+    except:
+        _stats.record(command, time.time() - began, _request.db_seconds, length, 0, True)
+        raise
+
     status = '200 OK'
     response_headers = [('Content-type','text/plain')]
+    if _state.epoch:
+        response_headers.append((sdht.EPOCH_HEADER, str(_state.epoch)))
+    if not isinstance(result, list):
+        # Streamed without a length, the connection is closed after it
+        start_response(status, response_headers)
+        return _counted(result, command, began, length)
+
+    # Always tell the length so the connection can be kept alive. The
+    # parts are written as they are, values aren't copied into a body.
+    size = sum([len(part) for part in result])
+    response_headers.append(('Content-Length', str(size)))
     start_response(status, response_headers)
+    _stats.record(command, time.time() - began, _request.db_seconds, length, size,
+                  result[:1] and result[0] in FAILURES)
+    return result
+
+def _counted(lines, command, began, length):
+    """
+    Stream the lines of a response and count the command in the stats
+    when the last one has been written.
+
+    @param lines: The lines of the response
+    @type lines: iterator
+    """
+    size = 0
+    line = ''
+    try:
+        for line in lines:
+            size += len(line)
+            yield line
+    finally:
+        _stats.record(command, time.time() - began, _request.db_seconds, length, size,
+                      line.strip() in FAILURES)
+
+def _run(execute, exclusive):
+    """
+    Execute a request in one of the request slots of this worker
+    holding the lock, with the shared state reloaded if another
+    worker has changed it.
+
+    @param execute: Executes the request and returns the response
+    @type execute: function
+
+    @param exclusive: Hold the lock exclusively and save the shared
+    state afterwards
+    @type exclusive: bool
+
+    @return: The response parts
+    """
+    with _slots:
+        if exclusive:
+            with _lock.exclusive():
+                _state.refresh()
+                result = execute()
+                _state.save()
+        else:
+            with _lock.shared():
+                _state.refresh()
+                result = execute()
+    return result
+
+def _execute(form):
+    """
+    Execute the command of a request (see storage_app).
 
-    form = cgi.FieldStorage(fp=environ['wsgi.input'], environ=environ, keep_blank_values=True)
+    @param form: The posted form
+    @type form: cgi.FieldStorage
 
+    @return: The response parts
+    @rtype: list
+    """
     # Global post parts
     command = form.getfirst("cmd", "")
     key = form.getfirst("key", "")
     value = form.getfirst("value", "")
     
-    print "Executing command '%s' on server which is available? %s" % (command, _available)
+    _log.debug("Executing command '%s'", command)
 
-    if not _available:
-        return []
-    
     if command == "set" and key and value:
         # Simple set value command
-        print "Setting key: ", key
-        _local_db.put(key, value)
+        db_key = _db_key(key)
+        target = _forwarded(db_key)
+        if target is not None:
+            # Already handed over, write it where it lives now
+            target[long(key)] = value
+        else:
+            _write_batch([(db_key, value)])
         return ['OK']
 
     elif command == "check":
         # Check if storage is available
-        if _available:
-            return ['OK']
+        if 'frame' in form.getfirst("protocols", "").split(','):
+            return ['OK frame']
+        return ['OK']
         
     elif command == "get" and key:
         # Simple get command
-        data = _local_db.get(key)
+        db_key = _db_key(key)
+        target = _forwarded(db_key)
+        if target is not None:
+            try:
+                data = target[long(key)]
+            except KeyError:
+                data = None
+        else:
+            data = _in_engine(_engine.get, db_key)
         if data:
             return [data]
         else:
             return ['NO DATA']
 
-    elif command == "transfer_part":
-        # During transfer the storage should be unaccessible
-        try:
-            _available = False
-            other_node_ip = form.getfirst("other_node_ip", "")
-            other_node_port = form.getfirst("other_node_port", "")
-            from_key_id = form.getfirst("from_key_id","")
-            to_key_id = form.getfirst("to_key_id","")
-            print "Performing partial transfer to: ", other_node_port, "between these ranges: ", from_key_id, "-", to_key_id
-                    
-            for key in _local_db.keys():
-                if  int(from_key_id) < int(key) and int(key) < int(to_key_id):
-                    # Check if this hashed key is within transfer range.
-                    print "transfering key: ", key, " to: ", other_node_ip, ":", other_node_port
-                    value = _local_db.get(key)
-                    url = 'http://%s:%s' % (other_node_ip, other_node_port)
-                    values = {'cmd' : 'set',
-                              'key' : '%s' % key,
-                              'value' : '%s' % value }
-                    
-                    data = urllib.urlencode(values)
-                    req = urllib2.Request(url, data)
-                    response = urllib2.urlopen(req)
-                    _local_db.delete(key)
-            # print "SETTING AVAILABLE AGAIN!"
-            _available = True
-            return ['OK']
-        
-        except Exception, e:
-            traceback.print_exc(file=sys.stdout)
+    elif command == "mget":
+        # Look up the keys in sorted order with a single cursor and
+        # answer in the order they where asked for
+        keys = [_db_key(key) for key in form.getlist("key")]
+        return [sdht._format_records(_get_batch(keys))]
+
+    elif command == "mset":
+        keys = form.getlist("key")
+        values = form.getlist("value")
+        if len(keys) != len(values) or not all(values):
             return ['FAILURE']
+        keys = [_db_key(key) for key in keys]
+        replaced = _set_batch(zip(keys, values))
+        if form.getfirst("replaced", "") == "1":
+            return [sdht._format_records([replaced.get(key) for key in keys])]
+        return ['OK']
 
-    elif command == "transfer":
-        # During transfer this storage should be unaccessible and then
-        # removed (never accessible again).
+    elif command == "mdelete":
+        keys = [_db_key(key) for key in form.getlist("key")]
+        replaced = _remove_batch(keys)
+        if form.getfirst("replaced", "") == "1":
+            return [sdht._format_records([replaced.get(key) for key in keys])]
+        return ['OK']
+
+    elif command in ("cas", "incr", "append"):
+        keys = [_db_key(key) for key in form.getlist("key")]
+        values = form.getlist("value")
+        versions = form.getlist("version")
+        if len(values) != len(keys) or (command == "cas" and len(versions) != len(keys)):
+            return ['FAILURE']
         try:
-            _available = False
-            other_node_ip = form.getfirst("other_node_ip", "")
-            other_node_port = form.getfirst("other_node_port", "")
-            print "Performing transfer to: ", other_node_port, "This node will becoma unavailable also"
-                    
-            for key in _local_db.keys():
-                print "transfering key: ", key, " to: ", other_node_ip, ":", other_node_port
-                value = _local_db.get(key)
-                url = 'http://%s:%s' % (other_node_ip, other_node_port)
-                values = {'cmd' : 'set',
-                          'key' : '%s' % key,
-                          'value' : '%s' % value }
-                
-                data = urllib.urlencode(values)
-                req = urllib2.Request(url, data)
-                response = urllib2.urlopen(req)
-                
-            return ['OK']
-        except:
+            written = _atomic_batch(command, keys, values, versions)
+        except TypeError:
+            return ['WRONG TYPE']
+        except ValueError:
+            # Not an integer delta, nothing was written
             return ['FAILURE']
+        if form.getfirst("written", "") != "1":
+            written = [None if value is None else '' for value in written]
+        return [sdht._format_records(written)]
+
+    elif command == "transfer_part":
+        other_node = sdht.Node(form.getfirst("other_node_ip", ""), form.getfirst("other_node_port", ""))
+        from_key_id = form.getfirst("from_key_id","")
+        to_key_id = form.getfirst("to_key_id","")
+        _log.info("Transfering %s - %s to %s:%s", from_key_id, to_key_id, other_node.ip, other_node.port)
+        if _running():
+            return ['BUSY']
+
+        # The keys are sorted by their hash so we can jump straight to
+        # the start of the range and stop at its end.
+        if long(to_key_id) < 2**sdht.MAXIMUM_BIT:
+            to_key = _db_key(to_key_id)
+        else:
+            to_key = None
+
+        since = form.getfirst("since", "")
+        since = since and float(since) or None
+        compare = form.getfirst("compare", "") == '1'
+        if form.getfirst("copy", "") == '1':
+            # This storage stays a replica of the range, it is copied
+            # and nothing is forwarded
+            return _stream_transfer(_Handoff(other_node, _db_key(from_key_id), to_key), False, since, compare)
+        return _stream_transfer(_start_handoff(other_node, _db_key(from_key_id), to_key), True, since, compare)
+
+    elif command == "transfer":
+        # This storage is removed once the transfer is done. Until then
+        # (and for clients that haven't noticed) it forwards the keys.
+        other_node = sdht.Node(form.getfirst("other_node_ip", ""), form.getfirst("other_node_port", ""))
+        _log.info("Transfering everything to %s:%s, this storage is being removed", other_node.ip, other_node.port)
+        if _running():
+            return ['BUSY']
+
+        return _stream_transfer(_start_handoff(other_node, '', None), False)
         
+    elif command == "fingers":
+        # Routing information pushed by the client that changed the ring
+        ip, port = form.getfirst("node_ip", ""), form.getfirst("node_port", "")
+        key_ids = form.getlist("key_id")
+        for position, (next_node, fingers) in enumerate(zip(form.getlist("next"), form.getlist("fingers"))):
+            node = sdht.Node(ip, port)
+            if key_ids:
+                node.key_id = long(key_ids[position])
+            if next_node:
+                node.next = sdht._parse_position(next_node)
+            if fingers:
+                node.fingers = [sdht._parse_position(finger) for finger in fingers.split(',')]
+            _state.nodes[node.key_id] = node
+        return ['OK']
+
+    elif command == "find_successor" and key:
+        # Answer with the owner or the closest preceding finger of all
+        # the positions of this storage
+        if not _state.nodes:
+            return ['NO ROUTE']
+        hashed_key = long(key)
+        best = None
+        for node in _state.nodes.values():
+            if node.owns(hashed_key):
+                return ['OWNER %s' % sdht._format_address(node)]
+            hop = node.closest_preceding(hashed_key)
+            if best is None or sdht.distance(hop.key_id, hashed_key) < sdht.distance(best.key_id, hashed_key):
+                best = hop
+        return ['HOP %s' % sdht._format_address(best)]
+
+    elif command == "stats":
+        return [json.dumps(_stats.report())]
+
+    elif command == "ring":
+        membership = form.getfirst("membership", "")
+        if not membership:
+            return [_state.ring or 'NONE']
+        epoch = json.loads(membership)['epoch']
+        if epoch < _state.epoch:
+            return ['STALE %d' % _state.epoch]
+        _state.ring, _state.epoch = membership, epoch
+        _save_ring()
+        return ['OK']
+
+    elif command == "bloom":
+        if not _bloom.bits:
+            return ['NONE']
+        version, data, delta = _bloom.dump(form.getfirst("version", ""), form.getfirst("delta", "") == "1")
+        if data is None:
+            return ['SAME']
+        return ['%s %s %d %d\n' % (delta and 'DELTA' or 'BLOOM', version, _bloom.bits, _bloom.hashes), data]
+
+    elif command == "digest":
+        if not _digests.levels:
+            return ['NONE']
+        prefixes = form.getlist("prefix")
+        if [prefix for prefix in prefixes if len(prefix) > _digests.levels]:
+            return ['FAILURE']
+        to_key_id = form.getfirst("to_key_id", "")
+        to_key = None
+        if long(to_key_id) < 2**sdht.MAXIMUM_BIT:
+            to_key = _db_key(to_key_id)
+        digests = _digests.digests(_db_key(form.getfirst("from_key_id", "")), to_key, prefixes)
+        return [json.dumps(dict(zip(prefixes, [digest.encode('hex') for digest in digests])))]
+
+    elif command == "hashes":
+        hashes = []
+        for from_key_id, to_key_id in zip(form.getlist("from_key_id"), form.getlist("to_key_id")):
+            to_key = None
+            if long(to_key_id) < 2**sdht.MAXIMUM_BIT:
+                to_key = _db_key(to_key_id)
+            hashes.extend([key + _record_digest(key, value) for key, value in _scan(_db_key(from_key_id), to_key)])
+        return ['HASHES %d\n' % len(hashes), ''.join(hashes)]
+
+    elif command == "snapshot":
+        from_key_id = form.getfirst("from_key_id", "")
+        to_key_id = form.getfirst("to_key_id", "")
+        since = form.getfirst("since", "")
+        since = since and float(since) or None
+        if _running():
+            return ['BUSY']
+        if since is not None and (_journal is None or not _journal.covers(since)):
+            return ['TOO OLD']
+
+        from_key, to_key = '', None
+        if from_key_id:
+            from_key = _db_key(from_key_id)
+            if long(to_key_id) < 2**sdht.MAXIMUM_BIT:
+                to_key = _db_key(to_key_id)
+        header = {'version': 1,
+                  'from_key_id': from_key_id or None,
+                  'to_key_id': to_key_id or None,
+                  'since': since}
+        return _stream_snapshot(from_key, to_key, since, header)
+
     else:
         return ['UNKNOWN COMMAND']
    
 
-def _get_args():
+def _execute_frames(data):
     """
-    Parse launcher arguments and display help.
+    Execute a data command posted as binary frames (see storage_app).
+    All the frames of a request have the same command.
+
+    @param data: Packed frames
+    @type data: str
+
+    @return: The response parts, an answer for every frame
+    @rtype: list
     """
-    usage = 'usage: %prog [options]'
-    desc = "Launches a small WSGI (HTTP) server that provides the means of storage to Berkeley DB"
+    frames = sdht._unpack_frames(data)
+    if not frames:
+        return []
+    command = frames[0][0]
+    if [frame for frame in frames if frame[0] != command]:
+        raise ValueError("Frames with different commands in one request")
 
-    parser = OptionParser(usage = usage, description = desc)
-    parser.add_option('-p',
-                      dest='port',
-                      type='int',
-                      default=8000,
-                      help=("Port number to run the server on"))
+    if command == sdht.FRAME_GET:
+        return sdht._pack_answers(_get_batch([key for command, key, value in frames]))
+    elif command == sdht.FRAME_SET:
+        replaced = _set_batch([(key, value) for command, key, value in frames])
+    elif command == sdht.FRAME_DELETE:
+        replaced = _remove_batch([key for command, key, value in frames])
+    else:
+        raise ValueError("Unknown frame command %d" % command)
+    # The manifests of the chunked values replaced, for the client to
+    # delete their chunks
+    return sdht._pack_answers([replaced.get(key, '') for command, key, value in frames])
 
-    (options, args) = parser.parse_args()
-    return options
-    
-def main():
+def _get_batch(keys):
     """
-    Main launcher for the WSGI (HTTP) application which provides the
-    means of storage to a simple Berkeley DB.
+    Get the values of several keys, forwarding the keys that have been
+    handed over.
 
-    Only one argument is available (the port number)
+    @param keys: Packed keys
+    @type keys: list
 
-    BTREE is choosen to gain performance but as many programmers
-    know this is never a obvious choice. Especially when the data
-    grows and b-trees become more cumbersome to handle then HASH.
-    
-    But the layer used to find where to put the data scales in
-    specific mannor this will still be enough
+    @return: The values (None for missing values) in the same order
+    @rtype: list
     """
-    global _local_db
+    local, groups = _split(keys)
+    found = _in_engine(_engine.get_many, local)
+    for target, forwarded in groups:
+        values = target.get_many([sdht._unpack_key(key) for key in forwarded])
+        for key, value in zip(forwarded, values):
+            if value is not sdht.MISSING:
+                found[key] = value
+    return [found.get(key) for key in keys]
 
-    options = _get_args()
-        
-    httpd = make_server('', options.port, storage_app)
-    
-    db_name = "/tmp/distributed_storage_%s.db" % options.port
-    _local_db = db.DB()
-    _local_db.open(db_name, None, db.DB_BTREE, db.DB_CREATE)
-    
-    print "Serving storage (HTTP) on port %s..." % options.port
+def _replaced(keys):
+    """
+    Find the chunked values (see sdht._manifest) that a write of keys
+    replaces, reading only the first byte of the other values. The
+    client deletes their chunks.
 
-    # Respond to requests until process is killed
-    httpd.serve_forever()
+    @param keys: Packed keys
+    @type keys: list
+
+    @return: The manifests by key
+    @rtype: dict
+    """
+    heads = _in_engine(_engine.get_heads, keys, 1)
+    chunked = [key for key, head in heads.iteritems() if head == chr(sdht.MANIFEST)]
+    return chunked and _in_engine(_engine.get_many, chunked) or {}
+
+def _set_batch(records):
+    """
+    Set several records, forwarding the keys that have been handed
+    over.
+
+    @param records: Tuples of a packed key and a serialized value
+    @type records: list
+
+    @return: The manifests of the chunked values replaced by key (see
+    _replaced)
+    @rtype: dict
+    """
+    items = dict(records)
+    local, groups = _split(items.keys())
+    replaced = _replaced(local)
+    _write_batch([(key, items[key]) for key in local])
+    for target, forwarded in groups:
+        manifests = target.set_many([sdht._unpack_key(key) for key in forwarded],
+                                    [items[key] for key in forwarded])
+        replaced.update([(key, manifest) for key, manifest in zip(forwarded, manifests) if manifest])
+    return replaced
+
+def _atomic_batch(command, keys, values, versions):
+    """
+    Execute an atomic command (see storage_app), forwarding the keys
+    that have been handed over. The local keys are locked while they
+    are read and written (see _KeyLocks) and all of them written in
+    one batch, nothing is written if one of them can't be changed.
+
+    @param command: 'cas', 'incr' or 'append'
+    @type command: str
+
+    @param keys: Packed keys, a key may come more then once
+    @type keys: list
+
+    @param values: The values of the command, same order as the keys
+    @type values: list
+
+    @param versions: The versions (cas)
+    @type versions: list
+
+    @return: The values written (None for a cas that didn't match) in
+    the same order as the keys
+    @rtype: list
+    """
+    local, groups = _split(keys)
+    written = [None] * len(keys)
+    with _key_locks.holding(local):
+        stored = _in_engine(_engine.get_many, local)
+        changed = {}
+        served = frozenset(local)
+        for position, key in enumerate(keys):
+            if key not in served:
+                continue
+            current = changed.get(key, stored.get(key))
+            written[position] = _change(command, current, values[position],
+                                        versions and versions[position])
+            if written[position] is not None:
+                changed[key] = written[position]
+        if changed:
+            _write_batch(changed.items())
+    for target, forwarded in groups:
+        forwarded = frozenset(forwarded)
+        positions = [position for position, key in enumerate(keys) if key in forwarded]
+        answers = target.atomic(command, [sdht._unpack_key(keys[position]) for position in positions],
+                                [values[position] for position in positions],
+                                versions and [versions[position] for position in positions], True)
+        for position, answer in zip(positions, answers):
+            if answer is not sdht.MISSING:
+                written[position] = answer
+    return written
+
+def _change(command, current, value, version):
+    """
+    Change a stored value by an atomic command.
+
+    @param current: The stored value (None if there is none)
+    @type current: str
+
+    @return: The value to write (None if a cas doesn't match)
+    @rtype: str
+
+    @raise TypeError: If the stored value can't be changed by the
+    command
+
+    @raise ValueError: If the delta of an incr isn't an integer
+    """
+    if command == 'cas':
+        if (current and sdht._version(current)) != (version or None):
+            return None
+        return value
+    elif command == 'incr':
+        number, ident = 0, None
+        if current is not None:
+            number, ident = _plain_loads(current)
+        if not isinstance(number, (int, long)) or isinstance(number, bool):
+            raise TypeError("Not an integer")
+        return _plain_dumps(number + int(value), ident)
+    else:
+        item, ident = _plain_loads(value)
+        items = []
+        if current is not None:
+            items, ident = _plain_loads(current)
+        if not isinstance(items, list):
+            raise TypeError("Not a list")
+        items.append(item)
+        return _plain_dumps(items, ident)
+
+def _find_plain_global(module, name):
+    """
+    The globals a value read by _plain_loads may use.
+    """
+    try:
+        return PLAIN_GLOBALS[(module, name)]
+    except KeyError:
+        raise TypeError("%s.%s isn't a builtin type" % (module, name))
+
+def _plain_loads(data):
+    """
+    Decode a value made of builtin types (see sdht._decode). Pickled
+    instances of other classes are refused, nothing a client stored is
+    executed.
+
+    @param data: A value as the sdht stores it
+    @type data: str
+
+    @return: The value and the ident of its codec (None for a plain
+    pickle)
+    @rtype: tuple
+
+    @raise TypeError: If the value isn't made of builtin types
+    """
+    try:
+        ident, data = sdht._unwrap(data)
+        if ident is None or ident == sdht.PickleCodec.ident:
+            unpickler = cPickle.Unpickler(StringIO(data))
+            unpickler.find_global = _find_plain_global
+            return unpickler.load(), ident
+        elif ident == sdht.MarshalCodec.ident:
+            return marshal.loads(data), ident
+        elif ident == sdht.RawCodec.ident:
+            return data, ident
+        elif ident == sdht.MANIFEST:
+            raise TypeError("A chunked value can't be changed")
+    except (cPickle.UnpicklingError, zlib.error, EOFError, ValueError, KeyError, IndexError), error:
+        raise TypeError("Not an encoded value: %s" % error)
+    raise TypeError("Unknown codec %d" % ident)
+
+def _plain_dumps(value, ident):
+    """
+    Encode a value changed by an atomic command like the value it was
+    read from.
+
+    @param ident: The ident of the codec (None for a plain pickle), a
+    list or an integer can't be raw and is pickled instead
+    @type ident: int
+
+    @return: The value to store
+    @rtype: str
+    """
+    if ident is None:
+        return pickle.dumps(value)
+    codec = sdht._codecs.get(ident)
+    if codec is None or isinstance(codec, sdht.RawCodec):
+        codec = sdht.CODECS['pickle']
+    return sdht._wrap(codec.ident, codec.encode(value))
+
+def _remove_batch(keys):
+    """
+    Delete several keys, forwarding the keys that have been handed
+    over. Keys without a value are ignored.
+
+    @param keys: Packed keys
+    @type keys: list
+
+    @return: The manifests of the chunked values deleted by key (see
+    _replaced)
+    @rtype: dict
+    """
+    local, groups = _split(keys)
+    replaced = _replaced(local)
+    _delete_batch(local)
+    for target, forwarded in groups:
+        manifests = target.delete_many([sdht._unpack_key(key) for key in forwarded])
+        replaced.update([(key, manifest) for key, manifest in zip(forwarded, manifests) if manifest])
+    return replaced
+
+class _Handoff(object):
+    """
+    A range of keys being handed over to another storage.
+
+    The keys are handed over in order so every key from from_key up
+    to (but not including) position lives on the target by now. The
+    rest of the range is still served by this storage.
+
+    The handoff is kept when it is done so requests from clients that
+    routed them before the ring changed are still forwarded. It is
+    dropped when a later transfer covers the same keys or when keys of
+    the range are handed back to this storage.
+    """
+
+    def __init__(self, target, from_key, to_key):
+        """
+        @param target: The storage the range is handed over to
+        @type target: sdht.Node
+
+        @param from_key: Packed key the range starts at ('' for the
+        first key)
+        @type from_key: str
+
+        @param to_key: Packed key the range ends before (None for no
+        end)
+        @type to_key: str
+        """
+        self.target = target
+        self.from_key = from_key
+        self.to_key = to_key
+        self.position = from_key
+        self.done = False
+        # Identifies the handoff in copies of the shared state
+        self.ident = os.urandom(8)
+
+    def moved(self, key):
+        """
+        Check if a key has already been handed over.
+
+        @param key: A packed key
+        @type key: str
+
+        @rtype: bool
+        """
+        return self.from_key <= key < self.position
+
+    def overlaps(self, from_key, to_key):
+        """
+        Check if the range of this handoff overlaps another range.
+
+        @rtype: bool
+        """
+        return ((to_key is None or self.from_key < to_key) and
+                (self.to_key is None or from_key < self.to_key))
+
+class _SharedLock(object):
+    """
+    Lock held shared by the requests and exclusively while the
+    handoffs or the routing information change and while a chunk of
+    a transfer is handed over.
+
+    A waiting exclusive holder keeps new shared holders out so a
+    transfer isn't starved by a steady stream of requests.
+
+    With several worker processes it is built on multiprocessing
+    primitives created before the workers are forked.
+    """
+
+    def __init__(self, condition=None, counts=None):
+        """
+        @param condition: Condition guarding the counts (a
+        threading.Condition by default)
+
+        @param counts: The number of shared holders and if it is held
+        (or wanted) exclusively, a list by default
+        """
+        if condition is None:
+            condition = threading.Condition()
+        if counts is None:
+            counts = [0, 0]
+        self._condition = condition
+        self._counts = counts
+
+    @contextmanager
+    def shared(self):
+        """
+        Hold the lock shared in a with statement.
+        """
+        with self._condition:
+            while self._counts[1]:
+                self._condition.wait()
+            self._counts[0] += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._counts[0] -= 1
+                if not self._counts[0]:
+                    self._condition.notify_all()
+
+    @contextmanager
+    def exclusive(self):
+        """
+        Hold the lock exclusively in a with statement.
+        """
+        with self._condition:
+            while self._counts[1]:
+                self._condition.wait()
+            self._counts[1] = 1
+            while self._counts[0]:
+                self._condition.wait()
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._counts[1] = 0
+                self._condition.notify_all()
+
+class _KeyLocks(object):
+    """
+    Locks the keys changed by the atomic commands are striped over, so
+    two commands changing the same key (in any thread or worker
+    process) don't read it before the other has written it.
+
+    With several worker processes the locks are multiprocessing locks
+    created before the workers are forked.
+    """
+
+    def __init__(self, factory=threading.Lock):
+        """
+        @param factory: Makes a lock (threading.Lock by default)
+        @type factory: callable
+        """
+        self._locks = [factory() for stripe in xrange(KEY_LOCKS)]
+
+    @contextmanager
+    def holding(self, keys):
+        """
+        Hold the locks of keys in a with statement, taken in order so
+        commands locking several keys don't deadlock.
+
+        @param keys: Packed keys
+        @type keys: list
+        """
+        stripes = sorted(set([ord(key[-1]) % KEY_LOCKS for key in keys]))
+        for stripe in stripes:
+            self._locks[stripe].acquire()
+        try:
+            yield
+        finally:
+            for stripe in reversed(stripes):
+                self._locks[stripe].release()
+
+class _SharedState(object):
+    """
+    The ranges handed over to other storages (see _Handoff, at most
+    one of them is still running) and the positions of this storage
+    in the ring by key_id, with the next pointer and finger table last
+    published by a client (see the 'fingers' command), and the ring
+    membership and its epoch (see the 'ring' command).
+
+    With several worker processes each worker has its own copy. A
+    change is saved pickled to shared memory and the other workers
+    reload it on their next request. Changes are made and saved
+    holding the lock exclusively.
+    """
+
+    # Version and length of the pickled state in the shared memory
+    HEADER = struct.Struct('!QI')
+
+    def __init__(self, size=0):
+        """
+        @param size: Bytes of shared memory, 0 when the state is only
+        used by this process
+        @type size: int
+        """
+        self.handoffs = []
+        self.nodes = {}
+        self.ring = None
+        self.epoch = 0
+        self._version = 0
+        self._memory = None
+        if size:
+            # Anonymous maps are shared with the forked workers
+            self._memory = mmap.mmap(-1, size)
+            self._memory[:self.HEADER.size] = self.HEADER.pack(0, 0)
+
+    def refresh(self):
+        """
+        Reload the state if another worker has saved a newer version.
+        """
+        if self._memory is None:
+            return
+        version, length = self.HEADER.unpack_from(self._memory, 0)
+        if version != self._version:
+            start = self.HEADER.size
+            self.handoffs, self.nodes, self.ring, self.epoch = pickle.loads(self._memory[start:start + length])
+            self._version = version
+
+    def save(self):
+        """
+        Save the state for the other workers.
+        """
+        if self._memory is None:
+            return
+        data = pickle.dumps((self.handoffs, self.nodes, self.ring, self.epoch), pickle.HIGHEST_PROTOCOL)
+        start = self.HEADER.size
+        if start + len(data) > len(self._memory):
+            raise ValueError("The shared state doesn't fit in %d bytes" % len(self._memory))
+        self._memory[start:start + len(data)] = data
+        self._version = self.HEADER.unpack_from(self._memory, 0)[0] + 1
+        self._memory[:start] = self.HEADER.pack(self._version, len(data))
+
+    def handoff(self, handoff):
+        """
+        Find the current copy of a handoff.
+
+        @type handoff: _Handoff
+
+        @return: The copy with the same ident (the handoff itself if
+        it has been dropped)
+        @rtype: _Handoff
+        """
+        for other in self.handoffs:
+            if other.ident == handoff.ident:
+                return other
+        return handoff
+
+class _Bloom(object):
+    """
+    A Bloom filter of the keys of this storage, fetched by the clients
+    so they don't ask for keys that aren't here (see
+    sdht.BloomFilters).
+
+    The keys are added when they are written. A deleted key stays in
+    the filter until it is rebuilt from the keys in the engine, at
+    start up and after a transfer has moved keys away. The filter is
+    kept twice: while one is rebuilt the other is served, and both get
+    the keys written meanwhile.
+
+    The filter is in shared memory, so every worker process adds to
+    and serves the same one (the lock is then a multiprocessing lock
+    created before the workers are forked). Its version changes when a
+    key sets new bits and when it is rebuilt.
+
+    The positions of the last keys that set new bits are logged, a
+    client with a filter of the same rebuild is sent those set since
+    instead of the whole filter. The log is as big as the filter, a
+    client further behind gets the whole filter again.
+    """
+
+    # The rebuilds so far, the keys that set new bits since, the copy
+    # served and whether the other one is being rebuilt
+    HEADER = struct.Struct('!QQBB')
+
+    # A position in the log
+    POSITION = struct.Struct('!I')
+
+    def __init__(self, bits=0, factory=threading.Lock):
+        """
+        @param bits: Bits of the filter, 0 for no filter
+        @type bits: int
+
+        @param factory: Makes the lock (threading.Lock by default)
+        @type factory: callable
+        """
+        self.bits = bits
+        self.hashes = BLOOM_HASHES
+        self._bytes = (bits + 7) / 8
+        self._entry = self.hashes * self.POSITION.size
+        # Keys in the log (none if a position doesn't fit)
+        self._logged = bits < 2**32 and self._bytes / self._entry or 0
+        self._lock = factory()
+        self._memory = None
+        if bits:
+            # Anonymous maps are shared with the forked workers
+            self._memory = mmap.mmap(-1, self.HEADER.size + 2 * self._bytes + self._logged * self._entry)
+            self._memory[:self.HEADER.size] = self.HEADER.pack(0, 0, 0, 0)
+
+    def add(self, keys):
+        """
+        Add keys that are written.
+
+        @param keys: Packed keys
+        @type keys: list
+        """
+        if self._memory is None:
+            return
+        with self._lock:
+            generation, additions, served, rebuilding = self.HEADER.unpack_from(self._memory, 0)
+            for key in keys:
+                if len(key) != sdht.KEY_BYTES:
+                    # Not upgraded (see _upgrade_keys), clients don't ask for it
+                    continue
+                positions = sdht._bloom_positions(key, self.bits, self.hashes)
+                if self._set(positions, served):
+                    if self._logged:
+                        start = self._log_start(additions)
+                        self._memory[start:start + self._entry] = struct.pack(
+                            '!%dI' % self.hashes, *positions)
+                    additions += 1
+                if rebuilding:
+                    self._set(positions, 1 - served)
+            self._memory[:self.HEADER.size] = self.HEADER.pack(generation, additions, served, rebuilding)
+
+    def dump(self, version=None, delta=False):
+        """
+        @param version: The version the client has
+        @type version: str
+
+        @param delta: Send the positions set since the version if they
+        are logged
+        @type delta: bool
+
+        @return: The version, the bits of the filter served (None if it
+        is still the version the client has) and True if they are the
+        positions set since instead
+        @rtype: tuple
+        """
+        with self._lock:
+            generation, additions, served, rebuilding = self.HEADER.unpack_from(self._memory, 0)
+            current = '%d.%d' % (generation, additions)
+            if current == version:
+                return current, None, False
+            since = self._since(version, generation)
+            if delta and since is not None and since < additions <= since + self._logged:
+                return current, ''.join([self._memory[self._log_start(addition):
+                                                      self._log_start(addition) + self._entry]
+                                         for addition in xrange(since, additions)]), True
+            start = self.HEADER.size + served * self._bytes
+            return current, self._memory[start:start + self._bytes], False
+
+    def _since(self, version, generation):
+        """
+        @return: The additions of a version of the filter of this
+        rebuild (None if it's of another one)
+        @rtype: int
+        """
+        try:
+            since_generation, since = [int(part) for part in (version or '').split('.')]
+        except ValueError:
+            return None
+        if since_generation != generation:
+            return None
+        return since
+
+    def _log_start(self, addition):
+        """
+        @return: Where the positions of an addition are logged
+        @rtype: int
+        """
+        return self.HEADER.size + 2 * self._bytes + (addition % self._logged) * self._entry
+
+    def rebuild(self, chunks):
+        """
+        Rebuild the filter while the storage goes on serving.
+
+        @param chunks: Lists of the packed keys in the engine
+        @type chunks: iterable
+        """
+        if self._memory is None:
+            return
+        with self._lock:
+            generation, additions, served, rebuilding = self.HEADER.unpack_from(self._memory, 0)
+            start = self.HEADER.size + (1 - served) * self._bytes
+            self._memory[start:start + self._bytes] = '\x00' * self._bytes
+            self._memory[:self.HEADER.size] = self.HEADER.pack(generation, additions, served, 1)
+        done = False
+        try:
+            for keys in chunks:
+                with self._lock:
+                    for key in keys:
+                        if len(key) == sdht.KEY_BYTES:
+                            self._set(sdht._bloom_positions(key, self.bits, self.hashes), 1 - served)
+            done = True
+        finally:
+            with self._lock:
+                generation, additions, served, rebuilding = self.HEADER.unpack_from(self._memory, 0)
+                if done:
+                    generation, additions, served = generation + 1, 0, 1 - served
+                self._memory[:self.HEADER.size] = self.HEADER.pack(generation, additions, served, 0)
+
+    def _set(self, positions, copy):
+        """
+        Set the bits of a key in one copy of the filter.
+
+        @param positions: The positions of the key (see
+        sdht._bloom_positions)
+        @type positions: list
+
+        @return: True if a bit wasn't set yet
+        @rtype: bool
+        """
+        changed = False
+        start = self.HEADER.size + copy * self._bytes
+        for position in positions:
+            offset = start + (position >> 3)
+            byte = ord(self._memory[offset])
+            mask = 1 << (position & 7)
+            if not byte & mask:
+                self._memory[offset] = chr(byte | mask)
+                changed = True
+        return changed
+
+class _Digests(object):
+    """
+    A Merkle tree of digests of the records of this storage, over the
+    same hashes the keys are placed in the ring by. Two storages
+    compare the trees of a range top down to find the parts of it
+    they hold differently, so a transfer only sends those (see
+    _Differences).
+
+    The leaves are the ranges of keys with the same first
+    DIGEST_LEVELS hex digits. The digest of a leaf is the XOR of the
+    SHA-1 of every record in it (see _record_digest), the digest of a
+    node the SHA-1 of the digests of its 16 children, or EMPTY if
+    they all are (there are no records under it).
+
+    The writes to every leaf are counted and a leaf is only hashed
+    again, by reading it from the engine, once it has been written
+    since. The writes under every other node are counted as well, its
+    digest is kept until one of them. Leaves only partly in the range
+    asked for are hashed for that part every time, and so are the
+    nodes above them.
+
+    The counts and digests are in shared memory, so every worker
+    process counts its writes in the same tree (the lock is then a
+    multiprocessing lock created before the workers are forked).
+    """
+
+    # The writes counted, the writes counted when the leaf (or node)
+    # was hashed and its digest
+    LEAF = struct.Struct('!QQ20s')
+
+    # The digest of the nodes without records
+    EMPTY = '\x00' * 20
+
+    def __init__(self, levels=0, factory=threading.Lock):
+        """
+        @param levels: Levels of the tree, 0 for no digests
+        @type levels: int
+
+        @param factory: Makes the lock (threading.Lock by default)
+        @type factory: callable
+        """
+        self.levels = levels
+        self.leaves = 16 ** levels
+        self._shift = sdht.MAXIMUM_BIT - 4 * levels
+        self._lock = factory()
+        self._memory = None
+        self._nodes = None
+        if levels:
+            # Anonymous maps are shared with the forked workers. Every
+            # leaf (and node) counts as written, it is hashed when first
+            # asked for.
+            self._memory = mmap.mmap(-1, self.leaves * self.LEAF.size)
+            self._memory[:] = self.LEAF.pack(1, 0, self.EMPTY) * self.leaves
+            nodes = self._slot(levels, 0)
+            self._nodes = mmap.mmap(-1, nodes * self.LEAF.size)
+            self._nodes[:] = self.LEAF.pack(1, 0, self.EMPTY) * nodes
+
+    def wrote(self, keys):
+        """
+        Count the keys written (or deleted).
+
+        @param keys: Packed keys
+        @type keys: list
+        """
+        if self._memory is None:
+            return
+        counts = {}
+        for key in keys:
+            if len(key) == sdht.KEY_BYTES:
+                leaf = self.leaf(key)
+                counts[leaf] = counts.get(leaf, 0) + 1
+        nodes = {}
+        for leaf, count in counts.iteritems():
+            for length in xrange(self.levels):
+                slot = self._slot(length, leaf >> 4 * (self.levels - length))
+                nodes[slot] = nodes.get(slot, 0) + count
+        with self._lock:
+            for memory, written in ((self._memory, counts), (self._nodes, nodes)):
+                for slot, count in written.iteritems():
+                    writes, hashed, digest = self.LEAF.unpack_from(memory, slot * self.LEAF.size)
+                    self.LEAF.pack_into(memory, slot * self.LEAF.size, writes + count, hashed, digest)
+
+    def leaf(self, key):
+        """
+        @param key: A packed key
+        @type key: str
+
+        @return: The number of the leaf the key is in
+        @rtype: int
+        """
+        # The first hex digits of the key, hexlify is the quickest
+        return int(binascii.hexlify(key[:(self.levels + 1) // 2])[:self.levels], 16)
+
+    def span(self, from_key, to_key):
+        """
+        @param from_key: Packed key the range starts at ('' for the
+        first key)
+        @type from_key: str
+
+        @param to_key: Packed key the range ends before (None for no
+        end)
+        @type to_key: str
+
+        @return: The first and the last leaf with keys of a range
+        (the last is before the first if the range is empty)
+        @rtype: tuple
+        """
+        first = from_key and self.leaf(from_key) or 0
+        if to_key is None:
+            return first, self.leaves - 1
+        last = self.leaf(to_key)
+        if self._bounds(last)[0] == to_key:
+            last -= 1
+        return first, last
+
+    def writes(self, first, last):
+        """
+        @return: The writes counted of the leaves first to last
+        @rtype: list
+        """
+        if first > last:
+            return []
+        with self._lock:
+            data = self._memory[first * self.LEAF.size:(last + 1) * self.LEAF.size]
+        # The counts only, the rest of every leaf is skipped
+        return list(struct.unpack('!' + 'Q28x' * (last - first + 1), data))
+
+    def held(self, first, last):
+        """
+        @return: The number of the leaves first to last with records
+        when they were last hashed
+        @rtype: int
+        """
+        if first > last:
+            return 0
+        with self._lock:
+            data = self._memory[first * self.LEAF.size:(last + 1) * self.LEAF.size]
+        return len([digest for digest in struct.unpack('!' + '16x20s' * (last - first + 1), data)
+                    if digest != self.EMPTY])
+
+    def children(self, prefix, from_key, to_key):
+        """
+        @param prefix: The hex digits of a node of the tree ('' for the
+        root)
+        @type prefix: str
+
+        @return: The prefixes of the children of a node with keys of a
+        range (none for a leaf)
+        @rtype: list
+        """
+        if len(prefix) == self.levels:
+            return []
+        first, last = self.span(from_key, to_key)
+        return [child for child in [prefix + digit for digit in '0123456789abcdef']
+                if self._overlaps(child, first, last)]
+
+    def digests(self, from_key, to_key, prefixes):
+        """
+        Find the digests of nodes of the tree, over the records of a
+        range only.
+
+        @param prefixes: The hex digits of the nodes ('' for the root)
+        @type prefixes: list
+
+        @return: The digests, in the same order as the prefixes
+        @rtype: list
+        """
+        first, last = self.span(from_key, to_key)
+        leaves = {}
+        for leaf in dict.fromkeys([first, last]):
+            # Only the leaves at the ends can be partly in the range,
+            # that part is hashed
+            start, end = self._bounds(leaf)
+            partial = start < from_key
+            if to_key is not None and (end is None or end > to_key):
+                partial, end = True, to_key
+            if partial and first <= last:
+                leaves[leaf] = _hash_records(max(start, from_key), end, self.leaf).get(leaf, self.EMPTY)
+
+        # The nodes kept that weren't written since, below the others
+        # down to the leaves (nodes are numbered by level)
+        edges = leaves.keys()
+        kept = {}
+        counted = {}
+        wanted = []
+        pending = [(len(prefix), int(prefix or '0', 16)) for prefix in prefixes]
+        while pending:
+            length, number = pending.pop()
+            low, high = self._under(length, number)
+            if low > last or high < first:
+                continue
+            elif length == self.levels:
+                if number not in leaves:
+                    wanted.append(number)
+                continue
+            elif low >= first and high <= last and not [leaf for leaf in edges if low <= leaf <= high]:
+                slot = self._slot(length, number)
+                with self._lock:
+                    writes, hashed, digest = self.LEAF.unpack_from(self._nodes, slot * self.LEAF.size)
+                if writes == hashed:
+                    kept[length, number] = digest
+                    continue
+                counted[length, number] = writes
+            if length == self.levels - 1:
+                wanted.extend([leaf for leaf in xrange(max(low, first), min(high, last) + 1)
+                               if leaf not in leaves])
+            else:
+                pending.extend([(length + 1, (number << 4) + digit) for digit in xrange(16)])
+
+        # The leaves wanted, the ones between are under nodes kept and
+        # weren't written
+        if wanted:
+            leaves.update(self._hash(min(wanted), max(wanted), edges))
+        return [self._digest(len(prefix), int(prefix or '0', 16), first, last, leaves, kept, counted)
+                for prefix in prefixes]
+
+    def _digest(self, length, number, first, last, leaves, kept, counted):
+        """
+        Find the digest of a node from its children over the leaves
+        first to last, and keep it if it wasn't written since its
+        writes were counted.
+
+        @param length: Hex digits of the prefix of the node
+        @type length: int
+
+        @param number: The prefix as a number
+        @type number: int
+
+        @param leaves: Digests of the leaves, by leaf
+        @type leaves: dict
+
+        @param kept: Digests of the nodes kept, by length and number
+        @type kept: dict
+
+        @param counted: Writes counted of the nodes to keep, by length
+        and number
+        @type counted: dict
+
+        @rtype: str
+        """
+        if (length, number) in kept:
+            return kept[length, number]
+        low, high = self._under(length, number)
+        if low > last or high < first:
+            return self.EMPTY
+        elif length == self.levels:
+            return leaves.get(number, self.EMPTY)
+        elif length == self.levels - 1:
+            # Only the leaves of the range have digests
+            children = [leaves.get(leaf, self.EMPTY) for leaf in xrange(low, high + 1)]
+        else:
+            children = [self._digest(length + 1, (number << 4) + digit, first, last, leaves, kept, counted)
+                        for digit in xrange(16)]
+        digest = self.EMPTY
+        if children != [self.EMPTY] * 16:
+            digest = sha.new(''.join(children)).digest()
+        kept[length, number] = digest
+        if (length, number) in counted:
+            slot = self._slot(length, number)
+            with self._lock:
+                # Written again meanwhile if the count has grown
+                current = self.LEAF.unpack_from(self._nodes, slot * self.LEAF.size)[0]
+                self.LEAF.pack_into(self._nodes, slot * self.LEAF.size, current,
+                                    counted[length, number], digest)
+        return digest
+
+    def _under(self, length, number):
+        """
+        @return: The first and the last leaf under a node
+        @rtype: tuple
+        """
+        shift = 4 * (self.levels - length)
+        return number << shift, ((number + 1) << shift) - 1
+
+    def _slot(self, length, number):
+        """
+        @param length: Hex digits of the prefix of a node (0 for the root)
+        @type length: int
+
+        @param number: The prefix as a number
+        @type number: int
+
+        @return: Where a node is kept, the nodes of the levels above
+        come first
+        @rtype: int
+        """
+        return (16 ** length - 1) // 15 + number
+
+    def _hash(self, low, high, known):
+        """
+        Find the digests of the leaves low to high, hashing the leaves
+        written since they were last hashed (consecutive ones with one
+        read of the engine).
+
+        @param known: Leaves found already
+        @type known: list
+
+        @return: The digests of the other leaves with records, by leaf
+        @rtype: dict
+        """
+        size = self.LEAF.size
+        with self._lock:
+            data = self._memory[low * size:(high + 1) * size]
+        entries = struct.unpack('!' + 'QQ20s' * (high - low + 1), data)
+        writes, hashed, kept = entries[0::3], entries[1::3], entries[2::3]
+        digests = dict([(low + offset, kept[offset]) for offset in xrange(high - low + 1)
+                        if writes[offset] == hashed[offset] and kept[offset] != self.EMPTY])
+        for leaf in known:
+            digests.pop(leaf, None)
+
+        runs = []
+        for leaf in [low + offset for offset in xrange(high - low + 1) if writes[offset] != hashed[offset]]:
+            if leaf in known:
+                continue
+            # The leaves between two runs are hashed again if few of
+            # them have records, that's cheaper than reading the engine
+            # again
+            elif runs and len([other for other in xrange(runs[-1][1] + 1, leaf) if other in digests]) < 16:
+                runs[-1][1] = leaf
+            else:
+                runs.append([leaf, leaf])
+        for first, last in runs:
+            found = _hash_records(self._bounds(first)[0], self._bounds(last)[1], self.leaf)
+            digests.update(found)
+            count = last - first + 1
+            with self._lock:
+                # Written again meanwhile if the count has grown
+                current = struct.unpack('!' + 'Q28x' * count, self._memory[first * size:(last + 1) * size])
+                self._memory[first * size:(last + 1) * size] = struct.pack(
+                    '!' + 'QQ20s' * count,
+                    *[value for leaf in xrange(first, last + 1)
+                      for value in (current[leaf - first], writes[leaf - low], found.get(leaf, self.EMPTY))])
+        return digests
+
+    def _bounds(self, leaf):
+        """
+        @return: The first packed key of a leaf and the first key after
+        it (None after the last leaf)
+        @rtype: tuple
+        """
+        end = None
+        if leaf + 1 < self.leaves:
+            end = sdht._pack_key(long(leaf + 1) << self._shift)
+        return sdht._pack_key(long(leaf) << self._shift), end
+
+    def _leaves(self, prefix):
+        """
+        @return: The first and the last leaf under a node
+        @rtype: tuple
+        """
+        return int(prefix.ljust(self.levels, '0'), 16), int(prefix.ljust(self.levels, 'f'), 16)
+
+    def _overlaps(self, prefix, first, last):
+        """
+        @return: True if a node has leaves between first and last
+        @rtype: bool
+        """
+        low, high = self._leaves(prefix)
+        return low <= last and high >= first
+
+class _Stats(object):
+    """
+    Counters of the commands executed by this storage: how many of
+    them, how many failed, the seconds they took (and the part spent
+    in the database), the bytes in and out and a histogram of their
+    latencies.
+
+    Every worker process counts in its own slot. With several workers
+    the counters are shared memory, so any worker can answer the
+    'stats' command for the whole storage.
+    """
+
+    FIELDS = ('count', 'errors', 'seconds', 'db_seconds', 'bytes_in', 'bytes_out')
+
+    def __init__(self, workers=1):
+        """
+        @param workers: Worker processes counting (each gets a slot)
+        @type workers: int
+        """
+        self.workers = workers
+        self.slot = 0
+        self.started = time.time()
+        self._stride = len(self.FIELDS) + HISTOGRAM_BUCKETS
+        size = workers * len(STATS_COMMANDS) * self._stride
+        if workers > 1:
+            # Shared with the forked workers
+            self._counters = multiprocessing.RawArray('d', size)
+        else:
+            self._counters = [0.0] * size
+        self._commands = dict([(command, index) for index, command in enumerate(STATS_COMMANDS)])
+        self._lock = threading.Lock()
+
+    def record(self, command, seconds, db_seconds, bytes_in, bytes_out, failed):
+        """
+        Count an executed command.
+
+        @param command: One of STATS_COMMANDS (others are counted as
+        'other')
+        @type command: str
+
+        @param failed: True if it raised or answered one of FAILURES
+        @type failed: bool
+        """
+        index = self._commands.get(command, self._commands['other'])
+        base = (self.slot * len(STATS_COMMANDS) + index) * self._stride
+        bucket = min(HISTOGRAM_BUCKETS - 1, int(seconds * 1000000).bit_length())
+        counters = self._counters
+        with self._lock:
+            counters[base] += 1
+            counters[base + 1] += failed and 1 or 0
+            counters[base + 2] += seconds
+            counters[base + 3] += db_seconds
+            counters[base + 4] += bytes_in
+            counters[base + 5] += bytes_out
+            counters[base + len(self.FIELDS) + bucket] += 1
+
+    def report(self):
+        """
+        Add up the counters of every worker.
+
+        @return: The pid of the worker answering, the seconds since
+        the storage started, the number of workers and the counters of
+        every command executed so far. The histogram of a command is a
+        list of [upper bound in milliseconds, count] of its buckets
+        with a count, p50_ms and p99_ms are read from it (upper
+        bounds).
+        @rtype: dict
+        """
+        commands = {}
+        for index, command in enumerate(STATS_COMMANDS):
+            totals = [0.0] * self._stride
+            for slot in xrange(self.workers):
+                base = (slot * len(STATS_COMMANDS) + index) * self._stride
+                for field in xrange(self._stride):
+                    totals[field] += self._counters[base + field]
+            if not totals[0]:
+                continue
+            stats = dict(zip(self.FIELDS, totals))
+            for field in ('count', 'errors', 'bytes_in', 'bytes_out'):
+                stats[field] = int(stats[field])
+            buckets = totals[len(self.FIELDS):]
+            stats['histogram'] = [[2 ** bucket / 1000.0, int(count)]
+                                  for bucket, count in enumerate(buckets) if count]
+            for name, share in (('p50_ms', 0.5), ('p99_ms', 0.99)):
+                seen = 0
+                for bound, count in stats['histogram']:
+                    seen += count
+                    if seen >= share * stats['count']:
+                        stats[name] = bound
+                        break
+            commands[command] = stats
+        return {'pid': os.getpid(),
+                'uptime': time.time() - self.started,
+                'workers': self.workers,
+                'commands': commands}
+
+class _GroupCommit(object):
+    """
+    Writes of concurrent requests coalesced into one engine write (and
+    one sync to disk).
+
+    The first request to write while no commit is running leads the
+    next commit: it waits up to delay seconds for other requests to
+    join, then writes every record waiting, syncs if the durability
+    asks for it and wakes the requests it wrote for. Requests that
+    come while a commit is running wait for it and are written together
+    by the next one. So the cost of a sync is shared by every request
+    waiting for it instead of being paid by each of them.
+
+    Each worker process commits the writes of its own threads.
+    """
+
+    def __init__(self, durability='async', delay=0.0):
+        """
+        @param durability: One of DURABILITIES
+        @type durability: str
+
+        @param delay: Seconds the leader of a commit waits for other
+        writes to join it
+        @type delay: float
+        """
+        self.durability = durability
+        self.delay = delay
+        self._condition = threading.Condition()
+        self._waiting = []
+        self._records = 0
+        self._committing = False
+
+    def write(self, puts, deletes):
+        """
+        Write records and delete keys, returns when they are written
+        (and synced with the 'sync' durability).
+
+        @param puts: Tuples of a packed key and a serialized value
+        @type puts: list
+
+        @param deletes: Packed keys
+        @type deletes: list
+        """
+        write = {'puts': puts, 'deletes': deletes, 'done': False, 'error': None}
+        with self._condition:
+            self._waiting.append(write)
+            self._records += len(puts) + len(deletes)
+            if self._records >= GROUP_COMMIT_RECORDS:
+                # Don't keep the leader waiting
+                self._condition.notify_all()
+            while not write['done']:
+                if self._committing:
+                    self._condition.wait()
+                    continue
+                self._committing = True
+                if self.delay > 0 and self._records < GROUP_COMMIT_RECORDS:
+                    self._condition.wait(self.delay)
+                batch, self._waiting, self._records = self._waiting, [], 0
+                self._condition.release()
+                error = None
+                try:
+                    self._commit(batch)
+                except Exception, e:
+                    error = e
+                finally:
+                    self._condition.acquire()
+                    self._committing = False
+                    for other in batch:
+                        other['done'] = True
+                        other['error'] = error
+                    self._condition.notify_all()
+        if write['error'] is not None:
+            raise write['error']
+
+    def _commit(self, batch):
+        """
+        Write a batch of waiting writes at once.
+        """
+        # The later write of a key wins, like it would one after the
+        # other
+        latest = {}
+        for write in batch:
+            for key, value in write['puts']:
+                latest[key] = value
+            for key in write['deletes']:
+                latest[key] = None
+        _apply([(key, value) for key, value in latest.iteritems() if value is not None],
+               [key for key, value in latest.iteritems() if value is None])
+        if self.durability == 'sync':
+            _engine.sync()
+
+def _sync_periodically(interval):
+    """
+    Sync the engine every interval seconds (the 'periodic' durability),
+    run by a thread of each worker.
+    """
+    while True:
+        time.sleep(interval)
+        try:
+            _engine.sync()
+        except Exception:
+            _log.exception("Syncing the records failed")
+
+# Connections are served in their own threads (so an idle keep-alive
+# connection doesn't block everybody else). At most --threads requests
+# are executed at the same time in each worker process.
+_slots = threading.BoundedSemaphore(1)
+
+# Requests hold the lock shared, see EXCLUSIVE_COMMANDS
+_lock = _SharedLock()
+
+_state = _SharedState()
+
+_key_locks = _KeyLocks()
+
+_bloom = _Bloom()
+
+_digests = _Digests()
+
+_stats = _Stats()
+
+_commits = _GroupCommit()
+
+# The database time of the request a thread is executing (see _Stats)
+_request = threading.local()
+
+def _running():
+    """
+    Check if a transfer is running.
+
+    @rtype: bool
+    """
+    return [handoff for handoff in _state.handoffs if not handoff.done] != []
+
+def _start_handoff(target, from_key, to_key):
+    """
+    Start handing over a range, replacing older handoffs of the same
+    keys.
+
+    @return: The new handoff
+    @rtype: _Handoff
+    """
+    handoff = _Handoff(target, from_key, to_key)
+    _state.handoffs = [other for other in _state.handoffs if not other.overlaps(from_key, to_key)]
+    _state.handoffs.append(handoff)
+    return handoff
+
+def _forwarded(key):
+    """
+    Find the storage a key has been handed over to.
+
+    @param key: A packed key
+    @type key: str
+
+    @return: The storage or None if the key is still served here
+    @rtype: sdht.Node
+    """
+    for handoff in _state.handoffs:
+        if handoff.moved(key):
+            return handoff.target
+    return None
+
+def _split(keys):
+    """
+    Split keys into those served here and those that have been handed
+    over (see _forwarded).
+
+    @param keys: Packed keys
+    @type keys: list
+
+    @return: The local keys and a list of tuples with a storage and
+    the keys handed over to it
+    @rtype: tuple
+    """
+    local = []
+    groups = {}
+    for key in keys:
+        target = _forwarded(key)
+        if target is None:
+            local.append(key)
+        else:
+            groups.setdefault(sdht._format_address(target), (target, []))[1].append(key)
+    return local, groups.values()
+
+def _in_engine(call, *args):
+    """
+    Call the engine. The time it takes is counted as the database time
+    of the request (see _Stats).
+
+    @param call: A method of the engine
+    @type call: function
+
+    @return: What the call returns
+    """
+    began = time.time()
+    try:
+        return call(*args)
+    finally:
+        _request.db_seconds = getattr(_request, 'db_seconds', 0.0) + time.time() - began
+
+def _write_batch(records):
+    """
+    Write a batch of records at once.
+
+    @param records: Tuples of a packed key and a serialized value
+    @type records: list
+    """
+    _in_engine(_commits.write, records, [])
+
+def _delete_batch(keys):
+    """
+    Delete a batch of records at once, keys that aren't stored are
+    ignored.
+
+    @param keys: Packed keys
+    @type keys: list
+    """
+    _in_engine(_commits.write, [], keys)
+
+def _ingest(data):
+    """
+    Write records handed over by another storage (see storage_app).
+
+    @param data: Packed records
+    @type data: str
+
+    @return: The response parts
+    @rtype: list
+    """
+    records = sdht._unpack_records(data)
+    for handoff in _state.handoffs[:]:
+        if handoff.done and [key for key, value in records if handoff.moved(key)]:
+            # The range is handed back, stop forwarding it
+            _state.handoffs.remove(handoff)
+    # Deleted keys come with the changes of a transfer since a snapshot
+    _in_engine(_commits.write, [(key, value) for key, value in records if value is not None],
+               [key for key, value in records if value is None])
+    return ['OK %d' % len(records)]
+
+def _read_chunk(position, to_key):
+    """
+    Read the records of a transfer chunk.
+
+    @param position: Packed key to start at ('' for the first key)
+    @type position: str
+
+    @param to_key: Packed key to stop before (None for no end)
+    @type to_key: str
+
+    @return: The records and the position of the next chunk
+    @rtype: tuple
+    """
+    chunk = []
+    size = 0
+    began = time.time()
+    records = _engine.range(position, to_key)
+    try:
+        for record in records:
+            chunk.append(record)
+            size += len(record[1])
+            if size >= TRANSFER_CHUNK_BYTES:
+                break
+    finally:
+        records.close()
+        _request.db_seconds = getattr(_request, 'db_seconds', 0.0) + time.time() - began
+    if chunk:
+        # The smallest key after the last one in the chunk
+        position = chunk[-1][0] + '\x00'
+    return chunk, position
+
+def _send_records(target, records):
+    """
+    Send records to the target of a transfer ('ingest').
+
+    @param target: The storage the records are handed over to
+    @type target: sdht.Node
+
+    @param records: Packed keys and values (None for a deleted key)
+    @type records: list
+
+    @return: The number of records and bytes of values sent
+    @rtype: tuple
+    """
+    if records:
+        target.ingest(sdht._pack_records(records))
+    return len(records), sum([len(value) for key, value in records if value is not None])
+
+def _range_writes(records, from_key, to_key):
+    """
+    Count the writes to the leaves of the digest tree (see _Digests) a
+    range of a transfer is in, to tell if it is written later.
+
+    @param records: The records read of the range
+    @type records: list
+
+    @param from_key: Packed key the range starts at ('' for the first
+    key)
+    @type from_key: str
+
+    @param to_key: Packed key the range ends before (None for no end)
+    @type to_key: str
+
+    @return: The writes counted, None if they can't tell (there are no
+    digests or keys not upgraded, see _upgrade_keys)
+    @rtype: list
+    """
+    if not _digests.levels or [key for key, value in records if len(key) != sdht.KEY_BYTES]:
+        return None
+    # The positions between chunks are a key with a byte appended
+    first = from_key and _digests.leaf(from_key[:sdht.KEY_BYTES]) or 0
+    last = to_key is None and _digests.leaves - 1 or _digests.leaf(to_key[:sdht.KEY_BYTES])
+    return _digests.writes(first, last)
+
+def _written_since(records, from_key, to_key, writes):
+    """
+    Find the records of a range of a transfer written since it was
+    read, by reading it again unless the writes counted tell that it
+    wasn't written.
+
+    @param records: The records read of the range
+    @type records: list
+
+    @param writes: The writes counted when they were read (see
+    _range_writes)
+    @type writes: list
+
+    @return: The records of the range now and the ones written since
+    (None as the value of the keys deleted since)
+    @rtype: tuple
+    """
+    if writes is not None and _range_writes(records, from_key, to_key) == writes:
+        return records, []
+    before = dict(records)
+    records = list(_scan(from_key, to_key))
+    written = [(key, value) for key, value in records if before.pop(key, None) != value]
+    written.extend([(key, None) for key in before])
+    written.sort()
+    return records, written
+
+def _stream_transfer(handoff, move, since=None, compare=False):
+    """
+    Hand over the range of a handoff to its target in chunks of packed
+    records ('ingest') and yield the progress as lines of the response.
+
+    A chunk is read holding the lock exclusively and sent without it,
+    so the storage serves requests (for keys in the chunk too) while
+    the target ingests it. The lock is then held again to send the
+    records written meanwhile once more (see _written_since) and to
+    delete the chunk, after that requests for its keys are forwarded
+    to the target.
+
+    @param handoff: The range to hand over
+    @type handoff: _Handoff
+
+    @param move: Delete the records here once they are acknowledged
+    (they are kept when the whole storage is handed over)
+    @type move: bool
+
+    @param since: Only send the keys written since this time and the
+    keys deleted since, the target has the rest from a snapshot. The
+    range is still read (and deleted when moved) chunk by chunk.
+    @type since: float
+
+    @param compare: Compare the digests of the range with the target
+    first and only send the records it doesn't hold (see
+    _Differences), unless only the changes since are sent
+    @type compare: bool
+    """
+    records = size = 0
+    changes = differences = None
+    if since is not None and _journal is not None and _journal.covers(since):
+        changes = _Changes(since)
+    try:
+        if changes is None and compare and _digests.levels:
+            try:
+                differences = _Differences(handoff.target, handoff.from_key, handoff.to_key)
+                _log.info("%s leaves of the range differ on %s:%s",
+                          differences.leaves is None and 'Most' or len(differences.leaves),
+                          handoff.target.ip, handoff.target.port)
+            except sdht.NodeError:
+                _log.info("%s:%s keeps no digests, the whole range is sent",
+                          handoff.target.ip, handoff.target.port)
+        last = False
+        while not last:
+            with _lock.exclusive():
+                _state.refresh()
+                handoff = _state.handoff(handoff)
+                start = handoff.position
+                chunk, position = _read_chunk(start, handoff.to_key)
+                last = not chunk
+                end = chunk and position or handoff.to_key
+                writes = _range_writes(chunk, start, end)
+
+                sent = chunk
+                if changes is not None:
+                    values = dict(chunk)
+                    sent = [(key, values.get(key)) for key in changes.between(start, end)]
+            if differences is not None:
+                sent = differences.records(chunk)
+
+            resends = 0
+            while True:
+                sent_records, sent_bytes = _send_records(handoff.target, sent)
+                records += sent_records
+                size += sent_bytes
+                with _lock.exclusive():
+                    _state.refresh()
+                    handoff = _state.handoff(handoff)
+                    chunk, sent = _written_since(chunk, start, end, writes)
+                    if sent and resends == TRANSFER_RESENDS:
+                        # Written over and over, nothing is written
+                        # while it is sent holding the lock
+                        sent_records, sent_bytes = _send_records(handoff.target, sent)
+                        records += sent_records
+                        size += sent_bytes
+                        sent = []
+                    if not sent:
+                        if move:
+                            _delete_batch([key for key, value in chunk])
+                        handoff.position = position
+                        _state.save()
+                        break
+                    writes = _range_writes(chunk, start, end)
+                resends += 1
+
+            _log.debug("Transfered %d records to %s:%s", records, handoff.target.ip, handoff.target.port)
+            yield 'PROGRESS %d %d\n' % (records, size)
+
+        _log.info("Transfered %d records (%d bytes) to %s:%s", records, size,
+                  handoff.target.ip, handoff.target.port)
+        yield 'OK %d %d\n' % (records, size)
+        if move:
+            # Drop the keys moved away from the filter, before the
+            # transfer counts as done so no other one starts meanwhile
+            _rebuild_bloom()
+    except Exception, e:
+        _log.exception("Transfer to %s:%s failed", handoff.target.ip, handoff.target.port)
+        yield 'FAILURE\n'
+    finally:
+        with _lock.exclusive():
+            _state.refresh()
+            _state.handoff(handoff).done = True
+            _state.save()
+
+def _rebuild_bloom():
+    """
+    Rebuild the Bloom filter from the keys in the engine, read chunk by
+    chunk like a transfer reads them.
+    """
+    def chunks():
+        position = ''
+        while True:
+            chunk, position = _read_chunk(position, None)
+            if not chunk:
+                break
+            yield [key for key, value in chunk]
+    if _bloom.bits:
+        began = time.time()
+        _bloom.rebuild(chunks())
+        _log.info("Rebuilt the Bloom filter of the keys in %.1f seconds", time.time() - began)
+
+def _scan(from_key, to_key):
+    """
+    Read the records of a range in order. The time it takes is counted
+    as the database time of the request (see _Stats).
+
+    @param from_key: Packed key to start at ('' for the first key)
+    @type from_key: str
+
+    @param to_key: Packed key to stop before (None for no end)
+    @type to_key: str
+    """
+    began = time.time()
+    records = _engine.range(from_key, to_key)
+    try:
+        for record in records:
+            yield record
+    finally:
+        records.close()
+        _request.db_seconds = getattr(_request, 'db_seconds', 0.0) + time.time() - began
+
+def _record_digest(key, value):
+    """
+    @return: The SHA-1 of a record, compared by the 'hashes' command
+    and summed up in the leaves of the digest tree (see _Digests)
+    @rtype: str
+    """
+    return sha.new(key + value).digest()
+
+def _hash_records(from_key, to_key, leaf):
+    """
+    Hash the records of a range by leaf of the digest tree (see
+    _Digests).
+
+    @param leaf: Finds the leaf of a packed key
+    @type leaf: callable
+
+    @return: The digests of the leaves with records in the range, by
+    leaf
+    @rtype: dict
+    """
+    sums = {}
+    for key, value in _scan(from_key, to_key):
+        if len(key) == sdht.KEY_BYTES:
+            number = leaf(key)
+            sums[number] = sums.get(number, 0) ^ long(binascii.hexlify(_record_digest(key, value)), 16)
+    return dict([(number, ('%040x' % total).decode('hex')) for number, total in sums.items()])
+
+class _Differences(object):
+    """
+    The leaves of the digest tree (see _Digests) of a range that this
+    storage and the target of a transfer hold differently, found by
+    comparing their trees top down with one request per level.
+
+    The transfer still reads the whole range but only sends the
+    records of those leaves, and of the leaves written since they were
+    compared, that the target doesn't hold with the same value (see
+    the 'hashes' command). Keys only the target holds are left there,
+    like a transfer of the whole range leaves them. If more than
+    DIGEST_DIFFERENT of the leaves compared differ the whole range is
+    sent, that is cheaper than asking for their hashes.
+    """
+
+    def __init__(self, target, from_key, to_key):
+        """
+        @param target: The storage the range is transfered to
+        @type target: sdht.Node
+
+        @param from_key: Packed key the range starts at ('' for the
+        first key)
+        @type from_key: str
+
+        @param to_key: Packed key the range ends before (None for no
+        end)
+        @type to_key: str
+
+        @raise sdht.NodeError: If the target keeps no digests
+        """
+        self._target = target
+        self._first, self._last = _digests.span(from_key, to_key)
+        # Counted before hashing, leaves written after are compared again
+        self._writes = _digests.writes(self._first, self._last)
+        self.leaves = self._compare(from_key, to_key)
+
+    def _compare(self, from_key, to_key):
+        """
+        @return: The leaves that differ (as a dict), None if the target
+        holds nothing of the range or most of it differs
+        @rtype: dict
+        """
+        from_id = from_key and sdht._unpack_key(from_key) or 0
+        to_id = to_key is None and 2**sdht.MAXIMUM_BIT or sdht._unpack_key(to_key)
+        prefixes = ['']
+        held = None
+        while True:
+            theirs = self._target.digests(from_id, to_id, prefixes)
+            if prefixes == [''] and theirs[''] == _Digests.EMPTY:
+                return None
+            mine = _digests.digests(from_key, to_key, prefixes)
+            different = [prefix for prefix, digest in zip(prefixes, mine) if theirs.get(prefix) != digest]
+            if held is None:
+                # Hashed by now
+                held = _digests.held(self._first, self._last)
+            # Every node that differs has a leaf that does
+            if len(different) > max(1, DIGEST_DIFFERENT * held):
+                return None
+            if not different or len(different[0]) == _digests.levels:
+                return dict.fromkeys([int(prefix, 16) for prefix in different], True)
+            prefixes = [child for prefix in different for child in _digests.children(prefix, from_key, to_key)]
+
+    def records(self, chunk):
+        """
+        @param chunk: Records of the range read by the transfer, in
+        order
+        @type chunk: list
+
+        @return: The records of the chunk the target doesn't hold
+        @rtype: list
+        """
+        if self.leaves is None:
+            return chunk
+        keys = [key for key, value in chunk if len(key) == sdht.KEY_BYTES]
+        if not keys:
+            return chunk
+        first, last = _digests.leaf(keys[0]), _digests.leaf(keys[-1])
+        changed = dict([(leaf, True) for leaf, writes in zip(xrange(first, last + 1), _digests.writes(first, last))
+                        if leaf in self.leaves or writes != self._writes[leaf - self._first]])
+
+        # Asked for the hashes of the runs of records in those leaves,
+        # records of keys not upgraded (see _upgrade_keys) are sent
+        candidates = []
+        runs = []
+        running = False
+        for key, value in chunk:
+            if len(key) != sdht.KEY_BYTES:
+                candidates.append((key, value))
+            elif _digests.leaf(key) in changed:
+                candidates.append((key, value))
+                if not running:
+                    runs.append([key, key])
+                runs[-1][1] = key
+                running = True
+            else:
+                running = False
+        ranges = [(sdht._unpack_key(start), sdht._unpack_key(end) + 1) for start, end in runs]
+        theirs = ranges and self._target.hashes(ranges) or {}
+        return [(key, value) for key, value in candidates if theirs.get(key) != _record_digest(key, value)]
+
+class _JournalGap(Exception):
+    """
+    The journal doesn't reach back to the time asked for.
+    """
+
+class _Journal(object):
+    """
+    The keys written by this storage and when they where written.
+    Snapshots and transfers read it to find what changed since a time.
+
+    The journal is a file of fixed size entries appended to by every
+    worker. Once it is larger then max_bytes it is renamed to
+    <path>.1 (replacing the one before) and a new one is started, so
+    the writes of the last one or two max_bytes are remembered. The
+    first entry of a journal marks when it was started.
+    """
+
+    ENTRY = struct.Struct('!dB%ds' % sdht.KEY_BYTES)
+
+    START = 0
+    PUT = 1
+    DELETE = 2
+
+    def __init__(self, path, max_bytes=JOURNAL_BYTES):
+        """
+        @param path: The journal file
+        @type path: str
+
+        @param max_bytes: Bytes of the journal before it is started
+        over
+        @type max_bytes: int
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self._fd = None
+        self._lock = threading.Lock()
+        with self._locked():
+            if not os.path.exists(path):
+                self._start()
+            self._open()
+
+    @contextmanager
+    def _locked(self):
+        """
+        Hold the lock file of the journal, so the workers don't start
+        it over at the same time (or while it is read).
+        """
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+    def _start(self):
+        """
+        Start a new journal. It is marked as started a JOURNAL_MARGIN
+        early, like the snapshots are taken, since nothing was written
+        that isn't in it or in the one before.
+        """
+        with open(self.path + '.new', 'wb') as journal:
+            journal.write(self.ENTRY.pack(time.time() - JOURNAL_MARGIN, self.START,
+                                          '\0' * sdht.KEY_BYTES))
+        os.rename(self.path + '.new', self.path)
+
+    def _open(self):
+        """
+        Open the journal for appending (again, once it was started
+        over).
+        """
+        if self._fd is not None:
+            os.close(self._fd)
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+
+    def record(self, puts, deletes):
+        """
+        Append the keys of a write.
+
+        @param puts: Packed keys written
+        @type puts: list
+
+        @param deletes: Packed keys deleted
+        @type deletes: list
+        """
+        now = time.time()
+        data = ''.join([self.ENTRY.pack(now, self.PUT, key) for key in puts] +
+                       [self.ENTRY.pack(now, self.DELETE, key) for key in deletes])
+        with self._lock:
+            os.write(self._fd, data)
+            if os.fstat(self._fd).st_size < self.max_bytes:
+                return
+            with self._locked():
+                # Another worker may have started it over already
+                if os.fstat(self._fd).st_ino == os.stat(self.path).st_ino:
+                    os.rename(self.path, self.path + '.1')
+                    self._start()
+                self._open()
+
+    def _files(self):
+        """
+        Open the journals, the older one first.
+
+        @rtype: list
+        """
+        files = []
+        with self._locked():
+            for path in (self.path + '.1', self.path):
+                try:
+                    files.append(open(path, 'rb'))
+                except IOError:
+                    pass
+        return files
+
+    def covers(self, since):
+        """
+        @return: True if the journal reaches back to since
+        @rtype: bool
+        """
+        files = self._files()
+        try:
+            started = self.ENTRY.unpack(files[0].read(self.ENTRY.size))[0]
+        finally:
+            for journal in files:
+                journal.close()
+        return started <= since
+
+    def end(self):
+        """
+        @return: A cursor to the end of the journal (see changes)
+        @rtype: tuple
+        """
+        with self._locked():
+            status = os.stat(self.path)
+        return status.st_ino, status.st_size - status.st_size % self.ENTRY.size
+
+    def changes(self, since, cursor=None):
+        """
+        Find the keys written or deleted since a time.
+
+        @param since: The time
+        @type since: float
+
+        @param cursor: Only read the entries after the cursor returned
+        by an earlier call (None to read the whole journal)
+        @type cursor: tuple
+
+        @return: The keys and a cursor to the end of the journal
+        @rtype: tuple
+        """
+        files = self._files()
+        try:
+            inodes = [os.fstat(journal.fileno()).st_ino for journal in files]
+            first, offset = 0, 0
+            if cursor is None:
+                if self.ENTRY.unpack(files[0].read(self.ENTRY.size))[0] > since:
+                    raise _JournalGap("The journal starts after %s" % since)
+                files[0].seek(0)
+            elif cursor[0] in inodes:
+                first, offset = inodes.index(cursor[0]), cursor[1]
+                files[first].seek(offset)
+            else:
+                raise _JournalGap("The journal was started over twice")
+
+            keys = set()
+            size = self.ENTRY.size
+            for index in xrange(first, len(files)):
+                data = files[index].read()
+                # A write of another worker may be half way
+                data = data[:len(data) - len(data) % size]
+                for position in xrange(0, len(data), size):
+                    when, kind, key = self.ENTRY.unpack_from(data, position)
+                    if kind != self.START and when >= since:
+                        keys.add(key)
+                if index > first:
+                    offset = 0
+                offset += len(data)
+            return keys, (inodes[-1], offset)
+        finally:
+            for journal in files:
+                journal.close()
+
+    def close(self):
+        os.close(self._fd)
+        self._fd = None
+
+class _Changes(object):
+    """
+    The keys written since a time, read from the journal and kept up
+    to date while a transfer runs (see _stream_transfer).
+    """
+
+    def __init__(self, since):
+        keys, self._cursor = _journal.changes(since)
+        self._since = since
+        self._keys = sorted(keys)
+
+    def between(self, from_key, to_key):
+        """
+        @param from_key: First packed key
+        @type from_key: str
+
+        @param to_key: Packed key to stop before (None for no end)
+        @type to_key: str
+
+        @return: The changed keys of a range in order
+        @rtype: list
+        """
+        more, self._cursor = _journal.changes(self._since, self._cursor)
+        if more.difference(self._keys):
+            self._keys = sorted(more.union(self._keys))
+        start = bisect.bisect_left(self._keys, from_key)
+        if to_key is None:
+            return self._keys[start:]
+        return self._keys[start:bisect.bisect_left(self._keys, to_key)]
+
+def _apply(puts, deletes):
+    """
+    Write records and delete keys in the engine and journal them.
+
+    @param puts: Tuples of a packed key and a serialized value
+    @type puts: list
+
+    @param deletes: Packed keys
+    @type deletes: list
+    """
+    _bloom.add([key for key, value in puts])
+    _engine.write(puts, deletes)
+    _digests.wrote([key for key, value in puts] + deletes)
+    if _journal is not None:
+        _journal.record([key for key, value in puts], deletes)
+
+def _stream_snapshot(from_key, to_key, since, header):
+    """
+    Stream a snapshot (see sdht.Node.snapshot) as its blocks.
+
+    The records are read chunk by chunk like a transfer reads them,
+    while writes go on. The keys written meanwhile (found in the
+    journal) are read again at the end, so the snapshot holds every
+    write committed before the time in its end block. With since only
+    the keys written since are read, the ones that are gone are
+    written as deleted.
+
+    @param from_key: Packed key to start at ('' for the first key)
+    @type from_key: str
+
+    @param to_key: Packed key to stop before (None for no end)
+    @type to_key: str
+
+    @param since: Only the changes since this time (or None)
+    @type since: float
+
+    @param header: Written in the header block
+    @type header: dict
+    """
+    records = deleted = 0
+    try:
+        yield sdht._pack_block('H', json.dumps(header))
+
+        keys = None
+        if since is None:
+            taken = time.time() - JOURNAL_MARGIN
+            cursor = None
+            if _journal is not None:
+                cursor = _journal.end()
+            position = from_key
+            while True:
+                chunk, position = _read_chunk(position, to_key)
+                if not chunk:
+                    break
+                records += len(chunk)
+                yield sdht._pack_block('R', zlib.compress(sdht._pack_records(chunk), 1))
+            if cursor is not None:
+                taken = time.time() - JOURNAL_MARGIN
+                keys = _journal.changes(0.0, cursor)[0]
+        else:
+            taken = time.time() - JOURNAL_MARGIN
+            keys = _journal.changes(since)[0]
+
+        if keys:
+            keys = sorted([key for key in keys if from_key <= key and (to_key is None or key < to_key)])
+            for start in xrange(0, len(keys), SNAPSHOT_BATCH):
+                batch = keys[start:start + SNAPSHOT_BATCH]
+                found = _in_engine(_engine.get_many, batch)
+                changed = [(key, found.get(key)) for key in batch]
+                records += len(found)
+                deleted += len(batch) - len(found)
+                yield sdht._pack_block('R', zlib.compress(sdht._pack_records(changed), 1))
+
+        _log.info("Snapshot of %d records and %d deleted keys taken", records, deleted)
+        yield sdht._pack_block('E', json.dumps({'time': taken, 'records': records, 'deleted': deleted}))
+    except Exception:
+        # The client notices the missing end block
+        _log.exception("Snapshot failed")
+
+def _load(stream):
+    """
+    Load a snapshot straight into the engine (see storage_app), without
+    forwarding or group commits.
+
+    @param stream: The snapshot
+    @type stream: file
+
+    @return: The response parts
+    @rtype: list
+    """
+    records = deleted = 0
+    for kind, data in sdht._read_blocks(stream):
+        if kind != 'R':
+            continue
+        chunk = sdht._unpack_records(zlib.decompress(data))
+        puts = [(key, value) for key, value in chunk if value is not None]
+        deletes = [key for key, value in chunk if value is None]
+        _in_engine(_apply, puts, deletes)
+        records += len(puts)
+        deleted += len(deletes)
+    _log.info("Loaded %d records and %d deleted keys from a snapshot", records, deleted)
+    return ['OK %d %d' % (records, deleted)]
+
+def _db_key(key):
+    """
+    Turn a hashed key from a request (a decimal string) into the key
+    it is stored with.
+
+    Keys are stored as the fixed width big-endian bytes of the hash
+    so the engines keep them in ring order and a range can be read
+    in order instead of scanning every key.
+
+    @param key: A hashed key
+    @type key: str
+
+    @rtype: str
+    """
+    return sdht._pack_key(long(key))
+
+def _upgrade_keys():
+    """
+    Re-store keys written as decimal strings (by older versions of
+    the storage) with the binary encoding used by _db_key.
+
+    The records are read chunk by chunk like a transfer reads them and
+    the keys of each chunk are re-stored in one write (journaled like
+    any other write).
+
+    @return: Number of upgraded keys
+    @rtype: int
+    """
+    upgraded = 0
+    position = ''
+    while True:
+        chunk, position = _read_chunk(position, None)
+        if not chunk:
+            return upgraded
+        old = [(key, value) for key, value in chunk
+               if len(key) != sdht.KEY_BYTES and key.isdigit()]
+        if old:
+            _in_engine(_apply, [(_db_key(key), value) for key, value in old],
+                       [key for key, value in old])
+            upgraded += len(old)
+
+class KeepAliveServerHandler(ServerHandler):
+    """
+    Answers with HTTP/1.1 and closes the connection after responses
+    without a length (streamed transfers).
+    """
+    http_version = '1.1'
+
+    def cleanup_headers(self):
+        """
+        Mark the connection for closing if the response has no length.
+        """
+        ServerHandler.cleanup_headers(self)
+        if 'Content-Length' not in self.headers:
+            # The end of the connection is the end of the response
+            self.headers['Connection'] = 'close'
+            self.request_handler.close_connection = 1
+
+class KeepAliveHandler(WSGIRequestHandler):
+    """
+    Request handler that keeps serving requests on the same connection
+    (HTTP/1.1 keep-alive) so the connection pools of the clients and
+    the other storages can reuse it.
+
+    Idle connections are closed after KEEP_ALIVE_TIMEOUT seconds.
+    Nagle is turned off since the headers and the body are written
+    separately and would otherwise wait for the delayed ACK of the
+    client on every request.
+    """
+    protocol_version = 'HTTP/1.1'
+    timeout = KEEP_ALIVE_TIMEOUT
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        """
+        Log the requests at the debug level instead of writing every
+        one of them to stderr (with a reverse lookup of the client).
+        """
+        if _log.isEnabledFor(logging.DEBUG):
+            _log.debug("%s %s", self.client_address[0], format % args)
+
+    def log_error(self, format, *args):
+        _log.warning("%s %s", self.client_address[0], format % args)
+
+    def handle(self):
+        """
+        Handle requests until the client or the timeout closes the
+        connection.
+        """
+        self.close_connection = 1
+        self.handle_one_request()
+        while not self.close_connection:
+            self.handle_one_request()
+
+    def handle_one_request(self):
+        """
+        Handle a single request with the WSGI application.
+        """
+        try:
+            self.raw_requestline = self.rfile.readline()
+        except socket.timeout:
+            self.close_connection = 1
+            return
+        if not self.raw_requestline:
+            self.close_connection = 1
+            return
+        if not self.parse_request():
+            return
+
+        handler = KeepAliveServerHandler(self.rfile, self.wfile, self.get_stderr(), self.get_environ())
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+
+class StorageServer(ThreadingMixIn, WSGIServer):
+    """
+    WSGI server that serves each connection in its own thread.
+
+    The worker processes of a storage each bind their own server to
+    the same port with SO_REUSEPORT and the kernel spreads the
+    connections between them.
+    """
+    daemon_threads = True
+    reuse_port = False
+    # Clients open several connections at once (see sdht_async), the
+    # default backlog of 5 drops the rest and they wait for a resend
+    request_queue_size = 128
+
+    def server_bind(self):
+        """
+        Bind the socket, sharing the port if reuse_port is set.
+        """
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        WSGIServer.server_bind(self)
+
+class ReusePortStorageServer(StorageServer):
+    """
+    Storage server of one of several worker processes.
+    """
+    reuse_port = True
+
+def _get_args():
+    """
+    Parse launcher arguments and display help.
+    """
+    usage = 'usage: %prog [options]'
+    desc = "Launches a small WSGI (HTTP) server that provides the means of storage to Berkeley DB (or another storage engine)"
+
+    parser = OptionParser(usage = usage, description = desc)
+    parser.add_option('-p',
+                      dest='port',
+                      type='int',
+                      default=8000,
+                      help=("Port number to run the server on"))
+    parser.add_option('--pool-size',
+                      dest='pool_size',
+                      type='int',
+                      default=sdht.POOL_SIZE,
+                      help=("Idle connections kept per storage when transfering data"))
+    parser.add_option('--pool-idle-timeout',
+                      dest='pool_idle_timeout',
+                      type='float',
+                      default=sdht.POOL_IDLE_TIMEOUT,
+                      help=("Seconds before an idle pooled connection is closed"))
+    parser.add_option('--connect-timeout',
+                      dest='connect_timeout',
+                      type='float',
+                      default=sdht.CONNECT_TIMEOUT,
+                      help=("Seconds to wait for a connection to another storage"))
+    parser.add_option('--read-timeout',
+                      dest='read_timeout',
+                      type='float',
+                      default=sdht.READ_TIMEOUT,
+                      help=("Seconds another storage may stay silent while it is sent "
+                            "records or answers"))
+    parser.add_option('--db',
+                      dest='db_name',
+                      default=None,
+                      help=("Where the engine keeps the records (/tmp/distributed_storage_<port>.db "
+                            "by default, .<engine> for engines other then bdb), "
+                            "the Berkeley DB environment is kept in <db>.env"))
+    parser.add_option('--engine',
+                      dest='engine',
+                      default=sdht_engines.DEFAULT_ENGINE,
+                      choices=sorted(sdht_engines.ENGINES),
+                      help=("Storage engine: bdb (Berkeley DB), sqlite (WAL mode), log (log-structured "
+                            "append-only file) or memory (nothing kept, for tests), "
+                            "default %s" % sdht_engines.DEFAULT_ENGINE))
+    parser.add_option('--durability',
+                      dest='durability',
+                      default='async',
+                      choices=list(DURABILITIES),
+                      help=("When writes are flushed to disk: async (by the operating system), "
+                            "periodic (every --sync-interval seconds) or sync (before a write "
+                            "is answered), default async"))
+    parser.add_option('--sync-interval',
+                      dest='sync_interval',
+                      type='float',
+                      default=1.0,
+                      help=("Seconds between the syncs of the periodic durability"))
+    parser.add_option('--commit-delay',
+                      dest='commit_delay',
+                      type='float',
+                      default=0.0,
+                      help=("Milliseconds a write waits for concurrent writes to be committed "
+                            "(and synced) together, writes coming during a commit always are"))
+    parser.add_option('--threads',
+                      dest='threads',
+                      type='int',
+                      default=1,
+                      help=("Requests executed at the same time by each worker process"))
+    parser.add_option('--workers',
+                      dest='workers',
+                      type='int',
+                      default=1,
+                      help=("Worker processes sharing the port and the database"))
+    parser.add_option('--log-level',
+                      dest='log_level',
+                      default='info',
+                      choices=['debug', 'info', 'warning', 'error'],
+                      help=("Log messages of this level and above: debug (every request), "
+                            "info (transfers), warning or error"))
+    parser.add_option('--journal-bytes',
+                      dest='journal_bytes',
+                      type='int',
+                      default=JOURNAL_BYTES,
+                      help=("Bytes of the journal of the keys written, which lets snapshots "
+                            "and transfers send only the changes since a time (0 for none), "
+                            "kept in <db>.journal"))
+    parser.add_option('--bloom-bits',
+                      dest='bloom_bits',
+                      type='int',
+                      default=BLOOM_BITS,
+                      help=("Bits of the Bloom filter of the keys the clients fetch to skip "
+                            "the gets of missing keys, 10 per key keep the false positives "
+                            "near 1% (0 for no filter)"))
+    parser.add_option('--load',
+                      dest='load',
+                      default=None,
+                      help=("Load a snapshot (see sdht.Node.snapshot) before serving"))
+    parser.add_option('--upgrade-keys',
+                      dest='upgrade_keys',
+                      action='store_true',
+                      default=False,
+                      help=("Convert keys stored by older versions (decimal strings) before serving"))
+
+    (options, args) = parser.parse_args()
+    return options
+    
+def _open_engine(options, recover=False):
+    """
+    Open the engine the records are kept in.
+
+    @param options: The launcher options (engine, db_name and
+    journal_bytes)
+
+    @param recover: Recover the records first, only the process that
+    opens the engine before the workers are forked may do that
+    @type recover: bool
+    """
+    global _engine, _journal
+
+    _engine = sdht_engines.open_engine(options.engine, options.db_name, recover)
+    if options.journal_bytes:
+        _journal = _Journal(options.db_name + '.journal', options.journal_bytes)
+
+def _read_ring(path):
+    """
+    Read the ring membership kept by an earlier run into the state.
+
+    @param path: The file the membership is kept in
+    @type path: str
+    """
+    global _ring_path
+
+    _ring_path = path
+    try:
+        with open(path) as stream:
+            membership = stream.read()
+    except IOError, error:
+        if error.errno != errno.ENOENT:
+            raise
+        return
+    _state.ring, _state.epoch = membership, json.loads(membership)['epoch']
+
+def _save_ring():
+    """
+    Keep the ring membership of the state on disk, replaced atomically.
+    """
+    if _ring_path is None:
+        return
+    temporary = '%s.%d.tmp' % (_ring_path, os.getpid())
+    with open(temporary, 'w') as stream:
+        stream.write(_state.ring)
+    os.rename(temporary, _ring_path)
+
+def _close_engine():
+    """
+    Close the engine.
+    """
+    global _engine, _journal
+
+    _engine.close()
+    _engine = None
+    if _journal is not None:
+        _journal.close()
+        _journal = None
+
+def _serve(options, server_class):
+    """
+    Serve requests until the process is killed.
+    """
+    global _slots
+
+    _slots = threading.BoundedSemaphore(options.threads)
+    if options.durability == 'periodic':
+        syncer = threading.Thread(target=_sync_periodically, args=(options.sync_interval,))
+        syncer.daemon = True
+        syncer.start()
+    httpd = make_server('', options.port, storage_app,
+                        server_class=server_class, handler_class=KeepAliveHandler)
+    httpd.serve_forever()
+
+def _run_workers(options):
+    """
+    Fork the worker processes and wait for them. They are killed with
+    this process.
+    """
+    global _lock, _state, _stats, _key_locks
+
+    # Shared before forking so every worker sees the same
+    _lock = _SharedLock(multiprocessing.Condition(), multiprocessing.RawArray('i', 2))
+    _key_locks = _KeyLocks(multiprocessing.Lock)
+    ring, epoch = _state.ring, _state.epoch
+    _state = _SharedState(SHARED_STATE_BYTES)
+    _state.ring, _state.epoch = ring, epoch
+    _state.save()
+    _stats = _Stats(options.workers)
+
+    workers = []
+    for i in xrange(options.workers):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                _stats.slot = i
+                _open_engine(options)
+                _serve(options, ReusePortStorageServer)
+            finally:
+                os._exit(1)
+        workers.append(pid)
+
+    def stop(signum, frame):
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, stop)
+
+    try:
+        while workers:
+            pid, status = os.wait()
+            workers.remove(pid)
+    except KeyboardInterrupt:
+        stop(signal.SIGINT, None)
+
+def main():
+    """
+    Main launcher for the WSGI (HTTP) application which provides the
+    means of storage to a simple Berkeley DB (or one of the other
+    engines of sdht_engines).
+
+    The port number is the main argument, the pool options tune the
+    connections used when transfering data to other storages. The
+    threads and workers options let one storage use all the cores of
+    a box.
+
+    BTREE is choosen to gain performance but as many programmers
+    know this is never a obvious choice. Especially when the data
+    grows and b-trees become more cumbersome to handle then HASH.
+    
+    But the layer used to find where to put the data scales in
+    specific mannor this will still be enough
+    """
+    global _bloom, _digests
+
+    options = _get_args()
+    logging.basicConfig(level=getattr(logging, options.log_level.upper()),
+                        format='%(asctime)s [%(process)d] %(levelname)s %(message)s')
+    sdht.configure_pool(options.pool_size, options.pool_idle_timeout,
+                        options.connect_timeout, options.read_timeout)
+    _commits.durability = options.durability
+    _commits.delay = options.commit_delay / 1000.0
+
+    if options.db_name is None:
+        suffix = 'db' if options.engine == 'bdb' else options.engine
+        options.db_name = "/tmp/distributed_storage_%s.%s" % (options.port, suffix)
+    if options.workers > 1 and not sdht_engines.ENGINES[options.engine].shared:
+        sys.exit("The %s engine can't be shared by several workers" % options.engine)
+    _open_engine(options, True)
+    _read_ring(options.db_name + '.ring')
+
+    if options.upgrade_keys:
+        _log.info("Upgraded %s keys", _upgrade_keys())
+
+    if options.load:
+        with open(options.load, 'rb') as snapshot:
+            _load(snapshot)
+
+    # Shared with the workers forked later
+    _bloom = _Bloom(options.bloom_bits, options.workers > 1 and multiprocessing.Lock or threading.Lock)
+    _rebuild_bloom()
+    _digests = _Digests(DIGEST_LEVELS, options.workers > 1 and multiprocessing.Lock or threading.Lock)
+
+    _log.info("Serving storage (HTTP) on port %s with %s worker(s) of %s thread(s) on the %s engine...",
+              options.port, options.workers, options.threads, options.engine)
+
+    # Respond to requests until process is killed
+    if options.workers > 1:
+        # The workers open the engine again after the fork
+        _close_engine()
+        _run_workers(options)
+    else:
+        _serve(options, StorageServer)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,973 @@
+#! /usr/bin/python
+# -*- mode: python -*-
+
+"""
+Benchmarks for the Simplified distributable hash table.
+
+Each benchmark is a small function that prints its results as a plain
+table. Pick one with the first argument:
+
+$> python sdht-bench.py routing
+$> python sdht-bench.py -w 4 load
+$> python sdht-bench.py --value-size 1000 protocol
+$> python sdht-bench.py --nodes 32 distribution
+$> python sdht-bench.py --storages 3 replication
+$> python sdht-bench.py --storages 4 --zipf 1.1 --rebalance join --json run.json workload
+$> python sdht-bench.py --keys 100000 engines
+$> python sdht-bench.py -n 10000 codecs
+$> python sdht-bench.py --keys 100000 repair
+
+The workload benchmark also writes its results as JSON and compares
+them with the results of an earlier run:
+
+$> python sdht-bench.py --compare run.json --json new.json workload
+"""
+
+from optparse import OptionParser
+
+import os, random, shutil, socket, subprocess, sys, tempfile, time
+import bisect, json, platform, shlex
+import multiprocessing
+import sdht, sdht_engines
+
+def _reset_ring():
+    """
+    Forget every node the sdht module knows about.
+    """
+    del sdht._node_list[:]
+    del sdht._ring_ids[:]
+
+def _build_ring(size):
+    """
+    Link size nodes into the ring without talking to any storage.
+
+    @param size: Number of nodes in the ring
+    @type size: int
+    """
+    _reset_ring()
+    for i in xrange(size):
+        sdht._link(sdht.Node('10.%d.%d.%d' % (i >> 16, (i >> 8) & 255, i & 255), '8000'))
+    for node in sdht._node_list:
+        node.fingers = [sdht.find_node(node, (node.key_id + 2**i) % 2**sdht.MAXIMUM_BIT)
+                        for i in xrange(sdht.MAXIMUM_BIT)]
+
+def _walk(start, key):
+    """
+    The linear ring walk find_node used before it got the ring index.
+    Only kept here as a reference point.
+    """
+    current = start
+    while len(sdht._node_list) > 1 and sdht.distance(current.key_id, key) > sdht.distance(current.next.key_id, key):
+        current = current.next
+    return current
+
+def _hops(start, key):
+    """
+    Count the hops sdht.route would need to find the owner of a key
+    from start, answering every find_successor locally.
+    """
+    node, hops = start, 0
+    while not node.owns(key):
+        node = node.closest_preceding(key)
+        hops += 1
+    return hops
+
+def _time_lookups(lookup, keys):
+    """
+    Time how long a lookup takes on average.
+
+    @return: Microseconds per lookup
+    @rtype: float
+    """
+    start = sdht._node_list[0]
+    began = time.time()
+    for key in keys:
+        lookup(start, key)
+    return (time.time() - began) * 1000000.0 / len(keys)
+
+def routing(options):
+    """
+    Routing micro-benchmark. Times find_node (binary search on the
+    ring index) for growing rings and compares it with the old linear
+    walk while that one is still bearable to run. Also shows how many
+    finger table hops route needs from a random node.
+    """
+    keys = [random.getrandbits(sdht.MAXIMUM_BIT) for i in xrange(options.lookups)]
+    print "%8s %16s %16s %12s" % ("nodes", "find_node (us)", "walk (us)", "route hops")
+    for size in (10, 100, 1000, 10000):
+        _build_ring(size)
+        for key in keys[:100]:
+            if sdht.find_node(sdht._node_list[0], key) is not _walk(sdht._node_list[0], key):
+                raise AssertionError("find_node and the ring walk disagree on %s" % key)
+        indexed = _time_lookups(sdht.find_node, keys)
+        if size <= 1000:
+            walked = "%16.2f" % _time_lookups(_walk, keys[:max(options.lookups / size, 10)])
+        else:
+            walked = "%16s" % "-"
+        hops = [_hops(random.choice(sdht._node_list), key) for key in keys[:1000]]
+        print "%8d %16.2f %s %12.2f" % (size, indexed, walked, float(sum(hops)) / len(hops))
+    _reset_ring()
+
+def _storage_command():
+    """
+    The command line starting a storage, next to this script in the
+    source tree or as installed by the package.
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for name in ('minor-wsgi-storage.py', 'minor-wsgi-storage'):
+        path = os.path.join(directory, name)
+        if os.path.exists(path):
+            return [sys.executable, path]
+    raise IOError("Can't find minor-wsgi-storage next to %s" % __file__)
+
+def _free_port():
+    """
+    A port nobody listens on right now.
+    """
+    sock = socket.socket()
+    try:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+def _start_storage(port, db_name, args):
+    """
+    Start a storage and wait until it answers.
+
+    @param args: Extra options for the storage
+    @type args: list
+
+    @return: The storage process
+    @rtype: subprocess.Popen
+    """
+    devnull = open(os.devnull, 'w')
+    process = subprocess.Popen(_storage_command() + ['-p', str(port), '--db', db_name] + args,
+                               stdout=devnull, stderr=subprocess.STDOUT)
+    node = sdht.Node('127.0.0.1', str(port))
+    deadline = time.time() + 10
+    while True:
+        try:
+            node.check()
+            return process
+        except (socket.error, sdht.NodeError):
+            if time.time() > deadline or process.poll() is not None:
+                process.kill()
+                raise sdht.NodeError("The storage on port %s didn't start" % port)
+            time.sleep(0.1)
+
+def _stop_storage(process):
+    """
+    Stop a storage started by _start_storage (and its workers).
+    """
+    process.terminate()
+    process.wait()
+
+class _Cluster(object):
+    """
+    Storages started on free ports with their databases in a temporary
+    directory.
+    """
+
+    def __init__(self, args=None):
+        """
+        @param args: Extra options for the storages
+        @type args: list
+        """
+        self.args = args or []
+        self.directory = tempfile.mkdtemp(prefix='sdht-bench-')
+        self.nodes = []
+        self._processes = []
+
+    def start(self):
+        """
+        Start one more storage.
+
+        @return: Its node
+        @rtype: sdht.Node
+        """
+        port = _free_port()
+        db_name = os.path.join(self.directory, 'storage%d.db' % len(self.nodes))
+        self._processes.append(_start_storage(port, db_name, self.args))
+        self.nodes.append(sdht.Node('127.0.0.1', str(port)))
+        return self.nodes[-1]
+
+    def stop(self):
+        """
+        Stop every storage and remove their databases.
+        """
+        for process in self._processes:
+            _stop_storage(process)
+        shutil.rmtree(self.directory)
+
+def _load_client(port, keys, value, reads, duration, results):
+    """
+    Send gets and sets to a storage until the time is up and put the
+    number of requests done in the results queue. Run in its own
+    process so the clients don't share an interpreter lock.
+    """
+    sdht.configure_pool(1)
+    node = sdht.Node('127.0.0.1', str(port))
+    done = 0
+    deadline = time.time() + duration
+    while time.time() < deadline:
+        key = random.choice(keys)
+        if random.random() < reads:
+            try:
+                node[key]
+            except KeyError:
+                pass
+        else:
+            node[key] = value
+        done += 1
+    results.put(done)
+
+def load(options):
+    """
+    Load benchmark of a single storage. Runs the same mix of gets and
+    sets from several client processes against a storage executing
+    one request at a time, one with --threads and one with --workers
+    and compares their throughput.
+    """
+    value = 'x' * options.value_size
+    keys = [sdht._hash('key%d' % i) for i in xrange(options.keys)]
+    modes = [('single', []),
+             ('threads', ['--threads', str(options.workers)]),
+             ('workers', ['--workers', str(options.workers)])]
+
+    print "%8s %8s %8s %12s %8s" % ("mode", "workers", "clients", "ops/s", "speedup")
+    single = None
+    for name, args in modes:
+        directory = tempfile.mkdtemp(prefix='sdht-bench-')
+        port = _free_port()
+        process = _start_storage(port, os.path.join(directory, 'storage.db'), args)
+        try:
+            sdht.Node('127.0.0.1', str(port)).set_many(keys, [value] * len(keys))
+            results = multiprocessing.Queue()
+            clients = [multiprocessing.Process(target=_load_client,
+                                               args=(port, keys, value, options.reads,
+                                                     options.duration, results))
+                       for i in xrange(options.clients)]
+            for client in clients:
+                client.start()
+            done = sum([results.get() for client in clients])
+            for client in clients:
+                client.join()
+        finally:
+            _stop_storage(process)
+            shutil.rmtree(directory)
+
+        throughput = done / options.duration
+        if single is None:
+            single = throughput
+        workers = name == 'single' and 1 or options.workers
+        print "%8s %8d %8d %12.1f %8.2f" % (name, workers, options.clients, throughput, throughput / single)
+
+class _CountingPool(sdht.ConnectionPool):
+    """
+    Connection pool that counts the bytes of the request and response
+    bodies.
+    """
+
+    def __init__(self):
+        sdht.ConnectionPool.__init__(self)
+        self.sent = self.received = 0
+
+    def post(self, ip, port, data, content_type='application/x-www-form-urlencoded'):
+        result = sdht.ConnectionPool.post(self, ip, port, data, content_type)
+        self.sent += len(data)
+        self.received += len(result)
+        return result
+
+def _cpu(pid=None):
+    """
+    CPU seconds used by a process so far.
+
+    @param pid: Another process (read from /proc) or None for this one
+
+    @return: The seconds or None if they can't be read
+    @rtype: float
+    """
+    if pid is None:
+        user, system = os.times()[:2]
+        return user + system
+    try:
+        fields = open('/proc/%d/stat' % pid).read().rsplit(')', 1)[1].split()
+    except IOError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+
+def protocol(options):
+    """
+    Wire protocol benchmark. Sets and gets binary values one at a time
+    and in batches of 100 with urlencoded forms and with binary frames
+    and compares the bytes of the bodies sent and received and the CPU
+    used by the client and the storage for every operation.
+    """
+    value = os.urandom(options.value_size)
+    keys = [sdht._hash('key%d' % i) for i in xrange(options.keys)]
+    batches = [keys[i:i + 100] for i in xrange(0, len(keys), 100)]
+
+    directory = tempfile.mkdtemp(prefix='sdht-bench-')
+    port = _free_port()
+    process = _start_storage(port, os.path.join(directory, 'storage.db'), [])
+    pool = sdht._pool = _CountingPool()
+    node = sdht.Node('127.0.0.1', str(port))
+    operations = [('set', lambda: [node.__setitem__(key, value) for key in keys]),
+                  ('get', lambda: [node[key] for key in keys]),
+                  ('mset', lambda: [node.set_many(batch, [value] * len(batch)) for batch in batches]),
+                  ('mget', lambda: [node.get_many(batch) for batch in batches])]
+
+    print "%8s %6s %12s %12s %14s %14s" % ("protocol", "op", "sent B/op", "recv B/op",
+                                         "client us/op", "storage us/op")
+    try:
+        for name in ('form', 'frame'):
+            sdht.configure_protocol(name)
+            node.check()
+            for operation, run in operations:
+                pool.sent = pool.received = 0
+                client, storage = _cpu(), _cpu(process.pid)
+                run()
+                client = (_cpu() - client) * 1000000.0 / len(keys)
+                if storage is not None:
+                    storage = "%14.1f" % ((_cpu(process.pid) - storage) * 1000000.0 / len(keys))
+                else:
+                    storage = "%14s" % "-"
+                print "%8s %6s %12.1f %12.1f %14.1f %s" % (name, operation, float(pool.sent) / len(keys),
+                                                        float(pool.received) / len(keys), client, storage)
+    finally:
+        sdht.configure_pool()
+        sdht.configure_protocol()
+        _stop_storage(process)
+        shutil.rmtree(directory)
+
+def _join_locally(node):
+    """
+    Link all positions of a node into the ring without talking to any
+    storage and return the ranges it would steal.
+    """
+    sdht._begin_join(node)
+    steals = sdht._steals(node)
+    for position in node.positions():
+        position.source = None
+    return steals
+
+def distribution(options):
+    """
+    Virtual node benchmark. Builds rings of the same nodes with more
+    and more positions per node and shows how evenly the hashes are
+    shared (load is the share of a node divided by its fair share) and
+    what one more node joining would steal: the share of all hashes,
+    the number of ranges and from how many nodes. Ends with the full
+    report of the ring with the most positions.
+    """
+    print "%8s %8s %10s %10s %10s %10s %8s %8s" % ("vnodes", "nodes", "max load", "min load",
+                                                  "deviation", "joined %", "ranges", "sources")
+    try:
+        for virtual_nodes in (1, 8, 32, 128):
+            sdht.VIRTUAL_NODES = virtual_nodes
+            _reset_ring()
+            for i in xrange(options.nodes):
+                _join_locally(sdht.Node('10.0.%d.%d' % (i >> 8, i & 255), '8000'))
+            loads = [share / fair for node, positions, share, fair in sdht.distribution()]
+            mean = sum(loads) / len(loads)
+            deviation = (sum([(load - mean) ** 2 for load in loads]) / len(loads)) ** 0.5
+
+            joining = sdht.Node('10.1.0.0', '8000')
+            steals = _join_locally(joining)
+            joined = [share for node, positions, share, fair in sdht.distribution()
+                      if sdht._format_address(node) == sdht._format_address(joining)][0]
+            sources = len(set([sdht._format_address(node) for node, from_id, to_id in steals]))
+            print "%8d %8d %10.2f %10.2f %10.3f %10.2f %8d %8d" % (virtual_nodes, options.nodes, max(loads),
+                                                               min(loads), deviation, joined * 100,
+                                                               len(steals), sources)
+        print
+        print sdht.distribution_report()
+    finally:
+        sdht.VIRTUAL_NODES = 1
+        _reset_ring()
+
+def _percentile(latencies, percentile):
+    """
+    @param latencies: Sorted latencies
+    @type latencies: list
+
+    @return: The latency below which percentile of them are, in
+    milliseconds
+    @rtype: float
+    """
+    return latencies[min(len(latencies) - 1, int(len(latencies) * percentile / 100.0))] * 1000.0
+
+def replication(options):
+    """
+    Replication benchmark. Joins a ring of local storages keeping every
+    key on 1, 2 and 3 of them and times single gets (from the fastest
+    replica, hedged) and sets (acknowledged by every replica) to show
+    their tail latencies.
+    """
+    value = 'x' * options.value_size
+    keys = ['key%d' % i for i in xrange(options.keys)]
+    cluster = _Cluster()
+    print "%9s %6s %10s %10s %10s %10s" % ("replicas", "op", "p50 ms", "p99 ms", "p99.9 ms", "max ms")
+    try:
+        nodes = [cluster.start() for i in xrange(options.storages)]
+        for replicas in (1, 2, 3):
+            if replicas > len(nodes):
+                break
+            sdht.configure_replication(replicas)
+            _reset_ring()
+            for node in nodes:
+                sdht.join(node)
+            sdht.set_many([(key, value) for key in keys])
+            for name, operation in (('get', sdht.get), ('set', lambda key: sdht.set(key, value))):
+                latencies = []
+                for i in xrange(options.lookups / 10):
+                    key = random.choice(keys)
+                    began = time.time()
+                    operation(key)
+                    latencies.append(time.time() - began)
+                latencies.sort()
+                print "%9d %6s %10.2f %10.2f %10.2f %10.2f" % (replicas, name, _percentile(latencies, 50),
+                                                             _percentile(latencies, 99),
+                                                             _percentile(latencies, 99.9),
+                                                             latencies[-1] * 1000.0)
+    finally:
+        sdht.configure_replication()
+        _reset_ring()
+        cluster.stop()
+
+def _size(mean, distribution):
+    """
+    Draw a size (of a key or a value).
+
+    @param mean: The mean size
+    @type mean: int
+
+    @param distribution: 'fixed', 'uniform' (1 to twice the mean) or
+    'exponential'
+    @type distribution: str
+
+    @rtype: int
+    """
+    if distribution == 'uniform':
+        return random.randint(1, max(1, 2 * mean - 1))
+    elif distribution == 'exponential':
+        return max(1, int(random.expovariate(1.0 / mean)))
+    return mean
+
+def _zipf(count, skew):
+    """
+    The cumulative weights of count ranks following Zipf's law, rank r
+    drawn in proportion to 1 / r ** skew (0 for no skew). Draw a rank
+    with bisect on a random number times the last weight.
+
+    @rtype: list
+    """
+    weights = []
+    total = 0.0
+    for rank in xrange(1, count + 1):
+        total += 1.0 / rank ** skew
+        weights.append(total)
+    return weights
+
+def _workload_client(options, keys, weights, start, results):
+    """
+    Send the requests of the workload benchmark from start until the
+    time is up and put the counts and latencies in the results queue.
+    Run in its own process, the ring is the one of the parent when it
+    forked (the storages forward what has moved since).
+    """
+    random.seed()
+    sdht.configure_pool(1)
+    values = 'x' * (4 * options.value_size + 1)
+    samples = []
+    errors = 0
+    while time.time() < start:
+        time.sleep(0.01)
+    deadline = start + options.duration
+    while True:
+        began = time.time()
+        if began >= deadline:
+            break
+        key = keys[bisect.bisect(weights, random.random() * weights[-1])]
+        read = random.random() < options.reads
+        try:
+            if read:
+                try:
+                    sdht.get(key)
+                except KeyError:
+                    pass
+            else:
+                sdht.set(key, values[:_size(options.value_size, options.sizes)])
+        except Exception:
+            errors += 1
+            continue
+        samples.append((began, read, time.time() - began))
+    results.put((errors, samples))
+
+def _latency_report(latencies):
+    """
+    @param latencies: Sorted latencies in seconds
+    @type latencies: list
+
+    @return: The count and percentiles (in milliseconds) of latencies
+    @rtype: dict
+    """
+    if not latencies:
+        return {'count': 0}
+    return {'count': len(latencies),
+            'p50': _percentile(latencies, 50),
+            'p99': _percentile(latencies, 99),
+            'p99.9': _percentile(latencies, 99.9),
+            'max': latencies[-1] * 1000.0}
+
+def _rebalance(options, cluster, start, moved):
+    """
+    Join or remove a storage while the workload runs, a third into it.
+
+    @param moved: Gets the records and bytes moved
+    @type moved: list
+
+    @return: When the rebalance began and ended
+    @rtype: tuple
+    """
+    def progress(source, target, records, size):
+        # The counts of a transfer add up, keep the last ones
+        moved[-1] = [records, size]
+    hand_over = sdht._hand_over
+    def counted(*args):
+        # Every range is a transfer of its own
+        moved.append([0, 0])
+        return hand_over(*args)
+
+    time.sleep(max(0, start + options.duration / 3.0 - time.time()))
+    began = time.time()
+    sdht._hand_over = counted
+    try:
+        if options.rebalance == 'join':
+            sdht.join(cluster.nodes[-1], progress)
+        else:
+            sdht.remove(cluster.nodes[0], progress)
+    finally:
+        sdht._hand_over = hand_over
+    return began, time.time()
+
+def _compare(results, earlier):
+    """
+    Print the changes from the results of an earlier run.
+    """
+    print
+    print "%-18s %12s %12s %8s" % ("compared to", "earlier", "now", "change")
+    rows = [('throughput', earlier.get('throughput'), results['throughput'])]
+    for operation in ('get', 'set'):
+        for name in ('p50', 'p99', 'p99.9'):
+            rows.append(('%s %s ms' % (operation, name),
+                         earlier.get('latency', {}).get(operation, {}).get(name),
+                         results['latency'][operation].get(name)))
+    for name, old, new in rows:
+        if old is None or new is None:
+            continue
+        change = old and "%+7.1f%%" % ((new - old) * 100.0 / old) or "%8s" % "-"
+        print "%-18s %12.2f %12.2f %s" % (name, old, new, change)
+
+def workload(options):
+    """
+    Load generator. Starts --storages storages (one more to join with
+    --rebalance join), writes --keys keys and runs --clients client
+    processes sending gets and sets of keys drawn with a Zipf skew for
+    --duration seconds, optionally joining or removing a storage a
+    third into the run. Prints the throughput, the latency percentiles
+    and what the rebalance took, and writes them as JSON with --json.
+    """
+    random.seed(options.seed)
+    cluster = _Cluster(shlex.split(options.storage_args))
+    try:
+        for i in xrange(options.storages + (options.rebalance == 'join' and 1 or 0)):
+            cluster.start()
+        sdht.configure_replication(options.replicas)
+        _reset_ring()
+        for node in cluster.nodes[:options.storages]:
+            sdht.join(node)
+
+        keys = []
+        for i in xrange(options.keys):
+            key = 'key%d-' % i
+            keys.append((key + 'k' * _size(options.key_size, options.sizes))[:max(len(key), options.key_size)])
+        random.shuffle(keys)
+        weights = _zipf(len(keys), options.zipf)
+        value = 'x' * options.value_size
+        for i in xrange(0, len(keys), 1000):
+            sdht.set_many([(key, value) for key in keys[i:i + 1000]])
+
+        results = multiprocessing.Queue()
+        start = time.time() + 1.0
+        clients = [multiprocessing.Process(target=_workload_client,
+                                           args=(options, keys, weights, start, results))
+                   for i in xrange(options.clients)]
+        for client in clients:
+            client.start()
+        moved = []
+        window = None
+        if options.rebalance != 'none':
+            window = _rebalance(options, cluster, start, moved)
+        answers = [results.get() for client in clients]
+        for client in clients:
+            client.join()
+    finally:
+        sdht.configure_replication()
+        _reset_ring()
+        cluster.stop()
+
+    samples = [sample for errors, client_samples in answers for sample in client_samples]
+    errors = sum([errors for errors, client_samples in answers])
+    report = {'benchmark': 'workload',
+              'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'host': {'platform': platform.platform(),
+                       'python': platform.python_version(),
+                       'cpus': multiprocessing.cpu_count()},
+              'options': dict([(name, getattr(options, name)) for name in
+                               ('storages', 'storage_args', 'replicas', 'clients', 'duration',
+                                'keys', 'key_size', 'value_size', 'sizes', 'zipf', 'reads',
+                                'rebalance', 'seed')]),
+              'operations': len(samples),
+              'errors': errors,
+              'throughput': len(samples) / options.duration,
+              'latency': {'get': _latency_report(sorted([latency for began, read, latency in samples if read])),
+                          'set': _latency_report(sorted([latency for began, read, latency in samples
+                                                         if not read]))}}
+    if window is not None:
+        during = sorted([latency for began, read, latency in samples if window[0] <= began < window[1]])
+        report['rebalance'] = {'action': options.rebalance,
+                               'seconds': window[1] - window[0],
+                               'records': sum([records for records, size in moved]),
+                               'bytes': sum([size for records, size in moved]),
+                               'latency': _latency_report(during)}
+
+    print "%d operations, %d errors, %.1f ops/s" % (report['operations'], errors, report['throughput'])
+    print "%6s %8s %10s %10s %10s %10s" % ("op", "count", "p50 ms", "p99 ms", "p99.9 ms", "max ms")
+    rows = [(operation, report['latency'][operation]) for operation in ('get', 'set')]
+    if window is not None:
+        rows.append((options.rebalance, report['rebalance']['latency']))
+    for name, latency in rows:
+        if latency['count']:
+            print "%6s %8d %10.2f %10.2f %10.2f %10.2f" % (name, latency['count'], latency['p50'],
+                                                        latency['p99'], latency['p99.9'], latency['max'])
+    if window is not None:
+        rebalance = report['rebalance']
+        print "%s took %.2f s and moved %d records (%d bytes)" % (options.rebalance, rebalance['seconds'],
+                                                               rebalance['records'], rebalance['bytes'])
+    if options.json:
+        with open(options.json, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    if options.compare:
+        with open(options.compare) as earlier:
+            _compare(report, json.load(earlier))
+
+def _disk_bytes(path):
+    """
+    Bytes taken on disk by the files of an engine (sparse files only
+    count the written parts).
+    """
+    total = 0
+    for directory, directories, files in os.walk(path):
+        for name in files:
+            total += os.stat(os.path.join(directory, name)).st_blocks * 512
+    return total
+
+def engines(options):
+    """
+    Storage engine benchmark. Runs the same workload on every engine,
+    in this process and without the HTTP layer: single puts, puts
+    overwriting every key in batches of 100, random gets, gets in
+    batches of 100 and a scan of the whole ring in key order. Prints
+    the operations per second of each step and the bytes the engine
+    took on disk at the end.
+    """
+    rand = random.Random(options.seed)
+    keys = [sdht._pack_key(sdht._hash('key%d' % i)) for i in xrange(options.keys)]
+    value = os.urandom(options.value_size)
+    reads = [rand.choice(keys) for i in xrange(options.keys)]
+    batches = [keys[i:i + 100] for i in xrange(0, len(keys), 100)]
+    read_batches = [reads[i:i + 100] for i in xrange(0, len(reads), 100)]
+
+    def scan(engine):
+        if len(list(engine.range())) != len(keys):
+            raise AssertionError("The scan missed records")
+
+    steps = [('put', len(keys), lambda engine: [engine.put(key, value) for key in keys]),
+             ('batch put', len(keys), lambda engine: [engine.write([(key, value) for key in batch], [])
+                                                      for batch in batches]),
+             ('get', len(reads), lambda engine: [engine.get(key) for key in reads]),
+             ('batch get', len(reads), lambda engine: [engine.get_many(batch) for batch in read_batches]),
+             ('scan', len(keys), scan)]
+
+    print "%8s %s %10s" % ("engine", ' '.join(["%12s" % name for name, count, step in steps]), "disk MB")
+    for name in options.engines.split(','):
+        directory = tempfile.mkdtemp(prefix='sdht-bench-')
+        try:
+            try:
+                engine = sdht_engines.open_engine(name, os.path.join(directory, 'records'))
+            except sdht_engines.EngineError, e:
+                print "%8s %s" % (name, e)
+                continue
+            rates = []
+            try:
+                for step, count, run in steps:
+                    began = time.time()
+                    run(engine)
+                    rates.append("%12.0f" % (count / (time.time() - began)))
+            finally:
+                engine.close()
+            print "%8s %s %10.1f" % (name, ' '.join(rates), _disk_bytes(directory) / 1048576.0)
+        finally:
+            shutil.rmtree(directory)
+
+def codecs(options):
+    """
+    Value codec benchmark. Encodes and decodes a small record, a large
+    text and a list of integers with every codec, with and without
+    compression, in this process. Prints the microseconds per encode
+    and decode and the bytes stored.
+    """
+    rand = random.Random(options.seed)
+    words = ['%x' % rand.getrandbits(16) for i in xrange(200)]
+    samples = [('record', {'name': 'key17', 'count': 17, 'tags': ['a', 'b'], 'score': 0.5}),
+               ('text', ' '.join([rand.choice(words) for i in xrange(5000)])),
+               ('integers', range(1000))]
+    setups = [('legacy', 'legacy', None),
+              ('pickle', 'pickle', None),
+              ('pickle+zlib', 'pickle', sdht.COMPRESS_BYTES),
+              ('marshal', 'marshal', None),
+              ('marshal+zlib', 'marshal', sdht.COMPRESS_BYTES),
+              ('raw', 'raw', None),
+              ('raw+zlib', 'raw', sdht.COMPRESS_BYTES)]
+    rounds = max(1, options.lookups / 10)
+
+    def timed(run, value):
+        began = time.time()
+        for i in xrange(rounds):
+            run(value)
+        return (time.time() - began) / rounds * 1000000
+
+    print "%8s %12s %10s %10s %10s" % ("value", "codec", "encode us", "decode us", "bytes")
+    try:
+        for sample, value in samples:
+            for name, codec, compress in setups:
+                sdht.configure_codec(codec, compress_bytes=compress)
+                try:
+                    data = sdht._encode(value)
+                except TypeError:
+                    continue
+                if sdht._decode(data) != value:
+                    raise AssertionError("The %s codec changed the value" % name)
+                print "%8s %12s %10.1f %10.1f %10d" % (sample, name, timed(sdht._encode, value),
+                                                       timed(sdht._decode, data), len(data))
+    finally:
+        sdht.configure_codec()
+
+def _diverge(node, keys, share, value):
+    """
+    Set a share of the keys on their replicas except one storage, as
+    if it was down while they were written.
+
+    @return: The keys changed
+    @rtype: list
+    """
+    changed = random.sample(keys, int(len(keys) * share))
+    address = sdht._format_address(node)
+    groups = {}
+    for key in changed:
+        hashed_key = sdht._hash(key)
+        for replica in sdht._replicas_of(hashed_key)[0]:
+            if sdht._format_address(replica) != address:
+                groups.setdefault(sdht._format_address(replica), (replica, []))[1].append(hashed_key)
+    data = sdht._encode(value)
+    for replica, hashed_keys in groups.values():
+        replica.set_many(hashed_keys, [data] * len(hashed_keys))
+    return changed
+
+def _copy_ranges(node, compare):
+    """
+    Copy the ranges a storage is a replica of from the other replicas,
+    like sdht.repair does.
+
+    @param compare: Compare the digests first (see sdht.Node.steal_range)
+    @type compare: bool
+
+    @return: The records and bytes sent and the seconds it took
+    @rtype: tuple
+    """
+    moved = []
+    def progress(source, target, records, size):
+        # The counts of a transfer add up, keep the last ones
+        moved[-1] = [records, size]
+    began = time.time()
+    for target, source, from_id, to_id in sdht._repair_moves(sdht._linked(node)[0]):
+        moved.append([0, 0])
+        target.steal_range(source, from_id, to_id, progress, True, compare=compare)
+    return (sum([records for records, size in moved]), sum([size for records, size in moved]),
+            time.time() - began)
+
+def repair(options):
+    """
+    Repair benchmark. Keeps every key on 2 of --storages local
+    storages, changes a share of the keys everywhere but on one
+    storage, as if it was down meanwhile, and copies them to it again:
+    the whole ranges it is a replica of, then only what differs once
+    the digests of the ranges are compared (see sdht.repair). Prints
+    the records and megabytes sent and the seconds it took.
+    """
+    value = 'x' * options.value_size
+    keys = ['key%d' % i for i in xrange(options.keys)]
+    cluster = _Cluster()
+    print "%8s %8s %10s %10s %10s" % ("changed", "copy", "records", "MB", "seconds")
+    try:
+        nodes = [cluster.start() for i in xrange(max(2, options.storages))]
+        sdht.configure_replication(2)
+        _reset_ring()
+        for node in nodes:
+            sdht.join(node)
+        for i in xrange(0, len(keys), 1000):
+            sdht.set_many([(key, value) for key in keys[i:i + 1000]])
+        run = 0
+        for share in (0.0, 0.01, 0.1):
+            for name, compare in (('whole', False), ('digests', True)):
+                run += 1
+                _diverge(nodes[-1], keys, share, '%s%d' % (value, run))
+                records, size, seconds = _copy_ranges(nodes[-1], compare)
+                print "%7.0f%% %8s %10d %10.1f %10.2f" % (share * 100, name, records,
+                                                          size / 1048576.0, seconds)
+    finally:
+        sdht.configure_replication()
+        _reset_ring()
+        cluster.stop()
+
+BENCHMARKS = {'routing': routing,
+              'load': load,
+              'protocol': protocol,
+              'distribution': distribution,
+              'replication': replication,
+              'workload': workload,
+              'engines': engines,
+              'codecs': codecs,
+              'repair': repair}
+
+def _get_args():
+    """
+    Parse launcher arguments and display help.
+    """
+    usage = 'usage: %%prog [options] %s' % '|'.join(sorted(BENCHMARKS))
+    desc = "Runs benchmarks for the sdht and its storages"
+
+    parser = OptionParser(usage = usage, description = desc)
+    parser.add_option('-n',
+                      dest='lookups',
+                      type='int',
+                      default=100000,
+                      help=("Number of lookups per ring size (routing), a tenth of them "
+                            "are timed per operation (replication) or are encodes and "
+                            "decodes per value (codecs)"))
+    parser.add_option('--nodes',
+                      dest='nodes',
+                      type='int',
+                      default=16,
+                      help=("Number of nodes in the ring (distribution)"))
+    parser.add_option('--storages',
+                      dest='storages',
+                      type='int',
+                      default=3,
+                      help=("Number of storages started (replication, workload, repair)"))
+    parser.add_option('--storage-args',
+                      dest='storage_args',
+                      default='',
+                      help=("Extra options for the storages, like '--threads 4' (workload)"))
+    parser.add_option('--replicas',
+                      dest='replicas',
+                      type='int',
+                      default=1,
+                      help=("Storages every key is kept on (workload)"))
+    parser.add_option('--key-size',
+                      dest='key_size',
+                      type='int',
+                      default=16,
+                      help=("Mean bytes per key (workload)"))
+    parser.add_option('--sizes',
+                      dest='sizes',
+                      default='fixed',
+                      choices=['fixed', 'uniform', 'exponential'],
+                      help=("Distribution of the key and value sizes around their mean: "
+                            "fixed, uniform or exponential (workload)"))
+    parser.add_option('--zipf',
+                      dest='zipf',
+                      type='float',
+                      default=0.0,
+                      help=("Skew of the keys drawn, 0 for uniform and about 1 for a few "
+                            "hot keys (workload)"))
+    parser.add_option('--rebalance',
+                      dest='rebalance',
+                      default='none',
+                      choices=['none', 'join', 'remove'],
+                      help=("Join or remove a storage during the run: none, join or remove (workload)"))
+    parser.add_option('--engines',
+                      dest='engines',
+                      default=','.join(sorted(sdht_engines.ENGINES)),
+                      help=("Comma separated storage engines to compare (engines)"))
+    parser.add_option('--seed',
+                      dest='seed',
+                      type='int',
+                      default=None,
+                      help=("Seed for the keys and their sizes (workload, engines)"))
+    parser.add_option('--json',
+                      dest='json',
+                      default=None,
+                      help=("Write the results to this file as JSON (workload)"))
+    parser.add_option('--compare',
+                      dest='compare',
+                      default=None,
+                      help=("Compare the results with an earlier JSON file (workload)"))
+    parser.add_option('-w',
+                      dest='workers',
+                      type='int',
+                      default=multiprocessing.cpu_count(),
+                      help=("Threads and worker processes of the storage (load)"))
+    parser.add_option('-c',
+                      dest='clients',
+                      type='int',
+                      default=2 * multiprocessing.cpu_count(),
+                      help=("Client processes sending requests (load, workload)"))
+    parser.add_option('-d',
+                      dest='duration',
+                      type='float',
+                      default=10.0,
+                      help=("Seconds to run each storage mode (load) or the workload (workload)"))
+    parser.add_option('--keys',
+                      dest='keys',
+                      type='int',
+                      default=10000,
+                      help=("Number of keys read and written (load, protocol, replication, workload, engines, "
+                            "repair)"))
+    parser.add_option('--value-size',
+                      dest='value_size',
+                      type='int',
+                      default=100,
+                      help=("Mean bytes per value (load, protocol, replication, workload, engines, repair)"))
+    parser.add_option('--reads',
+                      dest='reads',
+                      type='float',
+                      default=0.9,
+                      help=("Share of the requests that are gets (load, workload)"))
+
+    (options, args) = parser.parse_args()
+    if len(args) != 1 or args[0] not in BENCHMARKS:
+        parser.error("Choose one benchmark: %s" % ', '.join(sorted(BENCHMARKS)))
+    return options, args[0]
+
+def main():
+    """
+    Runs the choosen benchmark.
+    """
+    options, name = _get_args()
+    BENCHMARKS[name](options)
+
+if __name__ == "__main__":
+    main()
@@ -4,10 +4,12 @@
 """
 The Simplified distributable hash table.
 
-This implementation should be improved to include the proper finger
-table and such in due time. But for a simple proof of concept and
-distributable storage where data is keept intact it works at the
-moment. Probably needs improvements in the backend and frontend. Most
+Every node keeps a Chord-style finger table so a client that only
+knows a single storage can route a key to its owner in O(log n) hops
+(see route). A client that has the whole ring joined locally skips the
+hops and searches its sorted ring index directly. For a simple proof
+of concept and distributable storage where data is keept intact it
+works at the moment. Probably needs improvements in the backend and frontend. Most
 things are keept as KISS (tm) as possible :)
 
 The main function includes a smaller test that can be run. No
@@ -15,406 +17,4467 @@ unit-tests where included at this time (will appear soon).
 
 """
 
-import sha, random, pickle
-import urllib, urllib2
+import sha, random, pickle, cPickle, marshal, zlib, bisect, struct, os, json
+import urllib, httplib, socket, threading, time, Queue, sys
+from collections import deque
 
 # The maximum hash value is 2**MAXIMUM_BIT
 MAXIMUM_BIT = 160
 
+# Number of bytes in a packed hash (see _pack_key)
+KEY_BYTES = MAXIMUM_BIT / 8
+
+# Content type of a request body with packed records (see
+# _pack_records), used when storages hand over data to each other.
+RECORDS_TYPE = 'application/x-sdht-records'
+
+# Content type of a request body with binary frames (see
+# _pack_frames). The data commands are sent as frames instead of forms
+# to storages that support them (see Node.check).
+FRAME_TYPE = 'application/x-sdht-frames'
+
+# Content type of a snapshot (see Node.snapshot), posted to a storage
+# to load it (see Node.load)
+SNAPSHOT_TYPE = 'application/x-sdht-snapshot'
+
+# Length written instead of the length of the value for a key that is
+# deleted (see _pack_records), in the changes of a snapshot or a
+# transfer.
+DELETED_LENGTH = 0xffffffff
+
+# Commands of the request frames
+FRAME_GET = 1
+FRAME_SET = 2
+FRAME_DELETE = 3
+
+# Status of the answer frames
+FRAME_OK = 0
+FRAME_MISSING = 1
+
+# Names of the frame commands (as counted by the storages)
+FRAME_COMMANDS = {FRAME_GET: 'frame_get',
+                  FRAME_SET: 'frame_set',
+                  FRAME_DELETE: 'frame_delete'}
+
+# A request frame is the command, the packed key and the length of the
+# value (followed by the value), an answer frame the status and the
+# length of the value (followed by the value).
+_FRAME = struct.Struct('!B%dsI' % KEY_BYTES)
+_ANSWER = struct.Struct('!BI')
+
+# A snapshot is a sequence of blocks, each its kind and the length of
+# its data (followed by the data): a header ('H'), compressed packed
+# records ('R') and an end ('E'). The header and the end are JSON.
+_BLOCK = struct.Struct('!cI')
+
+# Idle keep-alive connections kept per storage and the seconds they
+# may stay idle before they are closed. Keep the timeout below the
+# KEEP_ALIVE_TIMEOUT of the storages.
+POOL_SIZE = 4
+POOL_IDLE_TIMEOUT = 15.0
+
+# Seconds to wait for a storage to accept a connection and for each
+# read (or write) of a request to it, so a hung storage can't block
+# a client for ever (see configure_pool)
+CONNECT_TIMEOUT = 2.0
+READ_TIMEOUT = 30.0
+
+# Failed requests in a row after which the requests to a storage fail
+# at once, and the seconds before one request is let through again to
+# see if it is back (see CircuitBreaker)
+BREAKER_FAILURES = 3
+BREAKER_RESET = 5.0
+
+# Seconds between the checks of every storage of the ring by the
+# health prober (see enable_prober)
+PROBE_INTERVAL = 2.0
+
+# Positions every storage (of weight 1) gets in the ring, see
+# Node.positions. Keep it at 1 for rings joined by older versions of
+# the sdht, a storage's first position is the one it always had.
+VIRTUAL_NODES = 1
+
+# Response header a storage sends the epoch of the ring membership it
+# has in (see membership)
+EPOCH_HEADER = 'X-Sdht-Epoch'
+
+# How values are encoded (see configure_codec). 'legacy' is the
+# protocol 0 pickle older versions of the sdht read, keep it until
+# every client of a ring knows the codecs.
+CODEC = 'legacy'
+
+# Encoded values of at least this many bytes are compressed with zlib
+# at this level, unless that doesn't make them smaller (see
+# configure_codec)
+COMPRESS_BYTES = 4096
+COMPRESS_LEVEL = 1
+
+# Bit of the header byte of an encoded value telling it is compressed,
+# the other bits are the ident of its codec (see Codec)
+COMPRESSED = 0x10
+
+# Ident in the header byte of a manifest, the record kept under the key
+# of a value stored in chunks (see _manifest). No codec has it.
+MANIFEST = 0x0f
+
+# Values set of more than CHUNK_THRESHOLD encoded bytes are stored in
+# chunks of CHUNK_BYTES (None to never split them, older versions of
+# the sdht can't read chunked values), CHUNK_FETCHES of the chunks are
+# read or written at the same time (see configure_chunks). Streams
+# (see set_stream) are always stored in chunks.
+CHUNK_THRESHOLD = None
+CHUNK_BYTES = 1024 * 1024
+CHUNK_FETCHES = 4
+
+# Default bound (bytes of serialized values) and seconds to live of the
+# entries of the read cache (see enable_cache)
+CACHE_BYTES = 16 * 1024 * 1024
+CACHE_TTL = 60.0
+
+# Seconds the Bloom filter of a storage is used before it is asked
+# again whether it has changed (see enable_bloom_filters)
+BLOOM_TTL = 1.0
+
+# The two 64 bit hashes of a Bloom filter position are the first 16
+# bytes of a packed key (see _bloom_positions)
+_BLOOM_HASHES = struct.Struct('!QQ')
+
+# Storages every key is kept on, the storage owning it and the ones
+# after it in the ring (see configure_replication). Keep it at 1 for
+# rings written by older versions of the sdht.
+REPLICAS = 1
+
+# Percentile of the latencies of a storage after which a read is also
+# sent to the next replica (see configure_replication), the latencies
+# kept per storage to find it and how many are needed before reads
+# are hedged at all.
+HEDGE_PERCENTILE = 95.0
+LATENCY_SAMPLES = 100
+HEDGE_MIN_SAMPLES = 20
+
+# Seconds a failed request counts as in the average latency of a
+# storage, so reads move to the other replicas.
+FAILURE_PENALTY = 1.0
+
+# Threads sending the requests when several replicas are asked at once
+REPLICA_THREADS = 16
+
 class NodeError(Exception):
     """
     Our own little exception that tells us if a Node is ok or not.
     """
     pass
 
-class Node():
+class _Missing(object):
     """
-    The class representation of a node in the sdht.
+    The marker the batch functions use for keys without a value.
     """
-    
-    def __init__(self, ip, port):
+    def __repr__(self):
+        return 'sdht.MISSING'
+
+MISSING = _Missing()
+
+class ConnectionPool(object):
+    """
+    Persistent HTTP/1.1 connections to the storages, shared by every
+    Node with the same address.
+
+    A connection is taken from the pool for one request and put back
+    when the response has been read. At most size idle connections are
+    kept per storage and connections idle for longer then idle_timeout
+    are closed instead of reused. If a reused connection fails (the
+    storage closed it or was restarted) the request is sent once more
+    on a fresh connection.
+
+    Requests to a storage whose circuit breaker is open fail at once
+    (see CircuitBreaker).
+    """
+
+    def __init__(self, size=POOL_SIZE, idle_timeout=POOL_IDLE_TIMEOUT,
+                 connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT):
         """
-        Set the normal value of this Node and also hash out the key_id
+        @param size: Idle connections kept per storage
+        @type size: int
 
-        @param ip: IP number of the node
-        @type ip: str
+        @param idle_timeout: Seconds before an idle connection is closed
+        @type idle_timeout: float
 
-        @param port: port number of the node
-        @type port: str
+        @param connect_timeout: Seconds to wait for a connection
+        @type connect_timeout: float
+
+        @param read_timeout: Seconds to wait for each read of a response
+        @type read_timeout: float
         """
-        self.next = None
-        self.ip = ip
-        self.port = port
-        self.key_id = long(sha.new("%s:%s" % (ip, port)).hexdigest(), 16)
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._idle = {}
+        self._lock = threading.Lock()
 
-    def transfer(self, other_node):
+    def _acquire(self, address):
         """
-        Transfer all hashed keys from this node to another one
+        Get an idle connection to a storage or a new one.
 
-        @param other_node: Other node that this node should transfer
-        its content to
-        @type other_node: Node
+        @return: The connection and a flag telling if it was reused
+        @rtype: tuple
+        """
+        now = time.time()
+        with self._lock:
+            idle = self._idle.get(address, [])
+            while idle:
+                connection, used = idle.pop()
+                if now - used < self.idle_timeout:
+                    return connection, True
+                connection.close()
+        connection = httplib.HTTPConnection(address[0], address[1], timeout=self.connect_timeout)
+        connection.connect()
+        connection.sock.settimeout(self.read_timeout)
+        return connection, False
 
-        @return: If the transfer was ok we return True or False if not
-        @rtype: bool
+    def _release(self, address, connection):
         """
-        url = 'http://%s:%s' % (self.ip, self.port)
-        values = {'cmd' : 'transfer',
-                  'other_node_ip': other_node.ip,
-                  'other_node_port': other_node.port}
-        
-        data = urllib.urlencode(values)
-        req = urllib2.Request(url, data)
-        response = urllib2.urlopen(req)
-        
-        result = response.read()
-        return result and result != 'NO DATA'
+        Put a connection back in the pool (or close it if the pool is
+        full).
+        """
+        with self._lock:
+            idle = self._idle.setdefault(address, [])
+            if len(idle) < self.size:
+                idle.append((connection, time.time()))
+                return
+        connection.close()
 
-    def steal_range(self, other_node, from_id, to_id):
+    def clear(self, address=None):
         """
-        Steal all hashed keys from another node to this node
-        (depending on their key_id).
-        
-        The node steals from other_node but the data passed is
-        actually to the node that is being stolen from to send its
-        data to this node. Confused?
+        Close the idle connections to one storage or to all of them.
 
-        @param other_node: Other node that this node should transfer
-        its content to
-        @type other_node: Node
+        @param address: (ip, port) of a storage or None for all
+        @type address: tuple
+        """
+        with self._lock:
+            if address is None:
+                addresses = self._idle.keys()
+            else:
+                addresses = [address]
+            for key in addresses:
+                for connection, used in self._idle.pop(key, []):
+                    connection.close()
 
-        @param from_id: starting hash-id to transfer
-        @type from_id: long
+    def _send(self, address, data, content_type):
+        """
+        Send a post to a storage and wait for the response headers,
+        unless the circuit breaker of the storage is open.
 
-        @param to_id: ending hash-id to transfer
-        @type to_id: long
+        @return: The connection and the response
+        @rtype: tuple
+        """
+        breaker = _breaker('%s:%s' % address)
+        if not breaker.allow():
+            raise NodeError("Storage %s:%s is down" % address)
+        try:
+            connection, response = self._exchange(address, data, content_type)
+        except (httplib.HTTPException, socket.error):
+            breaker.failed()
+            raise
+        except NodeError:
+            # The storage did answer
+            breaker.succeeded()
+            raise
+        breaker.succeeded()
+        return connection, response
 
-        @return: If the transfer was ok we return True or False if not
-        @rtype: bool
+    def _exchange(self, address, data, content_type):
         """
-        url = 'http://%s:%s' % (other_node.ip, other_node.port)
-        values = {'cmd' : 'transfer_part',
-                  'from_key_id': from_id,
-                  'to_key_id': to_id,
-                  'other_node_ip': self.ip,
-                  'other_node_port': self.port}
-        
-        data = urllib.urlencode(values)
-        req = urllib2.Request(url, data)
-        response = urllib2.urlopen(req)
-        
-        result = response.read()
-        return result and result != 'NO DATA'
+        Send a post to a storage and wait for the response headers.
 
-    def check(self):
+        @return: The connection and the response
+        @rtype: tuple
         """
-        Check if a node is ok and up and running
+        connection, reused = self._acquire(address)
+        try:
+            connection.request('POST', '/', data, {'Content-Type': content_type})
+            response = connection.getresponse()
+        except (httplib.HTTPException, socket.error), error:
+            connection.close()
+            if not reused or not self._unanswered(error):
+                raise
+            # The other idle connections are probably just as stale
+            self.clear(address)
+            if hasattr(data, 'seek'):
+                # A file posted (see Node.load) is sent again
+                data.seek(0)
+            return self._exchange(address, data, content_type)
 
-        @return: If the node responded ok we return True otherwise False
-        @rtype: bool
+        if response.status != 200:
+            connection.close()
+            raise NodeError("Storage %s:%s answered '%s %s'" % (address[0], address[1], response.status, response.reason))
+        epoch = response.getheader(EPOCH_HEADER)
+        if epoch:
+            _saw_epoch(int(epoch), address)
+        return connection, response
+
+    def _unanswered(self, error):
         """
-        url = 'http://%s:%s' % (self.ip, self.port)
-        values = {'cmd' : 'check'}
-        
-        data = urllib.urlencode(values)
-        req = urllib2.Request(url, data)
-        response = urllib2.urlopen(req)
-        
-        result = response.read()
-        return result and result == 'OK'
-    
-    def __setitem__(self, key, value):
+        Tell if a post failed before the storage answered anything, as
+        when it had closed an idle connection. After a timeout or a
+        partly read answer the storage may have executed the post, it
+        isn't sent again (incr and append would be applied twice).
+
+        @return: True if the post can be sent again
+        @rtype: bool
         """
-        Set an item in the storage
-        
-        @param key: Hashed key to set
-        @type key: long
+        if isinstance(error, socket.timeout):
+            return False
+        if isinstance(error, httplib.BadStatusLine):
+            # Nothing at all was read (the message differs between
+            # python versions)
+            return error.line in ("''", '""') or error.line.startswith('No status line')
+        return isinstance(error, (socket.error, httplib.CannotSendRequest))
 
-        @param key: Hashed key to set
-        @type key: long
+    def _finish(self, address, connection, response):
+        """
+        Put the connection of a completely read response back in the
+        pool unless the storage is closing it.
+        """
+        if response.will_close:
+            connection.close()
+        else:
+            self._release(address, connection)
 
-        @param key: Serialized data to set
-        @type key: str
+    def post(self, ip, port, data, content_type='application/x-www-form-urlencoded'):
         """
-        url = 'http://%s:%s' % (self.ip, self.port)
-        values = {'cmd' : 'set',
-                  'key' : '%s' % key,
-                  'value' : '%s' % value }
+        Post data to a storage and read the whole response.
 
-        data = urllib.urlencode(values)
-        req = urllib2.Request(url, data)
-        response = urllib2.urlopen(req)
-        
-        if response.read() != "OK":
-            raise ValueError ("Could not set value in storage")
+        @param ip: IP number of the storage
+        @type ip: str
 
-    def __getitem__(self, key):
+        @param port: port number of the storage
+        @type port: str
+
+        @param data: The request body
+        @type data: str
+
+        @return: The response body
+        @rtype: str
         """
-        Get an item from the storage
+        address = (ip, int(port))
+        connection, response = self._send(address, data, content_type)
+        try:
+            result = response.read()
+        except (httplib.HTTPException, socket.error):
+            connection.close()
+            raise
+        self._finish(address, connection, response)
+        return result
 
-        @param key: Hashed key to set
-        @type key: long
+    def lines(self, ip, port, data, content_type='application/x-www-form-urlencoded'):
         """
-        url = 'http://%s:%s' % (self.ip, self.port)
-        values = {'cmd' : 'get',
-                  'key' : '%s' % key }
+        Post data to a storage and read the response line by line as
+        the storage writes it (used for the progress of transfers).
 
-        data = urllib.urlencode(values)
-        req = urllib2.Request(url, data)
-        response = urllib2.urlopen(req)
-        result = response.read()
-        if result and result != 'NO DATA':
-            return result
-        
-        elif not result:
-            raise NodeError("Node isn't responding (has it gone down?)")
-        else:
-            raise KeyError(key)
+        @param ip: IP number of the storage
+        @type ip: str
 
-    def __repr__(self):
+        @param port: port number of the storage
+        @type port: str
+
+        @param data: The request body
+        @type data: str
+
+        @return: The lines of the response (without newlines)
+        @rtype: iterator
         """
-        Makes it simple to print out a Node.
+        address = (ip, int(port))
+        connection, response = self._send(address, data, content_type)
+        try:
+            if response.length is not None:
+                # Not streamed (the storage knew the length up front)
+                for line in response.read().splitlines():
+                    yield line
+            else:
+                line = response.fp.readline()
+                while line:
+                    yield line.rstrip('\n')
+                    line = response.fp.readline()
+        finally:
+            connection.close()
+
+    def blocks(self, ip, port, data):
         """
-        return "<Node '%s', port '%s'>" % (self.key_id, self.port)
+        Post data to a storage and read the response as the blocks of
+        a snapshot (see _read_blocks) as the storage writes them.
 
-# This is a clockwise ring distance function.
-#
-def distance(a, b):
+        @return: Tuples of the kind and the data of each block
+        @rtype: iterator
+        """
+        address = (ip, int(port))
+        connection, response = self._send(address, data, 'application/x-www-form-urlencoded')
+        try:
+            for block in _read_blocks(response):
+                yield block
+        finally:
+            connection.close()
+
+_pool = ConnectionPool()
+
+class ReadCache(object):
     """
-    Lets determine the distance between two hashes.
+    Least recently used cache of deserialized values, so a get of a
+    popular key neither hashes the key nor asks a storage.
 
-    If the same hash value the result is 0
+    The cache is bounded by the size of the serialized values (about
+    what the values take in memory) and every entry expires ttl
+    seconds after it was cached. The values are shared with the
+    callers, who shouldn't change them.
+    """
 
-    If a has a hash value less then b then return b - a (a positive value)
+    def __init__(self, max_bytes=CACHE_BYTES, ttl=CACHE_TTL):
+        """
+        @param max_bytes: Bytes of serialized values to keep at most
+        @type max_bytes: int
 
-    Else get the current maximum-hash and add it to b - a (we have
-    passed by the last element and we want to get the distance above
-    it).
-    
-    @param a: A hashed value to compare
-    @type a: long
+        @param ttl: Seconds an entry is used (None for no limit)
+        @type ttl: float
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = self.misses = self.evictions = 0
+        self.size = 0
+        # key -> [previous, next, key, hashed key, value, size, expires],
+        # linked from the least to the most recently used
+        self._entries = {}
+        self._head = [None, None]
+        self._head[0] = self._head[1] = self._head
+        self._lock = threading.Lock()
 
-    @param b: A hashed value to compare
-    @type b: long
+    def get(self, key):
+        """
+        @param key: A key (not hashed)
+        @type key: str
 
-    @return: The probable distance between current nodes or the current nodes distance + the maximum hash
-    @rtype: long
-    
-    """
-    if a == b:
-        return 0
-    elif a < b:
-        return b - a
-    else:
-        # If the next key has a id higher then the current hash. This
-        # distance has to be higher then previous unless it is the
-        # only node. Here the distance is maximum hash + the distance
-        # between the next nodes
-        #
-        return _node_list[len(_node_list)-1].key_id + (b - a)
+        @return: The cached value or MISSING
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[6] is not None and entry[6] < time.time():
+                self._remove(entry)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return MISSING
+            self.hits += 1
+            # Most recently used now
+            self._unlink(entry)
+            self._append(entry)
+            return entry[4]
 
-    # This is more correct version where the maximum
-    # return (2**MAXIMUM_BIT) + (b-a) # This is the proper DHT way
+    def put(self, key, hashed_key, value, size):
+        """
+        Cache a value, evicting the least recently used entries to
+        make room for it.
 
+        @param key: A key (not hashed)
+        @type key: str
 
-def find_node(start, key):
-    """
-    From the start node, find the node responsible for the target key
+        @param hashed_key: The hashed key (see drop_range)
+        @type hashed_key: long
 
-    We will keep wandering the nodes until we find a suitable sport
-    for our hashed key to be stored.
+        @param value: The deserialized value
 
-    If there is _node_list with more then one element and the distance
-    between current node and key is bigger then the distance between
-    the next-node and key go to the next node
-    
-    @param start: A starting node that we check if it is the correct
-    node for this hashed key
-    @type start: Node
+        @param size: Length of the serialized value
+        @type size: int
+        """
+        if size > self.max_bytes:
+            return
+        expires = self.ttl is not None and time.time() + self.ttl or None
+        with self._lock:
+            if key in self._entries:
+                self._remove(self._entries[key])
+            while self.size + size > self.max_bytes:
+                self._remove(self._head[1])
+                self.evictions += 1
+            entry = [None, None, key, hashed_key, value, size, expires]
+            self._entries[key] = entry
+            self._append(entry)
+            self.size += size
 
-    @param key: A hashed key that we want to find the correct node for
-    @type key: long
+    def invalidate(self, keys):
+        """
+        Drop the entries of keys (that have been written).
 
-    @return the node for where this key belongs to
-    @rtype: Node
-    """
-    current = start
-    
-    while len(_node_list) > 1 and distance(current.key_id, key) > distance(current.next.key_id, key):
-        current = current.next
-    return current
+        @param keys: Keys (not hashed)
+        @type keys: list
+        """
+        with self._lock:
+            for key in keys:
+                if key in self._entries:
+                    self._remove(self._entries[key])
 
-def _lookup(start, key):
-    """
-    Find the responsible node and get the value for the key
+    def drop_range(self, from_id, to_id):
+        """
+        Drop the entries with a hashed key from from_id up to (but not
+        including) to_id going clockwise around the ring (everything
+        if they are the same).
 
-    @param start: A starting node that we check if it is the correct
-    node for this hashed key
-    @type start: Node
+        @type from_id: long
+        @type to_id: long
+        """
+        with self._lock:
+            for entry in self._entries.values():
+                if from_id == to_id or distance(from_id, entry[3]) < distance(from_id, to_id):
+                    self._remove(entry)
 
-    @param key: A hashed key that we want to get the value for
-    @type key: long
+    def clear(self):
+        """
+        Drop every entry.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._head[0] = self._head[1] = self._head
+            self.size = 0
 
-    @return: The value in a node
-    @return: str
-    """
-    node = find_node(start, key)
-    return node[key]
+    def stats(self):
+        """
+        @return: The hits, misses and evictions so far and the number
+        of entries and bytes cached now
+        @rtype: dict
+        """
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'entries': len(self._entries),
+                    'bytes': self.size}
 
-def _store(start, key, value):
-    """
-    Find the responsible node and store the value with the key
+    def _append(self, entry):
+        last = self._head[0]
+        entry[0], entry[1] = last, self._head
+        last[1] = self._head[0] = entry
 
-    @param start: A starting node that we check if it is the correct
-    node for this hashed key
-    @type start: Node
+    def _unlink(self, entry):
+        entry[0][1], entry[1][0] = entry[1], entry[0]
 
-    @param key: A hashed key that we want to set the value for
-    @type key: long
+    def _remove(self, entry):
+        self._unlink(entry)
+        del self._entries[entry[2]]
+        self.size -= entry[5]
 
-    @param key: A serialized value we want to set in a storage
-    @type key: str
+# The read cache used by get and get_many (None until enable_cache)
+_cache = None
 
+def enable_cache(max_bytes=CACHE_BYTES, ttl=CACHE_TTL):
     """
-    node = find_node(start, key)
-    node[key] = value
+    Cache the values got with get and get_many (see ReadCache). Values
+    set or deleted through this module are dropped from the cache and
+    so are the values of ranges moved by join and remove. Writes made
+    by other clients are only seen when the entries expire.
 
+    @param max_bytes: Bytes of serialized values to keep at most
+    @type max_bytes: int
 
-# Instead of using a previous pointer a _node_list is used to assisst
-# for this purpose. Useally these shouldn't mixed up but the next
-# pointer simplifies the lookup algorithm while the _node_list assists
-# with the joining and removing of nodes. Maybe this should be
-# re-written for clarity, but I didn't have any trouble reading the
-# code still.
-#
-_node_list = []
-
-def remove (node):
+    @param ttl: Seconds an entry is used (None for no limit)
+    @type ttl: float
     """
-    Remove a node from the ring.
+    global _cache
+    _cache = ReadCache(max_bytes, ttl)
 
-    Please note that is a more official version of de-registration of
-    a node which makes sure that now values is lost from the ring by
-    transfering any removed data to other nodes when one node is
-    removed (unless it is the last node that is).
+def disable_cache():
+    """
+    Stop caching values (and drop the cached ones).
+    """
+    global _cache
+    _cache = None
 
-    @param start: A node we want to remove from the ring
-    @type start: Node
+def cache_stats():
     """
-    if len(_node_list) > 2:
-        index = _node_list.index(node)
-        if index > 0:
-            # Not first element
-            _node_list[index-1].next = node.next
-            # Transfer data to previous node
-            node.transfer(_node_list[index-1])
-        else:
-            # Is first element
-            _node_list[len(_node_list)-1].next = node.next
-            # Transfer data to new first node
-            node.transfer(node.next)
-        _node_list.remove(node)
-        
-    elif len(_node_list) == 2:
-        _node_list.remove(node)
-        _node_list[0].next = None
-        node.transfer(_node_list[0])
-        
-    else:
-        _node_list.remove(node)
-        # No where transfer the data.
-        
-def join(node):
+    @return: The counters of the read cache (see ReadCache.stats) or
+    None if it isn't enabled
+    @rtype: dict
     """
-    Add a node to the node-ring.
-    
-    Useally nodes are added at the start but if a node is added at a
-    latter state hashes keys and values might need to be moved around
-    a bit. See the following example for how this works.
-    
-    Example of how hashes get stolen:
-    
-    How the recalculations are done.
-    node 1 > 2 3 4 5 6 7
-    node 8 > 8 9 10
-    
-    Get all values from node 1 that are useful to new node 4 and remove them from node 1
-    
-    node 1 > 2 3 
-    node 4 > 4 5 6 7
-    node 8 > 8 9 10
-    
-    @param start: A node we want to add to the ring
-    @type start: Node
+    if _cache is None:
+        return None
+    return _cache.stats()
 
+def _bloom_positions(key, bits, hashes):
     """
-    if not node.check():
-        raise NodeError ("Node '%s' isn't responding" % node)
+    The bits of a key in a Bloom filter. The key is a hash already, so
+    its bytes are the two hashes the positions are made from (double
+    hashing).
 
-    if len(_node_list) == 0:
-        # Insert first
-        _node_list.append(node)
-        
-    elif len(_node_list) == 1:
-        first = _node_list[0]
-        if node.key_id < first.key_id:
-            # Insert first
-            _node_list.insert(0, node)
-            first.next = node
-            node.next = first
-            # Steal hash:es from the "last" node to the new first node
-            node.steal_range(first, node.key_id, first.key_id)
-        else:
-            # Insert last
-            _node_list.append(node)
-            node.next = first
-            first.next = node
-            # Steal hash:es from the previous node to the new node (to
-            # the maximum amount)
-            node.steal_range(first, first.key_id, 2**MAXIMUM_BIT)
-            
+    @param key: A packed key
+    @type key: str
+
+    @param bits: The bits of the filter
+    @type bits: int
+
+    @param hashes: The number of positions
+    @type hashes: int
+
+    @rtype: list
+    """
+    first, second = _BLOOM_HASHES.unpack_from(key)
+    second |= 1
+    return [(first + i * second) % bits for i in xrange(hashes)]
+
+class BloomFilters(object):
+    """
+    The Bloom filters of the keys the storages have (see Node.bloom),
+    so a get of a key without a value can be answered without asking a
+    storage. A filter never misses a key its storage has, a key is
+    missing for sure if the filter of every replica doesn't have it.
+
+    A filter is used for ttl seconds, then the storage is asked again
+    and only sends it if it has changed, usually just the positions set
+    since. The keys this client writes are added to its filters right
+    away, but a key set by another client may be found missing until
+    the filter is refreshed.
+    """
+
+    def __init__(self, ttl=BLOOM_TTL):
+        """
+        @param ttl: Seconds a filter is used before it is refreshed
+        @type ttl: float
+        """
+        self.ttl = ttl
+        self.checked = self.avoided = self.false_positives = self.refreshes = 0
+        # address -> [version, bits, hashes, data, refreshed]
+        self._filters = {}
+        # Addresses of the storages without a filter and of those a
+        # filter is being fetched from (see stale) -> True
+        self._without = {}
+        self._fetching = {}
+        # (time, address, key) written by this client the last ttl
+        # seconds, added again to a filter fetched meanwhile
+        self._written = deque()
+        self._lock = threading.Lock()
+
+    def missing(self, nodes, key, fetch=True):
+        """
+        Check a key in the filters of its replicas.
+
+        @param nodes: The replicas of the key
+        @type nodes: list
+
+        @param key: A packed key
+        @type key: str
+
+        @param fetch: Fetch the filters that need refreshing, else
+        they aren't used
+        @type fetch: bool
+
+        @return: True if the key is missing for sure, False if it may
+        have a value and None if there is no filter to tell
+        @rtype: bool
+        """
+        found = [self._filter(node, fetch) for node in nodes]
+        if None in found:
+            return None
+        with self._lock:
+            self.checked += 1
+            for version, bits, hashes, data, refreshed in found:
+                for position in _bloom_positions(key, bits, hashes):
+                    if not data[position >> 3] & (1 << (position & 7)):
+                        break
+                else:
+                    return False
+            self.avoided += 1
+        return True
+
+    def false_positive(self):
+        """
+        Count a key the filters had that turned out to be missing.
+        """
+        with self._lock:
+            self.false_positives += 1
+
+    def wrote(self, nodes, keys):
+        """
+        Add keys this client has written to the filters of the nodes.
+
+        @param keys: Packed keys
+        @type keys: list
+        """
+        now = time.time()
+        with self._lock:
+            for node in nodes:
+                address = _format_address(node)
+                entry = self._filters.get(address)
+                for key in keys:
+                    self._written.append((now, address, key))
+                    if entry is not None:
+                        self._add(entry, key)
+            while self._written and self._written[0][0] < now - self.ttl:
+                self._written.popleft()
+
+    def clear(self):
+        """
+        Drop every filter (the ring has changed).
+        """
+        with self._lock:
+            self._filters.clear()
+            self._without.clear()
+            self._fetching.clear()
+
+    def stats(self):
+        """
+        @return: The keys checked, the round trips avoided (keys found
+        missing), the false positives (keys the filters had that were
+        missing) and their rate among the missing keys, the refreshes
+        of the filters and the bytes of the filters kept
+        @rtype: dict
+        """
+        with self._lock:
+            missing = self.avoided + self.false_positives
+            return {'checked': self.checked,
+                    'avoided': self.avoided,
+                    'false_positives': self.false_positives,
+                    'false_positive_rate': missing and float(self.false_positives) / missing or 0.0,
+                    'refreshes': self.refreshes,
+                    'filters': len(self._filters),
+                    'bytes': sum([len(entry[3]) for entry in self._filters.values()])}
+
+    def stale(self, nodes):
+        """
+        Find the filters that need refreshing and aren't being fetched
+        already, for a client fetching them itself (see
+        sdht_async._bloom_missing). They count as being fetched until
+        refreshed, without or failed is called.
+
+        @return: The nodes and the versions of their filters (None if
+        there is no filter yet)
+        @rtype: list
+        """
+        stale = []
+        now = time.time()
+        with self._lock:
+            for node in nodes:
+                address = _format_address(node)
+                entry = self._filters.get(address)
+                if (address in self._without or address in self._fetching or
+                    entry is not None and entry[4] + self.ttl > now):
+                    continue
+                self._fetching[address] = True
+                stale.append((node, entry and entry[0]))
+        return stale
+
+    def refreshed(self, node, fetched, began):
+        """
+        Keep a filter fetched from a storage (see Node.bloom).
+
+        @param fetched: What Node.bloom returned
+        @type fetched: tuple
+
+        @param began: When the filter was asked for
+        @type began: float
+
+        @return: The filter
+        @rtype: list
+        """
+        address = _format_address(node)
+        with self._lock:
+            self._fetching.pop(address, None)
+            self.refreshes += 1
+            entry = self._filters.get(address)
+            if fetched is None:
+                # Unchanged (unless the filters were cleared meanwhile)
+                if entry is not None:
+                    entry[4] = time.time()
+                return entry
+            version, bits, hashes, data = fetched
+            if isinstance(data, list):
+                # The positions set since the version of the entry
+                if entry is None:
+                    return None
+                for position in data:
+                    entry[3][position >> 3] |= 1 << (position & 7)
+                entry[0], entry[4] = version, time.time()
+                return entry
+            entry = [version, bits, hashes, bytearray(data), time.time()]
+            for when, written, key in self._written:
+                if written == address and when >= began - self.ttl:
+                    self._add(entry, key)
+            self._filters[address] = entry
+            return entry
+
+    def without(self, node):
+        """
+        Note a storage that doesn't keep a filter.
+        """
+        with self._lock:
+            self._without[_format_address(node)] = True
+            self._fetching.pop(_format_address(node), None)
+
+    def failed(self, node):
+        """
+        Note a filter that couldn't be fetched, it is asked for again
+        the next time it is needed.
+        """
+        with self._lock:
+            self._fetching.pop(_format_address(node), None)
+
+    def _filter(self, node, fetch):
+        """
+        @return: The filter of the storage of a node, refreshed if it is
+        older than ttl (None if the storage has none or can't be
+        asked)
+        @rtype: list
+        """
+        address = _format_address(node)
+        with self._lock:
+            if address in self._without:
+                return None
+            entry = self._filters.get(address)
+        if entry is not None and entry[4] + self.ttl > time.time():
+            return entry
+        if not fetch:
+            return None
+        began = time.time()
+        try:
+            fetched = Node(node.ip, node.port).bloom(entry and entry[0], True)
+        except NodeError:
+            self.without(node)
+            return None
+        except (httplib.HTTPException, socket.error):
+            return None
+        return self.refreshed(node, fetched, began)
+
+    def _add(self, entry, key):
+        for position in _bloom_positions(key, entry[1], entry[2]):
+            entry[3][position >> 3] |= 1 << (position & 7)
+
+# The Bloom filters of the storages used by get, get_many and gets
+# (None until enable_bloom_filters)
+_blooms = None
+
+def enable_bloom_filters(ttl=BLOOM_TTL):
+    """
+    Answer the gets of keys without a value from the Bloom filters of
+    the storages instead of asking them (see BloomFilters). The
+    filters are dropped when the ring changes.
+
+    @param ttl: Seconds a filter is used before the storage is asked
+    if it has changed, a key set by another client may be found
+    missing for as long
+    @type ttl: float
+    """
+    global _blooms
+    _blooms = BloomFilters(ttl)
+
+def disable_bloom_filters():
+    """
+    Stop using the Bloom filters (and drop them).
+    """
+    global _blooms
+    _blooms = None
+
+def bloom_stats():
+    """
+    @return: The counters of the Bloom filters (see
+    BloomFilters.stats) or None if they aren't enabled
+    @rtype: dict
+    """
+    if _blooms is None:
+        return None
+    return _blooms.stats()
+
+class LatencyTracker(object):
+    """
+    The latencies of the storages seen by this client, used to read
+    from the fastest replica of a key and to find when a read is late
+    enough to hedge it.
+
+    Every storage gets a moving average of its latencies (a failed
+    request counts as FAILURE_PENALTY seconds) and keeps its last
+    samples for the percentiles.
+    """
+
+    def __init__(self, samples=LATENCY_SAMPLES, weight=0.2):
+        """
+        @param samples: Latencies kept per storage
+        @type samples: int
+
+        @param weight: Weight of a new latency in the moving average
+        @type weight: float
+        """
+        self.samples = samples
+        self.weight = weight
+        self._averages = {}
+        self._recent = {}
+
+    def record(self, address, seconds):
+        """
+        Add the latency of a request a storage answered.
+
+        @param address: 'ip:port' of the storage
+        @type address: str
+
+        @type seconds: float
+        """
+        recent = self._recent.get(address)
+        if recent is None:
+            recent = self._recent.setdefault(address, deque(maxlen=self.samples))
+        recent.append(seconds)
+        self._average(address, seconds)
+
+    def failed(self, address):
+        """
+        Count a request a storage didn't answer.
+
+        @param address: 'ip:port' of the storage
+        @type address: str
+        """
+        self._average(address, FAILURE_PENALTY)
+
+    def _average(self, address, seconds):
+        average = self._averages.get(address)
+        if average is None:
+            self._averages[address] = seconds
+        else:
+            self._averages[address] = average + self.weight * (seconds - average)
+
+    def rank(self, nodes):
+        """
+        Sort nodes by their average latency. Storages without one come
+        first (in the order given) so they get measured.
+
+        @type nodes: list
+
+        @rtype: list
+        """
+        return sorted(nodes, key=lambda node: self._averages.get(_format_address(node), 0.0))
+
+    def percentile(self, address, percentile):
+        """
+        @param address: 'ip:port' of the storage
+        @type address: str
+
+        @param percentile: 0 to 100
+        @type percentile: float
+
+        @return: The latency below which percentile of the recent
+        requests to the storage were answered (None if there are less
+        than HEDGE_MIN_SAMPLES)
+        @rtype: float
+        """
+        recent = sorted(self._recent.get(address, ()))
+        if len(recent) < HEDGE_MIN_SAMPLES:
+            return None
+        return recent[min(len(recent) - 1, int(len(recent) * percentile / 100.0))]
+
+    def stats(self):
+        """
+        @return: The average and the median, 99th percentile and
+        number of the recent latencies by storage
+        @rtype: dict
+        """
+        stats = {}
+        for address, average in self._averages.items():
+            recent = sorted(self._recent.get(address, ()))
+            stats[address] = {'average': average,
+                              'samples': len(recent),
+                              'p50': recent and recent[len(recent) / 2] or None,
+                              'p99': recent and recent[min(len(recent) - 1, len(recent) * 99 / 100)] or None}
+        return stats
+
+class _Workers(object):
+    """
+    Daemon threads running requests sent to several replicas at once.
+    """
+
+    def __init__(self, size):
+        """
+        @param size: Number of threads
+        @type size: int
+        """
+        # A forked process doesn't get the threads (see _submit)
+        self.pid = os.getpid()
+        self._tasks = Queue.Queue()
+        for i in xrange(size):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, function, *args):
+        """
+        Run function(*args) in one of the threads.
+        """
+        self._tasks.put((function, args))
+
+    def _work(self):
+        while True:
+            function, args = self._tasks.get()
+            function(*args)
+
+# The latencies of the storages, the threads asking the replicas
+# (started the first time they are needed) and the replication
+# settings (see configure_replication)
+_latencies = LatencyTracker()
+_workers = None
+_workers_lock = threading.Lock()
+_replicas = REPLICAS
+_write_acks = None
+_hedge_percentile = HEDGE_PERCENTILE
+
+def configure_replication(replicas=REPLICAS, write_acks=None, hedge_percentile=HEDGE_PERCENTILE):
+    """
+    Keep every key on several storages: the one owning it and the
+    storages of the next positions in the ring (every storage once).
+
+    Writes are sent to every replica and wait for write_acks of them
+    to answer. Reads go to the replica with the lowest latency so far
+    and, if it hasn't answered when hedge_percentile of its recent
+    requests had, to the next one as well. A replica that fails is
+    skipped. join and remove move the data so every key stays on its
+    replicas.
+
+    Use the same number of replicas in every client of a ring and set
+    it before the data is written, keys already stored aren't copied
+    to the new replicas.
+
+    @param replicas: Storages every key is kept on
+    @type replicas: int
+
+    @param write_acks: Replicas that must acknowledge a write (None
+    for all of them)
+    @type write_acks: int
+
+    @param hedge_percentile: Percentile of the latencies of a replica
+    after which a read is hedged (None to never hedge)
+    @type hedge_percentile: float
+    """
+    global _replicas, _write_acks, _hedge_percentile
+    if replicas < 1:
+        raise ValueError("At least one replica is needed")
+    if write_acks is not None and not 1 <= write_acks <= replicas:
+        raise ValueError("Between 1 and %d replicas can acknowledge a write" % replicas)
+    _replicas = replicas
+    _write_acks = write_acks
+    _hedge_percentile = hedge_percentile
+
+def latency_stats():
+    """
+    @return: The latencies of the storages (see LatencyTracker.stats)
+    @rtype: dict
+    """
+    return _latencies.stats()
+
+class CircuitBreaker(object):
+    """
+    The health of one storage as seen by the requests sent to it.
+
+    After failures requests in a row failed (the storage couldn't be
+    reached or timed out) the breaker opens and the requests to the
+    storage fail at once instead of waiting for the timeouts, so reads
+    go to the other replicas right away. After reset_timeout seconds a
+    single request is let through (half open): the breaker closes if
+    it succeeds and stays open for another reset_timeout if it fails.
+    """
+
+    def __init__(self, failures=BREAKER_FAILURES, reset_timeout=BREAKER_RESET):
+        """
+        @param failures: Failed requests in a row that open the breaker
+        @type failures: int
+
+        @param reset_timeout: Seconds before a request is tried again
+        @type reset_timeout: float
+        """
+        self.threshold = failures
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened = None
+        self._trying = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """
+        @return: True if a request may be sent to the storage (it must
+        then be reported with succeeded or failed)
+        @rtype: bool
+        """
+        if self.opened is None:
+            return True
+        with self._lock:
+            if self.opened is None:
+                return True
+            if self._trying or time.time() - self.opened < self.reset_timeout:
+                return False
+            self._trying = True
+            return True
+
+    def is_open(self):
+        """
+        @return: True while requests to the storage fail at once
+        @rtype: bool
+        """
+        opened = self.opened
+        return opened is not None and (self._trying or time.time() - opened < self.reset_timeout)
+
+    def succeeded(self):
+        """
+        The storage answered a request.
+        """
+        if self.failures or self.opened is not None:
+            with self._lock:
+                self.failures = 0
+                self.opened = None
+                self._trying = False
+
+    def failed(self):
+        """
+        A request to the storage failed.
+        """
+        with self._lock:
+            self.failures += 1
+            self._trying = False
+            if self.failures >= self.threshold:
+                self.opened = time.time()
+
+    def state(self):
+        """
+        @return: 'closed', 'open' or 'half open'
+        @rtype: str
+        """
+        if self.opened is None:
+            return 'closed'
+        elif self.is_open() and not self._trying:
+            return 'open'
+        return 'half open'
+
+class HealthProber(object):
+    """
+    A daemon thread checking every storage of the ring (see Node.check)
+    every interval seconds. The checks feed the circuit breakers, so a
+    storage that goes down is noticed (and one that comes back is used
+    again) without a request of the client having to wait for it, and
+    join doesn't have to check the storages it already knows.
+    """
+
+    def __init__(self, interval=PROBE_INTERVAL):
+        """
+        @param interval: Seconds between the checks
+        @type interval: float
+        """
+        self.interval = interval
+        self._checked = {}
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            nodes = [node for node, positions in _by_storage(_node_list)]
+            if _entry is not None:
+                nodes.append(_entry)
+            for node in nodes:
+                # An open breaker is left alone until a request may
+                # be tried again, the check is that request
+                if not _breaker(_format_address(node)).is_open():
+                    self.probe(node)
+            self._stopped.wait(self.interval)
+
+    def probe(self, node):
+        """
+        Check a storage now.
+
+        @type node: Node
+
+        @return: True if it answered
+        @rtype: bool
+        """
+        try:
+            healthy = node.check()
+        except (NodeError, httplib.HTTPException, socket.error):
+            healthy = False
+        self._checked[_format_address(node)] = (time.time(), healthy)
+        return healthy
+
+    def healthy(self, node):
+        """
+        @param node: A node
+        @type node: Node
+
+        @return: True or False if the storage of the node was checked
+        lately, None if it wasn't
+        """
+        checked = self._checked.get(_format_address(node))
+        if checked is None or time.time() - checked[0] > 2 * self.interval:
+            return None
+        return checked[1]
+
+    def stop(self):
+        """
+        Stop checking.
+        """
+        self._stopped.set()
+
+# The circuit breakers of the storages by 'ip:port' (see _breaker),
+# their settings (see configure_breakers) and the health prober (see
+# enable_prober)
+_breakers = {}
+_breakers_lock = threading.Lock()
+_breaker_failures = BREAKER_FAILURES
+_breaker_reset = BREAKER_RESET
+_prober = None
+
+def configure_breakers(failures=BREAKER_FAILURES, reset_timeout=BREAKER_RESET):
+    """
+    Set when the requests to a storage start to fail at once (see
+    CircuitBreaker). Every breaker starts closed again.
+
+    @param failures: Failed requests in a row that open a breaker
+    @type failures: int
+
+    @param reset_timeout: Seconds before a request to the storage is
+    tried again
+    @type reset_timeout: float
+    """
+    global _breaker_failures, _breaker_reset
+    if failures < 1:
+        raise ValueError("At least one failure must open a breaker")
+    with _breakers_lock:
+        _breaker_failures = failures
+        _breaker_reset = reset_timeout
+        _breakers.clear()
+
+def _breaker(address):
+    """
+    @param address: 'ip:port' of a storage
+    @type address: str
+
+    @return: The circuit breaker of the storage
+    @rtype: CircuitBreaker
+    """
+    breaker = _breakers.get(address)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.setdefault(address, CircuitBreaker(_breaker_failures, _breaker_reset))
+    return breaker
+
+def enable_prober(interval=PROBE_INTERVAL):
+    """
+    Check every storage of the ring in a background thread (see
+    HealthProber), replacing a running prober.
+
+    @param interval: Seconds between the checks
+    @type interval: float
+    """
+    global _prober
+    disable_prober()
+    _prober = HealthProber(interval)
+
+def disable_prober():
+    """
+    Stop the health prober.
+    """
+    global _prober
+    if _prober is not None:
+        _prober.stop()
+        _prober = None
+
+def health():
+    """
+    @return: The state ('closed', 'open' or 'half open') and the failed
+    requests in a row of every storage a request was sent to, by
+    'ip:port'
+    @rtype: dict
+    """
+    return dict([(address, {'state': breaker.state(), 'failures': breaker.failures})
+                 for address, breaker in _breakers.items()])
+
+def _healthy_first(nodes):
+    """
+    Move the nodes whose circuit breaker is open to the end, so their
+    replicas are asked first.
+
+    @type nodes: list
+
+    @rtype: list
+    """
+    down = [node for node in nodes if _breaker(_format_address(node)).is_open()]
+    if not down:
+        return nodes
+    return [node for node in nodes if node not in down] + down
+
+def _known_health(node):
+    """
+    What is known about a storage without asking it: False while its
+    breaker is open, what the health prober found if it checked it
+    lately, None otherwise.
+
+    @type node: Node
+    """
+    if _breaker(_format_address(node)).is_open():
+        return False
+    if _prober is not None:
+        return _prober.healthy(node)
+    return None
+
+def _check_ring_health(node):
+    """
+    Make sure a joining node answers and that no storage of the ring
+    is known to be down before the ring is changed, so join fails
+    before it has moved anything. A storage that isn't known (see
+    _known_health) is checked.
+
+    @param node: The joining node
+    @type node: Node
+
+    @raise NodeError: If a storage is down
+    """
+    healthy = _known_health(node)
+    if healthy is None:
+        healthy = node.check()
+    if not healthy:
+        raise NodeError ("Node '%s' isn't responding" % node)
+    _check_storages_health()
+
+def _check_storages_health():
+    """
+    @raise NodeError: If the breaker of a storage of the ring is open
+    """
+    down = [_format_address(other) for other, positions in _by_storage(_node_list)
+            if _breaker(_format_address(other)).is_open()]
+    if down:
+        raise NodeError("Storages %s are down" % ', '.join(down))
+
+def _submit(function, *args):
+    """
+    Run function(*args) in a replica thread (see _Workers).
+    """
+    global _workers
+    if _workers is None or _workers.pid != os.getpid():
+        with _workers_lock:
+            if _workers is None or _workers.pid != os.getpid():
+                _workers = _Workers(REPLICA_THREADS)
+    _workers.submit(function, *args)
+
+# Called after every request a Node sends (see add_timing_hook)
+_timing_hooks = []
+
+def add_timing_hook(hook):
+    """
+    Call hook(node, command, seconds, error) after every request a
+    Node sends to its storage, to see which storages are slow. error
+    is the exception the request raised (a KeyError for a missing
+    value) or None. The hooks are called in the thread sending the
+    request and should be quick.
+
+    @param hook: The function to call
+    @type hook: callable
+    """
+    _timing_hooks.append(hook)
+
+def remove_timing_hook(hook):
+    """
+    Stop calling a hook added with add_timing_hook.
+    """
+    _timing_hooks.remove(hook)
+
+def _timing(node, command, began, error):
+    """
+    Call the timing hooks for a request that began at began.
+    """
+    if _timing_hooks:
+        seconds = time.time() - began
+        for hook in _timing_hooks:
+            hook(node, command, seconds, error)
+
+# The protocols offered to the storages and the one each storage
+# agreed on, by (ip, port)
+_offered = ['frame', 'form']
+_protocols = {}
+
+def configure_pool(size=POOL_SIZE, idle_timeout=POOL_IDLE_TIMEOUT,
+                   connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT):
+    """
+    Replace the connection pool used by every Node.
+
+    @param size: Idle connections kept per storage
+    @type size: int
+
+    @param idle_timeout: Seconds before an idle connection is closed
+    @type idle_timeout: float
+
+    @param connect_timeout: Seconds to wait for a connection
+    @type connect_timeout: float
+
+    @param read_timeout: Seconds to wait for each read of a response
+    (a streamed transfer gets a line for every chunk moved)
+    @type read_timeout: float
+    """
+    global _pool
+    _pool.clear()
+    _pool = ConnectionPool(size, idle_timeout, connect_timeout, read_timeout)
+
+def configure_protocol(protocol='frame'):
+    """
+    Choose the protocol the data commands (get, set and the batches)
+    are sent in. The storages are asked again which protocols they
+    support.
+
+    @param protocol: 'frame' for binary frames where the storage
+    supports them, 'form' to always send urlencoded forms
+    @type protocol: str
+    """
+    if protocol not in ('frame', 'form'):
+        raise ValueError("Unknown protocol '%s'" % protocol)
+    _offered[:] = protocol == 'frame' and ['frame', 'form'] or ['form']
+    _protocols.clear()
+
+class Codec(object):
+    """
+    Turns the values set into the bytes stored and back.
+
+    A value encoded by a codec starts with a header byte: the ident of
+    the codec (1 to 14) and the COMPRESSED bit. No pickle starts with
+    such a byte, so the values stored as plain pickles by older
+    versions of the sdht are still read (see _decode).
+    """
+
+    # The ident in the header byte, 1 to 14 (15 is MANIFEST)
+    ident = None
+
+    def encode(self, value):
+        """
+        @return: The value as bytes
+        @rtype: str
+        """
+        raise NotImplementedError
+
+    def decode(self, data):
+        """
+        @param data: Bytes made by encode
+        @type data: str
+
+        @return: The value
+        """
+        raise NotImplementedError
+
+class PickleCodec(Codec):
+    """
+    Pickles at the highest protocol, for any value.
+    """
+
+    ident = 1
+
+    def encode(self, value):
+        return cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+
+    def decode(self, data):
+        return cPickle.loads(data)
+
+class MarshalCodec(Codec):
+    """
+    marshal, faster than pickle but only for the builtin types.
+    """
+
+    ident = 2
+
+    def encode(self, value):
+        return marshal.dumps(value)
+
+    def decode(self, data):
+        return marshal.loads(data)
+
+class RawCodec(Codec):
+    """
+    Stores str values as they are.
+    """
+
+    ident = 3
+
+    def encode(self, value):
+        if not isinstance(value, str):
+            raise TypeError("The raw codec only stores str values, not %s" % type(value).__name__)
+        return value
+
+    def decode(self, data):
+        return data
+
+# The codecs by name (see configure_codec) and by ident
+CODECS = {'pickle': PickleCodec(),
+          'marshal': MarshalCodec(),
+          'raw': RawCodec()}
+_codecs = dict([(codec.ident, codec) for codec in CODECS.values()])
+
+# The codec values are encoded with (None for legacy pickles) and when
+# they are compressed
+_codec = None
+_compress_bytes = COMPRESS_BYTES
+_compress_level = COMPRESS_LEVEL
+
+def register_codec(name, codec):
+    """
+    Add a codec of your own. Every client reading the values needs it
+    too.
+
+    @param name: The name to configure it with (see configure_codec)
+    @type name: str
+
+    @param codec: The codec, with an ident no other codec has
+    @type codec: Codec
+    """
+    if not 1 <= codec.ident < MANIFEST:
+        raise ValueError("The ident of a codec must be between 1 and %d" % (MANIFEST - 1))
+    if codec.ident in _codecs or name in CODECS or name == 'legacy':
+        raise ValueError("There is already a codec '%s' or with the ident %d" % (name, codec.ident))
+    CODECS[name] = codec
+    _codecs[codec.ident] = codec
+
+def configure_codec(codec=CODEC, compress_bytes=COMPRESS_BYTES, level=COMPRESS_LEVEL):
+    """
+    Choose how the values set are encoded. Values are read whatever
+    codec they were stored with.
+
+    @param codec: 'legacy', 'pickle', 'marshal', 'raw' or a codec
+    added with register_codec
+    @type codec: str
+
+    @param compress_bytes: Values of at least this many bytes are
+    compressed (None to never compress, legacy values never are)
+    @type compress_bytes: int
+
+    @param level: The zlib level, 1 (fastest) to 9 (smallest)
+    @type level: int
+    """
+    global _codec, _compress_bytes, _compress_level
+    if codec != 'legacy' and codec not in CODECS:
+        raise ValueError("Unknown codec '%s'" % codec)
+    _codec = CODECS.get(codec)
+    _compress_bytes = compress_bytes
+    _compress_level = level
+
+def _encode(value):
+    """
+    Encode a value with the configured codec (see configure_codec).
+
+    @return: The bytes to store
+    @rtype: str
+    """
+    if _codec is None:
+        return pickle.dumps(value) # Use default protocol
+    return _wrap(_codec.ident, _codec.encode(value))
+
+def _wrap(ident, data):
+    """
+    Put the header byte in front of an encoded value, compressing it
+    if it is large.
+
+    @param ident: The ident of the codec
+    @type ident: int
+
+    @param data: The encoded value
+    @type data: str
+
+    @rtype: str
+    """
+    header = ident
+    if _compress_bytes is not None and len(data) >= _compress_bytes:
+        compressed = zlib.compress(data, _compress_level)
+        if len(compressed) < len(data):
+            data = compressed
+            header |= COMPRESSED
+    return chr(header) + data
+
+def _unwrap(data):
+    """
+    Take the header byte off a stored value and decompress it.
+
+    @param data: The value as stored
+    @type data: str
+
+    @return: The ident of the codec (None for a plain pickle) and the
+    encoded value
+    @rtype: tuple
+    """
+    header = data and ord(data[0]) or 0
+    if not 0 < header < 2 * COMPRESSED:
+        return None, data
+    if header & COMPRESSED:
+        return header & ~COMPRESSED, zlib.decompress(buffer(data, 1))
+    return header, data[1:]
+
+def _decode(data):
+    """
+    Decode a stored value, whatever codec it was stored with.
+
+    @param data: The value as stored
+    @type data: str
+
+    @return: The value
+    """
+    ident, data = _unwrap(data)
+    if ident is None:
+        return cPickle.loads(data)
+    codec = _codecs.get(ident)
+    if codec is None:
+        raise ValueError("Unknown codec %d, was it registered?" % ident)
+    return codec.decode(data)
+
+# The chunk settings (see configure_chunks)
+_chunk_threshold = CHUNK_THRESHOLD
+_chunk_bytes = CHUNK_BYTES
+_chunk_fetches = CHUNK_FETCHES
+
+def configure_chunks(threshold=CHUNK_THRESHOLD, chunk_bytes=CHUNK_BYTES, fetches=CHUNK_FETCHES):
+    """
+    Store large values in chunks spread over the ring instead of a
+    single record, so no storage (and no request) has to hold a whole
+    value. The key then only has a small manifest of the chunks. Values
+    are read whether they were chunked or not.
+
+    @param threshold: Values of more than this many encoded bytes set
+    with set or set_many are chunked (None to never chunk them)
+    @type threshold: int
+
+    @param chunk_bytes: The bytes of a chunk
+    @type chunk_bytes: int
+
+    @param fetches: Chunks read or written at the same time, a client
+    holds at most this many chunks of a value in memory while it streams
+    it (see get_stream)
+    @type fetches: int
+    """
+    global _chunk_threshold, _chunk_bytes, _chunk_fetches
+    if chunk_bytes < 1 or fetches < 1:
+        raise ValueError("The chunks need at least a byte and a fetch")
+    _chunk_threshold = threshold
+    _chunk_bytes = chunk_bytes
+    _chunk_fetches = fetches
+
+def _manifest(ident, size, chunks, raw):
+    """
+    The record stored under the key of a chunked value: the header
+    byte MANIFEST followed by JSON.
+
+    @param ident: The random id the keys of the chunks are made from
+    (see _chunk_keys)
+    @type ident: str
+
+    @param size: The bytes of all the chunks
+    @type size: int
+
+    @param chunks: The number of chunks
+    @type chunks: int
+
+    @param raw: True if the chunks are the bytes of a stream, False if
+    they are a value encoded like any other (see _encode)
+    @type raw: bool
+
+    @rtype: str
+    """
+    return chr(MANIFEST) + json.dumps({'id': ident, 'size': size, 'chunks': chunks, 'raw': raw})
+
+def _read_manifest(serialized_value):
+    """
+    @param serialized_value: A value as stored
+    @type serialized_value: str
+
+    @return: The manifest if the value is chunked, else None
+    @rtype: dict
+    """
+    if serialized_value[:1] != chr(MANIFEST):
+        return None
+    return json.loads(serialized_value[1:])
+
+def _chunk_id():
+    """
+    @return: A random id for the chunks of a value, every value stored
+    gets new chunks
+    @rtype: str
+    """
+    return os.urandom(10).encode('hex')
+
+def _chunk_keys(ident, chunks):
+    """
+    @return: The hashed keys of the chunks of a value, in order. They
+    are spread over the ring like any other key.
+    @rtype: list
+    """
+    return [_hash('%s:%d' % (ident, position)) for position in xrange(chunks)]
+
+def _parallel(function, items):
+    """
+    Call function on every item at the same time, each in its own
+    thread (not the replica threads, the function may use them).
+
+    @return: What function returns for each item, in order
+    @rtype: list
+    """
+    if len(items) == 1:
+        return [function(items[0])]
+    results = [None] * len(items)
+    errors = []
+    def run(position, item):
+        try:
+            results[position] = function(item)
+        except Exception, e:
+            errors.append(e)
+    threads = [threading.Thread(target=run, args=(position, item)) for position, item in enumerate(items)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return results
+
+def _fetch_chunk(hashed_key):
+    """
+    @return: A chunk of a value
+    @rtype: str
+    """
+    try:
+        return _lookup(hashed_key)
+    except KeyError:
+        raise _chunk_missing()
+
+def _chunk_missing():
+    """
+    @return: The error of a read of a chunked value missing a chunk
+    @rtype: NodeError
+    """
+    return NodeError("A chunk of the value is missing, it was replaced or deleted while read")
+
+def _chunks(manifest):
+    """
+    Read the chunks of a value, _chunk_fetches of them at the same
+    time.
+
+    @param manifest: The manifest of the value
+    @type manifest: dict
+
+    @return: The chunks, in order
+    @rtype: generator
+    """
+    keys = _chunk_keys(manifest['id'], manifest['chunks'])
+    for start in xrange(0, len(keys), _chunk_fetches):
+        for data in _parallel(_fetch_chunk, keys[start:start + _chunk_fetches]):
+            yield data
+
+def _store_chunks(pieces, raw):
+    """
+    Store the chunks of a value, _chunk_fetches of them at the same
+    time. The chunks already stored are deleted if one fails.
+
+    @param pieces: The chunks
+    @type pieces: iterable
+
+    @param raw: See _manifest
+    @type raw: bool
+
+    @return: The manifest to store under the key of the value
+    @rtype: str
+    """
+    ident = _chunk_id()
+    counts = {'chunks': 0, 'size': 0}
+    def flush(window):
+        keys = _chunk_keys(ident, counts['chunks'] + len(window))[counts['chunks']:]
+        _parallel(lambda (key, data): _store(key, data), zip(keys, window))
+        counts['chunks'] += len(window)
+        counts['size'] += sum([len(data) for data in window])
+    window = []
+    try:
+        for data in pieces:
+            window.append(data)
+            if len(window) == _chunk_fetches:
+                flush(window)
+                window = []
+        if window:
+            flush(window)
+    except Exception:
+        _delete_chunks({'id': ident, 'chunks': counts['chunks'] + len(window)})
+        raise
+    return _manifest(ident, counts['size'], counts['chunks'], raw)
+
+def _delete_chunks(manifest):
+    """
+    Delete the chunks of a value that is replaced or deleted. A chunk
+    that can't be deleted is left behind, the value is gone anyway.
+    """
+    keys = _chunk_keys(manifest['id'], manifest['chunks'])
+    try:
+        for nodes, extras, positions in _group_replicas(keys):
+            group = [keys[position] for position in positions]
+            _write(nodes, extras, lambda node, group=group: node.delete_many(group))
+    except (NodeError, socket.error, httplib.HTTPException):
+        pass
+
+def _split(data):
+    """
+    @return: The chunks of an encoded value
+    @rtype: generator
+    """
+    for start in xrange(0, len(data), _chunk_bytes):
+        yield data[start:start + _chunk_bytes]
+
+def _read_stream(stream):
+    """
+    @return: The chunks of a file-like object, read a chunk at a time
+    @rtype: generator
+    """
+    while True:
+        data = stream.read(_chunk_bytes)
+        if not data:
+            break
+        yield data
+
+def _replaced_manifests(answers):
+    """
+    @param answers: What a storage answered for every key of a set or
+    delete, the manifest of the chunked value replaced or an empty
+    string (MISSING from a form)
+    @type answers: list
+
+    @return: The manifests, None for the keys without one
+    @rtype: list
+    """
+    return [answer is not MISSING and answer or None for answer in answers]
+
+def _replaced(answers):
+    """
+    @param answers: What the replicas answered to a write (see _write),
+    the manifests of the chunked values replaced (see Node.set_many)
+    @type answers: list
+
+    @return: The manifests read, each value only once
+    @rtype: list
+    """
+    manifests = {}
+    for manifest in [manifest for answer in answers for manifest in answer or [] if manifest]:
+        manifest = _read_manifest(manifest)
+        if manifest is not None:
+            manifests[manifest['id']] = manifest
+    return manifests.values()
+
+def _delete_replaced(answers):
+    """
+    Delete the chunks of the chunked values a write replaced or
+    deleted.
+
+    @param answers: What the replicas answered (see _replaced)
+    @type answers: list
+    """
+    for manifest in _replaced(answers):
+        _delete_chunks(manifest)
+
+class Node():
+    """
+    The class representation of a node in the sdht.
+    """
+    
+    def __init__(self, ip, port, weight=1):
+        """
+        Set the normal value of this Node and also hash out the key_id
+
+        @param ip: IP number of the node
+        @type ip: str
+
+        @param port: port number of the node
+        @type port: str
+
+        @param weight: Share of the keys this node takes compared to
+        nodes of weight 1 (see positions)
+        @type weight: float
+        """
+        self.next = None
+        self.fingers = []
+        # The node that keeps serving the hashes of this node while
+        # they are stolen from it during a join (see find_node)
+        self.source = None
+        self.ip = ip
+        self.port = port
+        self.weight = weight
+        self.key_id = long(sha.new("%s:%s" % (ip, port)).hexdigest(), 16)
+        self._positions = None
+
+    def positions(self):
+        """
+        The positions of this node in the ring. A node gets
+        VIRTUAL_NODES positions for each unit of weight so the keys
+        (and the data moved when nodes join or leave) are spread
+        evenly over the storages. The first position is the node
+        itself, the others are nodes with the same address and a
+        key_id hashed from 'ip:port#n'.
+
+        @rtype: list
+        """
+        if self._positions is None:
+            count = max(1, int(round(VIRTUAL_NODES * self.weight)))
+            self._positions = [self]
+            for n in xrange(1, count):
+                position = Node(self.ip, self.port, self.weight)
+                position.key_id = long(sha.new("%s:%s#%d" % (self.ip, self.port, n)).hexdigest(), 16)
+                self._positions.append(position)
+        return self._positions
+
+    def _post(self, values):
+        """
+        Post a command to the storage of this node using the pooled
+        connections.
+
+        @param values: The form values of the command
+        @type values: dict
+
+        @return: The response of the storage
+        @rtype: str
+        """
+        return _pool.post(self.ip, self.port, urllib.urlencode(values, True))
+
+    def _command(self, values, parse):
+        """
+        Post a command to the storage of this node and parse the
+        response. The commands only build the form and parse the
+        response so sdht_async.AsyncNode can send the same commands
+        without blocking.
+
+        @param values: The form values of the command
+        @type values: dict
+
+        @param parse: Turns the response into the result of the command
+        @type parse: callable
+
+        @return: What parse returns
+        """
+        began = time.time()
+        error = None
+        try:
+            return parse(self._post(values))
+        except Exception, error:
+            raise
+        finally:
+            _timing(self, values['cmd'], began, error)
+
+    def _frames(self, command, keys, values, parse):
+        """
+        Send a data command to the storage of this node as binary
+        frames (see _pack_frames) and parse the answers.
+
+        @param command: FRAME_GET, FRAME_SET or FRAME_DELETE
+        @type command: int
+
+        @param keys: Hashed keys
+        @type keys: list
+
+        @param values: Serialized values (same order as the keys) or
+        None
+        @type values: list
+
+        @param parse: Turns the answers (see _unpack_answers) into the
+        result of the command
+        @type parse: callable
+
+        @return: What parse returns
+        """
+        data = _pack_frames(command, keys, values)
+        began = time.time()
+        error = None
+        try:
+            return parse(_unpack_answers(_pool.post(self.ip, self.port, data, FRAME_TYPE)))
+        except Exception, error:
+            raise
+        finally:
+            _timing(self, FRAME_COMMANDS[command], began, error)
+
+    def _protocol(self):
+        """
+        The protocol the storage of this node agreed on, asked with
+        check the first time.
+
+        @return: 'frame' or 'form'
+        @rtype: str
+        """
+        address = (self.ip, str(self.port))
+        if address not in _protocols:
+            self.check()
+        return _protocols.get(address, 'form')
+
+    def _stream(self, values, line, parse):
+        """
+        Post a command to the storage of this node and follow the
+        lines of the response as the storage writes them.
+
+        @param values: The form values of the command
+        @type values: dict
+
+        @param line: Called with every line of the response
+        @type line: callable
+
+        @param parse: Turns the last line into the result of the
+        command
+        @type parse: callable
+
+        @return: What parse returns
+        """
+        result = ''
+        began = time.time()
+        error = None
+        try:
+            for result in _pool.lines(self.ip, self.port, urllib.urlencode(values, True)):
+                line(result)
+            return parse(result)
+        except Exception, error:
+            raise
+        finally:
+            _timing(self, values['cmd'], began, error)
+
+    def owns(self, key):
+        """
+        Check if a hashed key falls between this node and the next
+        one, that is if this node is the one responsible for it.
+
+        @param key: A hashed key
+        @type key: long
+
+        @return: True if this node is responsible for the key
+        @rtype: bool
+        """
+        if self.next is None:
+            return True
+        return distance(self.key_id, key) < distance(self.key_id, self.next.key_id)
+
+    def closest_preceding(self, key):
+        """
+        Find the finger that gets us as close as possible to a hashed
+        key without passing it.
+
+        @param key: A hashed key
+        @type key: long
+
+        @return: The closest preceding finger (or this node if no
+        finger gets us closer)
+        @rtype: Node
+        """
+        best = self
+        best_distance = 0
+        key_distance = distance(self.key_id, key)
+        for finger in self.fingers + [self.next]:
+            if finger is None:
+                continue
+            finger_distance = distance(self.key_id, finger.key_id)
+            if best_distance < finger_distance <= key_distance:
+                best = finger
+                best_distance = finger_distance
+        return best
+
+    def find_successor(self, key):
+        """
+        Ask the storage of this node where a hashed key belongs. The
+        storage either answers that it is the owner of the key or
+        which node to ask next (its closest preceding finger).
+
+        @param key: A hashed key
+        @type key: long
+
+        @return: A tuple of a flag that is True if the returned node
+        is the owner of the key and the node itself
+        @rtype: tuple
+        """
+        values = {'cmd' : 'find_successor',
+                  'key' : '%s' % key }
+
+        def parse(result):
+            if not result:
+                raise NodeError("Node isn't responding (has it gone down?)")
+            elif result == 'NO ROUTE':
+                raise NodeError("Node '%s' hasn't got a finger table" % self)
+
+            answer, address = result.split(' ', 1)
+            return answer == 'OWNER', _parse_address(address)
+        return self._command(values, parse)
+
+    def publish_fingers(self, positions=None):
+        """
+        Send the next pointer and the finger table of this node (or of
+        several positions of it) to its storage so it can answer
+        find_successor.
+
+        @param positions: Positions of this node (see positions), just
+        this node if None
+        @type positions: list
+        """
+        values = {'cmd' : 'fingers',
+                  'node_ip' : self.ip,
+                  'node_port' : self.port,
+                  'key_id' : [],
+                  'next' : [],
+                  'fingers' : []}
+
+        for position in positions or [self]:
+            fingers = []
+            for finger in position.fingers:
+                if finger not in fingers:
+                    fingers.append(finger)
+            values['key_id'].append('%s' % position.key_id)
+            values['next'].append(position.next and _format_position(position.next) or '')
+            values['fingers'].append(','.join([_format_position(finger) for finger in fingers]))
+
+        def parse(result):
+            if result != "OK":
+                raise NodeError("Could not set the finger table of '%s'" % self)
+        return self._command(values, parse)
+
+    def _transfer(self, values, source, target, progress):
+        """
+        Run a transfer command on the storage of this node and follow
+        its progress.
+
+        The storage streams the data in chunks and answers with a line
+        'PROGRESS <records> <bytes>' for every chunk the other storage
+        has acknowledged, ending with 'OK <records> <bytes>' (or
+        'FAILURE').
+
+        @param progress: Called as progress(source, target, records,
+        bytes) for every acknowledged chunk (may be None)
+        @type progress: callable
+
+        @return: If the transfer was ok we return True or False if not
+        @rtype: bool
+        """
+        def line(text):
+            if text.startswith('PROGRESS ') and progress is not None:
+                records, size = text.split()[1:3]
+                progress(source, target, int(records), int(size))
+        return self._stream(values, line, lambda result: result.startswith('OK'))
+
+    def transfer(self, other_node, progress=None):
+        """
+        Transfer all hashed keys from this node to another one
+
+        @param other_node: Other node that this node should transfer
+        its content to
+        @type other_node: Node
+
+        @param progress: Called as progress(source, target, records,
+        bytes) while the data is moved (may be None)
+        @type progress: callable
+
+        @return: If the transfer was ok we return True or False if not
+        @rtype: bool
+        """
+        values = {'cmd' : 'transfer',
+                  'other_node_ip': other_node.ip,
+                  'other_node_port': other_node.port}
+
+        return self._transfer(values, self, other_node, progress)
+
+    def ingest(self, records):
+        """
+        Write packed records (see _pack_records) straight into the
+        storage. Used by the storages when they hand over data.
+
+        @param records: Packed records
+        @type records: str
+
+        @return: The number of records the storage acknowledged
+        @rtype: int
+        """
+        began = time.time()
+        error = None
+        try:
+            result = _pool.post(self.ip, self.port, records, RECORDS_TYPE)
+            if not result.startswith('OK '):
+                raise NodeError("Node '%s' didn't accept the records" % self)
+            return int(result[3:])
+        except Exception, error:
+            raise
+        finally:
+            _timing(self, 'ingest', began, error)
+
+    def steal_range(self, other_node, from_id, to_id, progress=None, copy=False, since=None,
+                    compare=False):
+        """
+        Steal all hashed keys from another node to this node
+        (depending on their key_id).
+        
+        The node steals from other_node but the data passed is
+        actually to the node that is being stolen from to send its
+        data to this node. Confused?
+
+        @param other_node: Other node that this node should transfer
+        its content to
+        @type other_node: Node
+
+        @param from_id: starting hash-id to transfer
+        @type from_id: long
+
+        @param to_id: ending hash-id to transfer
+        @type to_id: long
+
+        @param progress: Called as progress(source, target, records,
+        bytes) while the data is moved (may be None)
+        @type progress: callable
+
+        @param copy: Leave the keys on the other node too (it stays a
+        replica of them)
+        @type copy: bool
+
+        @param since: Only send the keys changed since this time (of
+        the other node) and delete the keys deleted since, this node
+        has the range from a snapshot taken then (see bootstrap). The
+        whole range is sent if the other node doesn't remember that
+        far back.
+        @type since: float
+
+        @param compare: The other node compares the digests of the
+        range with this node first (see digests) and only sends the
+        records this node doesn't have with the same value, the keys
+        only this node has are kept. Cheap when this node has most of
+        the range already, after it was down for a while or a transfer
+        failed half way.
+        @type compare: bool
+
+        @return: If the transfer was ok we return True or False if not
+        @rtype: bool
+        """
+        values = {'cmd' : 'transfer_part',
+                  'from_key_id': from_id,
+                  'to_key_id': to_id,
+                  'other_node_ip': self.ip,
+                  'other_node_port': self.port}
+        if copy:
+            values['copy'] = '1'
+        if since is not None:
+            values['since'] = repr(since)
+        if compare:
+            values['compare'] = '1'
+
+        return other_node._transfer(values, other_node, self, progress)
+
+    def snapshot(self, path, from_id=None, to_id=None, since=None):
+        """
+        Dump the records of the storage (or of one range) to a file.
+        The storage streams them compressed, in chunks, while it keeps
+        serving requests.
+
+        The dump ends with the changes made while it was read, so the
+        file holds every write the storage committed before the time
+        returned. A later snapshot with that time as since only holds
+        what changed after it (and the keys deleted meanwhile), to
+        catch up a storage loaded with the first one.
+
+        @param path: The file written
+        @type path: str
+
+        @param from_id: First hash of the range (None for the whole
+        storage)
+        @type from_id: long
+
+        @param to_id: Hash the range ends before (2**MAXIMUM_BIT for
+        the end of the ring)
+        @type to_id: long
+
+        @param since: Only dump the changes since this time (of the
+        storage)
+        @type since: float
+
+        @return: The time of the snapshot and the number of records
+        and deleted keys in it
+        @rtype: dict
+        """
+        values = {'cmd': 'snapshot'}
+        if from_id is not None:
+            values['from_key_id'] = from_id
+            values['to_key_id'] = to_id
+        if since is not None:
+            values['since'] = repr(since)
+
+        began = time.time()
+        error = None
+        try:
+            end = None
+            with open(path, 'wb') as output:
+                for kind, data in _pool.blocks(self.ip, self.port, urllib.urlencode(values)):
+                    output.write(_BLOCK.pack(kind, len(data)))
+                    output.write(data)
+                    if kind == 'E':
+                        end = json.loads(data)
+            if end is None:
+                raise NodeError("The snapshot of node '%s' was cut short" % self)
+            return end
+        except Exception, error:
+            raise
+        finally:
+            _timing(self, 'snapshot', began, error)
+
+    def load(self, path):
+        """
+        Load a snapshot (see snapshot) straight into the storage
+        engine, without going through the writes of single keys.
+
+        @param path: The snapshot file
+        @type path: str
+
+        @return: The number of records written and keys deleted
+        @rtype: tuple
+        """
+        began = time.time()
+        error = None
+        try:
+            with open(path, 'rb') as snapshot:
+                result = _pool.post(self.ip, self.port, snapshot, SNAPSHOT_TYPE)
+            if not result.startswith('OK '):
+                raise NodeError("Node '%s' didn't load the snapshot: %s" % (self, result))
+            records, deleted = result.split()[1:3]
+            return int(records), int(deleted)
+        except Exception, error:
+            raise
+        finally:
+            _timing(self, 'load', began, error)
+
+    def check(self):
+        """
+        Check if a node is ok and up and running
+
+        @return: If the node responded ok we return True otherwise False
+        @rtype: bool
+        """
+        values = {'cmd' : 'check',
+                  'protocols' : ','.join(_offered)}
+
+        def parse(result):
+            # A storage that knows frames answers 'OK frame'
+            answer = result.split()
+            if answer[:1] != ['OK']:
+                return False
+            protocol = 'form'
+            if 'frame' in answer[1:] and 'frame' in _offered:
+                protocol = 'frame'
+            _protocols[(self.ip, str(self.port))] = protocol
+            return True
+        return self._command(values, parse)
+    
+    def stats(self):
+        """
+        Get the counters of the commands the storage has executed.
+
+        @return: The pid of the worker answering, the uptime and number
+        of workers of the storage and by command the count, errors,
+        seconds, db_seconds, bytes_in, bytes_out, a latency histogram
+        and p50_ms and p99_ms read from it
+        @rtype: dict
+        """
+        values = {'cmd' : 'stats'}
+
+        def parse(result):
+            if not result.startswith('{'):
+                raise NodeError("Node '%s' doesn't keep stats" % self)
+            return json.loads(result)
+        return self._command(values, parse)
+
+    def ring(self):
+        """
+        Get the ring membership the storage was last sent (see
+        membership).
+
+        @return: The membership, None if the storage hasn't got any
+        @rtype: dict
+        """
+        values = {'cmd' : 'ring'}
+
+        def parse(result):
+            if result == 'NONE':
+                return None
+            if not result.startswith('{'):
+                raise NodeError("Node '%s' doesn't keep the ring" % self)
+            return json.loads(result)
+        return self._command(values, parse)
+
+    def bloom(self, version=None, delta=False):
+        """
+        Get the Bloom filter of the keys the storage has (see
+        BloomFilters).
+
+        @param version: The version of the filter the client has, the
+        storage only sends it if it has changed
+        @type version: str
+
+        @param delta: Take only the positions set since the version,
+        if the storage still has them
+        @type delta: bool
+
+        @return: The version, the bits and the number of hashes of the
+        filter and its data (or the list of the positions set since),
+        None if it hasn't changed
+        @rtype: tuple
+
+        @raise NodeError: If the storage doesn't keep a filter
+        """
+        values = {'cmd' : 'bloom',
+                  'version' : version or ''}
+        if delta:
+            values['delta'] = '1'
+
+        def parse(result):
+            if result == 'SAME':
+                return None
+            line, data = (result.split('\n', 1) + [''])[:2]
+            if line.startswith('DELTA '):
+                data = list(struct.unpack('!%dI' % (len(data) / 4), data))
+            elif not line.startswith('BLOOM '):
+                raise NodeError("Node '%s' doesn't keep a Bloom filter" % self)
+            version, bits, hashes = line.split()[1:]
+            return version, int(bits), int(hashes), data
+        return self._command(values, parse)
+
+    def digests(self, from_id, to_id, prefixes):
+        """
+        Get digests of the records the storage has in a range: the
+        nodes of a Merkle tree over the hashes, the root first and 16
+        children to every node. Storages compare them before a transfer
+        to find what differs (see steal_range).
+
+        @param from_id: First hash of the range
+        @type from_id: long
+
+        @param to_id: Hash the range ends before (2**MAXIMUM_BIT for
+        the end of the ring)
+        @type to_id: long
+
+        @param prefixes: The nodes of the tree, as the hex digits the
+        hashes under them start with ('' for the root)
+        @type prefixes: list
+
+        @return: The SHA-1 digests by prefix
+        @rtype: dict
+
+        @raise NodeError: If the storage doesn't keep digests
+        """
+        values = {'cmd' : 'digest',
+                  'from_key_id' : from_id,
+                  'to_key_id' : to_id,
+                  'prefix' : prefixes}
+
+        def parse(result):
+            if not result.startswith('{'):
+                raise NodeError("Node '%s' doesn't keep digests" % self)
+            return dict([(str(prefix), str(digest).decode('hex'))
+                         for prefix, digest in json.loads(result).items()])
+        return self._command(values, parse)
+
+    def hashes(self, ranges):
+        """
+        Get the SHA-1 of every record the storage has in ranges, of
+        the packed key followed by the serialized value.
+
+        @param ranges: Tuples of the first hash of a range and the hash
+        it ends before
+        @type ranges: list
+
+        @return: The digests by packed key (see _pack_key)
+        @rtype: dict
+
+        @raise NodeError: If the storage can't hash its records
+        """
+        values = {'cmd' : 'hashes',
+                  'from_key_id' : [from_id for from_id, to_id in ranges],
+                  'to_key_id' : [to_id for from_id, to_id in ranges]}
+
+        def parse(result):
+            line, data = (result.split('\n', 1) + [''])[:2]
+            if not line.startswith('HASHES '):
+                raise NodeError("Node '%s' can't hash its records" % self)
+            size = KEY_BYTES + 20
+            return dict([(data[start:start + KEY_BYTES], data[start + KEY_BYTES:start + size])
+                         for start in xrange(0, len(data), size)])
+        return self._command(values, parse)
+
+    def publish_ring(self, membership):
+        """
+        Send the ring membership to the storage so clients can attach
+        to the ring through it (see attach). A storage keeps the
+        membership with the highest epoch.
+
+        @param membership: The membership encoded as JSON
+        @type membership: str
+        """
+        values = {'cmd' : 'ring',
+                  'membership' : membership}
+
+        def parse(result):
+            if result.startswith('STALE'):
+                raise NodeError("Node '%s' has the newer ring epoch %s" % (self, result.split()[1]))
+            if result != "OK":
+                raise NodeError("Could not send the ring to '%s'" % self)
+        return self._command(values, parse)
+
+    def __setitem__(self, key, value):
+        """
+        Set an item in the storage
+        
+        @param key: Hashed key to set
+        @type key: long
+
+        @param key: Hashed key to set
+        @type key: long
+
+        @param key: Serialized data to set
+        @type key: str
+        """
+        if self._protocol() == 'frame':
+            return self._frames(FRAME_SET, [key], [value], lambda answers: None)
+
+        values = {'cmd' : 'set',
+                  'key' : '%s' % key,
+                  'value' : '%s' % value }
+
+        def parse(result):
+            if result != "OK":
+                raise ValueError ("Could not set value in storage")
+        return self._command(values, parse)
+
+    def __getitem__(self, key):
+        """
+        Get an item from the storage
+
+        @param key: Hashed key to set
+        @type key: long
+        """
+        if self._protocol() == 'frame':
+            def parse_answers(answers):
+                if answers[0] is MISSING:
+                    raise KeyError(key)
+                return answers[0]
+            return self._frames(FRAME_GET, [key], None, parse_answers)
+
+        values = {'cmd' : 'get',
+                  'key' : '%s' % key }
+
+        def parse(result):
+            if result and result != 'NO DATA':
+                return result
+
+            elif not result:
+                raise NodeError("Node isn't responding (has it gone down?)")
+            else:
+                raise KeyError(key)
+        return self._command(values, parse)
+
+    def get_many(self, keys):
+        """
+        Get several items from the storage in one request
+
+        @param keys: Hashed keys to get
+        @type keys: list
+
+        @return: The serialized values in the same order as the keys
+        (MISSING for keys without a value)
+        @rtype: list
+        """
+        if self._protocol() == 'frame':
+            return self._frames(FRAME_GET, keys, None, lambda answers: answers)
+
+        values = {'cmd' : 'mget',
+                  'key' : ['%s' % key for key in keys]}
+
+        def parse(result):
+            if not result:
+                raise NodeError("Node isn't responding (has it gone down?)")
+            return _parse_records(result)
+        return self._command(values, parse)
+
+    def set_many(self, keys, values):
+        """
+        Set several items in the storage in one request
+
+        @param keys: Hashed keys to set
+        @type keys: list
+
+        @param values: Serialized data to set (same order as the keys)
+        @type values: list
+
+        @return: The manifests of the chunked values replaced (see
+        _manifest), None for the other keys, in the same order
+        @rtype: list
+        """
+        if self._protocol() == 'frame':
+            return self._frames(FRAME_SET, keys, values, _replaced_manifests)
+
+        values = {'cmd' : 'mset',
+                  'key' : ['%s' % key for key in keys],
+                  'value' : ['%s' % value for value in values],
+                  'replaced' : '1'}
+
+        def parse(result):
+            if result == "OK":
+                # A storage that doesn't tell
+                return [None] * len(keys)
+            try:
+                return _replaced_manifests(_parse_records(result))
+            except ValueError:
+                raise ValueError ("Could not set values in storage")
+        return self._command(values, parse)
+
+    def delete_many(self, keys):
+        """
+        Delete several items from the storage in one request. Keys
+        without a value are ignored.
+
+        @param keys: Hashed keys to delete
+        @type keys: list
+
+        @return: The manifests of the chunked values deleted (see
+        _manifest), None for the other keys, in the same order
+        @rtype: list
+        """
+        if self._protocol() == 'frame':
+            return self._frames(FRAME_DELETE, keys, None, _replaced_manifests)
+
+        values = {'cmd' : 'mdelete',
+                  'key' : ['%s' % key for key in keys],
+                  'replaced' : '1'}
+
+        def parse(result):
+            if result == "OK":
+                # A storage that doesn't tell
+                return [None] * len(keys)
+            try:
+                return _replaced_manifests(_parse_records(result))
+            except ValueError:
+                raise NodeError("Could not delete values in '%s'" % self)
+        return self._command(values, parse)
+
+    def atomic(self, command, keys, values, versions=None, written=False):
+        """
+        Change several items in the storage in one request, each read,
+        changed and written atomically by the storage (see the 'cas',
+        'incr' and 'append' commands of the storage).
+
+        @param command: 'cas', 'incr' or 'append'
+        @type command: str
+
+        @param keys: Hashed keys to change
+        @type keys: list
+
+        @param values: Serialized values to set if the version matches
+        (cas), numbers to add (incr) or serialized items to append
+        (append), in the same order as the keys
+        @type values: list
+
+        @param versions: The versions the values must have for cas (see
+        _version), None for keys that must be missing
+        @type versions: list
+
+        @param written: Answer the serialized values written instead of
+        empty strings
+        @type written: bool
+
+        @return: For every key the value written (or an empty string)
+        and MISSING for a cas that didn't match
+        @rtype: list
+        """
+        values = {'cmd' : command,
+                  'key' : ['%s' % key for key in keys],
+                  'value' : ['%s' % value for value in values]}
+        if versions is not None:
+            values['version'] = [version or '' for version in versions]
+        if written:
+            values['written'] = '1'
+
+        def parse(result):
+            if result == 'WRONG TYPE':
+                raise TypeError("A value can't be changed by '%s'" % command)
+            if result in ('FAILURE', 'UNKNOWN COMMAND') or not result and keys:
+                raise NodeError("Could not execute '%s' in '%s'" % (command, self))
+            return _parse_records(result)
+        return self._command(values, parse)
+
+    def __repr__(self):
+        """
+        Makes it simple to print out a Node.
+        """
+        return "<Node '%s', port '%s'>" % (self.key_id, self.port)
+
+def _pack_key(key):
+    """
+    Pack a hashed key into KEY_BYTES big-endian bytes. Packed keys
+    sort in the same order as the hashes themselves.
+
+    @param key: A hashed key
+    @type key: long
+
+    @rtype: str
+    """
+    return ('%0*x' % (KEY_BYTES * 2, key)).decode('hex')
+
+def _unpack_key(data):
+    """
+    Unpack a key packed by _pack_key.
+
+    @param data: A packed key
+    @type data: str
+
+    @rtype: long
+    """
+    return long(data.encode('hex'), 16)
+
+def _pack_records(records):
+    """
+    Pack key/value records for a storage to storage transfer. Each
+    record is the packed key, the length of the value (4 bytes,
+    big-endian) and the value itself. A deleted key is written with
+    DELETED_LENGTH and no value.
+
+    @param records: Tuples of a packed key and a serialized value (None
+    for a deleted key)
+    @type records: list
+
+    @rtype: str
+    """
+    parts = []
+    for key, value in records:
+        parts.append(key)
+        if value is None:
+            parts.append(struct.pack('!I', DELETED_LENGTH))
+            continue
+        parts.append(struct.pack('!I', len(value)))
+        parts.append(value)
+    return ''.join(parts)
+
+def _unpack_records(data):
+    """
+    Unpack records packed by _pack_records.
+
+    @param data: Packed records
+    @type data: str
+
+    @return: Tuples of a packed key and a serialized value (None for
+    a deleted key)
+    @rtype: list
+    """
+    records = []
+    position = 0
+    while position < len(data):
+        key = data[position:position + KEY_BYTES]
+        length, = struct.unpack('!I', data[position + KEY_BYTES:position + KEY_BYTES + 4])
+        position += KEY_BYTES + 4
+        if length == DELETED_LENGTH:
+            records.append((key, None))
+            continue
+        records.append((key, data[position:position + length]))
+        position += length
+    return records
+
+def _pack_block(kind, data):
+    """
+    Pack a block of a snapshot (see _BLOCK).
+
+    @param kind: 'H', 'R' or 'E'
+    @type kind: str
+
+    @rtype: str
+    """
+    return _BLOCK.pack(kind, len(data)) + data
+
+def _read_blocks(stream):
+    """
+    Read the blocks of a snapshot up to its end block.
+
+    @param stream: A file, a socket file or an HTTP response with the
+    snapshot
+    @type stream: file
+
+    @return: Tuples of the kind and the data of each block
+    @rtype: iterator
+    """
+    head = stream.read(_BLOCK.size)
+    if not head.startswith('H'):
+        # An answer like 'BUSY' or 'TOO OLD' instead of a snapshot
+        raise NodeError("Not a snapshot: '%s'" % (head + stream.read(100)).strip())
+    while len(head) == _BLOCK.size:
+        kind, length = _BLOCK.unpack(head)
+        data = stream.read(length)
+        if len(data) != length:
+            break
+        yield kind, data
+        if kind == 'E':
+            return
+        head = stream.read(_BLOCK.size)
+    raise NodeError("The snapshot is cut short")
+
+def _format_records(values):
+    """
+    Format the values of a batch response. Each value is written as
+    its length, a newline and the value itself. A missing value is
+    written as the length -1.
+
+    @param values: Values or None for missing values
+    @type values: list
+
+    @rtype: str
+    """
+    parts = []
+    for value in values:
+        if value is None:
+            parts.append('-1\n')
+        else:
+            parts.append('%d\n' % len(value))
+            parts.append(value)
+    return ''.join(parts)
+
+def _pack_frames(command, keys, values=None):
+    """
+    Pack a data command as binary frames, one frame per key. Each
+    frame is the command (1 byte), the packed key (KEY_BYTES), the
+    length of the value (4 bytes, big-endian) and the value itself,
+    raw. Frames of commands without values have an empty value.
+
+    @param command: FRAME_GET, FRAME_SET or FRAME_DELETE
+    @type command: int
+
+    @param keys: Hashed keys
+    @type keys: list
+
+    @param values: Serialized values (same order as the keys) or None
+    @type values: list
+
+    @rtype: str
+    """
+    parts = []
+    if values is None:
+        for key in keys:
+            parts.append(_FRAME.pack(command, _pack_key(key), 0))
     else:
-        current_index = 0
-        for current_node in _node_list:
-            if node.key_id < current_node.key_id:
-                node.next = current_node
-                if current_index == 0:
-                    # We are inserting the node as the new first
-                    # element in the list
-
-                    # Point the last node in the finger list to the
-                    # node being inserted
-                    _node_list[len(_node_list)-1].next = node
-                    
-                    # Steal hash:es in the first node to the new first
-                    # node
-                    node.steal_range(_node_list[len(_node_list)-1], node.key_id, _node_list[0].key_id)
-                else:
-                    # We are inserting the node at a regular interval
-                    # in the list
-
-                    # Point latest node to current node being inserted
-                    _node_list[current_index-1].next = node
-                    
-                    # Steal hash:es from the previous node to the new
-                    # node (to the maximum amount)
-                    node.steal_range(_node_list[current_index-1], node.key_id, 2**MAXIMUM_BIT)
-                    
-                _node_list.insert(current_index, node)
+        for key, value in zip(keys, values):
+            parts.append(_FRAME.pack(command, _pack_key(key), len(value)))
+            parts.append(value)
+    return ''.join(parts)
+
+def _unpack_frames(data):
+    """
+    Unpack frames packed by _pack_frames.
+
+    @param data: Packed frames
+    @type data: str
+
+    @return: Tuples of the command, the packed key and the value
+    @rtype: list
+    """
+    frames = []
+    position = 0
+    while position < len(data):
+        command, key, length = _FRAME.unpack_from(data, position)
+        position += _FRAME.size
+        frames.append((command, key, data[position:position + length]))
+        position += length
+    return frames
+
+def _pack_answers(values):
+    """
+    Pack the answers to frames, one for each frame. Each answer is the
+    status (1 byte), the length of the value (4 bytes, big-endian) and
+    the value itself.
+
+    @param values: Values, '' for frames without a value to answer and
+    None for missing values
+    @type values: list
+
+    @return: The parts of the answers (the values aren't copied)
+    @rtype: list
+    """
+    parts = []
+    for value in values:
+        if value is None:
+            parts.append(_ANSWER.pack(FRAME_MISSING, 0))
+        else:
+            parts.append(_ANSWER.pack(FRAME_OK, len(value)))
+            parts.append(value)
+    return parts
+
+def _unpack_answers(data):
+    """
+    Unpack answers packed by _pack_answers.
+
+    @param data: The response
+    @type data: str
+
+    @return: The values (MISSING for missing values)
+    @rtype: list
+    """
+    values = []
+    position = 0
+    while position < len(data):
+        status, length = _ANSWER.unpack_from(data, position)
+        position += _ANSWER.size
+        if status == FRAME_MISSING:
+            values.append(MISSING)
+        else:
+            values.append(data[position:position + length])
+            position += length
+    return values
+
+def _parse_records(data):
+    """
+    Parse a batch response made by _format_records.
+
+    @param data: The response
+    @type data: str
+
+    @return: The values (MISSING for missing values)
+    @rtype: list
+    """
+    values = []
+    position = 0
+    while position < len(data):
+        newline = data.index('\n', position)
+        length = int(data[position:newline])
+        position = newline + 1
+        if length < 0:
+            values.append(MISSING)
+        else:
+            values.append(data[position:position + length])
+            position += length
+    return values
+
+def _format_address(node):
+    """
+    Format the address of a node the way it is sent between storages.
+
+    @param node: A node
+    @type node: Node
+
+    @return: 'ip:port'
+    @rtype: str
+    """
+    return '%s:%s' % (node.ip, node.port)
+
+def _parse_address(address):
+    """
+    Create a node from an address made by _format_address.
+
+    @param address: 'ip:port'
+    @type address: str
+
+    @rtype: Node
+    """
+    ip, port = address.rsplit(':', 1)
+    return Node(ip, port)
+
+def _format_position(node):
+    """
+    Format the address and the key_id of a position in the ring (see
+    Node.positions). The key_id is left out for the first position of
+    a node, like the nodes of older versions of the sdht.
+
+    @param node: A position in the ring
+    @type node: Node
+
+    @return: 'ip:port' or 'ip:port@key_id'
+    @rtype: str
+    """
+    address = _format_address(node)
+    if node.key_id == Node(node.ip, node.port).key_id:
+        return address
+    return '%s@%s' % (address, node.key_id)
+
+def _parse_position(position):
+    """
+    Create a node from a position made by _format_position.
+
+    @param position: 'ip:port' or 'ip:port@key_id'
+    @type position: str
+
+    @rtype: Node
+    """
+    address, at, key_id = position.partition('@')
+    node = _parse_address(address)
+    if key_id:
+        node.key_id = long(key_id)
+    return node
+
+# This is a clockwise ring distance function.
+#
+def distance(a, b):
+    """
+    Lets determine the distance between two hashes.
+
+    If the same hash value the result is 0
+
+    If a has a hash value less then b then return b - a (a positive value)
+
+    Else add the maximum hash to b - a (we have passed by the last
+    element and we want to get the distance above it).
+    
+    @param a: A hashed value to compare
+    @type a: long
+
+    @param b: A hashed value to compare
+    @type b: long
+
+    @return: The clockwise distance from a to b
+    @rtype: long
+    
+    """
+    if a == b:
+        return 0
+    elif a < b:
+        return b - a
+    else:
+        # We have wrapped around the ring, the distance is the maximum
+        # hash + the (negative) distance between the hashes.
+        #
+        return (2**MAXIMUM_BIT) + (b - a)
+
+
+def find_node(start, key):
+    """
+    From the start node, find the node responsible for the target key
+
+    The responsible node is the one with the highest key_id that is
+    still less or equal to the hashed key. If no such node exists the
+    key has wrapped around the ring and belongs to the last node.
+
+    Instead of wandering the nodes one at a time (which used to make
+    every lookup linear in the size of the ring) the sorted _ring_ids
+    index is searched with a binary search. The start node is kept for
+    backward compatibility, every node in the ring gives the same
+    answer.
+
+    While a joining node steals its hashes the node they are stolen
+    from (the source of the joining node) is returned instead. It
+    serves the hashes that are left and forwards the ones already
+    moved.
+    
+    @param start: A starting node that we check if it is the correct
+    node for this hashed key
+    @type start: Node
+
+    @param key: A hashed key that we want to find the correct node for
+    @type key: long
+
+    @return the node for where this key belongs to
+    @rtype: Node
+    """
+    if len(_node_list) < 2:
+        return start
+    node = _node_list[bisect.bisect_right(_ring_ids, key) - 1]
+    return node.source or node
+
+def route(start, key):
+    """
+    Find the node responsible for a hashed key by following the finger
+    tables of the storages, starting at any node in the ring.
+
+    Each hop at least halves the distance to the key so the owner is
+    found in O(log n) hops without knowing the rest of the ring.
+
+    @param start: Any node in the ring
+    @type start: Node
+
+    @param key: A hashed key that we want to find the correct node for
+    @type key: long
+
+    @return the node for where this key belongs to
+    @rtype: Node
+    """
+    node = start
+    for hop in xrange(MAXIMUM_BIT):
+        owner, node = node.find_successor(key)
+        if owner:
+            return node
+    raise NodeError("Could not route key '%s' from '%s'" % (key, start))
+
+def _owner(key):
+    """
+    Find the node responsible for a hashed key. Uses the local ring if
+    nodes have joined it, otherwise routes from the entry node.
+
+    @param key: A hashed key that we want to find the correct node for
+    @type key: long
+
+    @rtype: Node
+    """
+    if _node_list:
+        return find_node(_node_list[0], key)
+    elif _entry is not None:
+        return route(_entry, key)
+    raise NodeError("No nodes have joined the ring")
+
+def _group(hashed_keys):
+    """
+    Group hashed keys by the node responsible for them.
+
+    @param hashed_keys: Hashed keys
+    @type hashed_keys: list
+
+    @return: Tuples of a node and the positions of its keys in
+    hashed_keys
+    @rtype: list
+    """
+    return _group_owners([_owner(key) for key in hashed_keys])
+
+def _group_owners(owners):
+    """
+    Group the positions of keys by the node responsible for them.
+
+    Nodes are told apart by their address since route answers with a
+    new Node for every key.
+
+    @param owners: The node responsible for each key
+    @type owners: list
+
+    @return: Tuples of a node and the positions of its keys
+    @rtype: list
+    """
+    groups = {}
+    order = []
+    for position, node in enumerate(owners):
+        address = _format_address(node)
+        if address not in groups:
+            groups[address] = (node, [])
+            order.append(address)
+        groups[address][1].append(position)
+    return [groups[address] for address in order]
+
+def _lookup(key):
+    """
+    Find the responsible nodes and get the value for the key
+
+    @param key: A hashed key that we want to get the value for
+    @type key: long
+
+    @return: The value in a node
+    @return: str
+    """
+    nodes, extras = _replicas_of(key)
+    return _read(nodes, lambda node: node[key])
+
+def _store(key, value):
+    """
+    Find the responsible nodes and store the value with the key
+
+    @param key: A hashed key that we want to set the value for
+    @type key: long
+
+    @param key: A serialized value we want to set in a storage
+    @type key: str
+
+    @return: What the replicas answered (see _replaced)
+    @rtype: list
+    """
+    nodes, extras = _replicas_of(key)
+    _bloom_wrote(nodes + extras, [key])
+    return _write(nodes, extras, lambda node: node.set_many([key], [value]))
+
+def _bloom_missing(key):
+    """
+    Check a hashed key in the Bloom filters of its replicas (see
+    enable_bloom_filters). They aren't used while the ring changes.
+
+    @type key: long
+
+    @return: True if the key has no value for sure, False if it may
+    have one and None if there are no filters to tell
+    @rtype: bool
+    """
+    blooms = _blooms
+    if blooms is None or not _node_list or _rebalancing is not None:
+        return None
+    nodes, extras = _replicas_of(key)
+    return blooms.missing(nodes, _pack_key(key))
+
+def _bloom_wrote(nodes, keys):
+    """
+    Add hashed keys written to the Bloom filters of the nodes.
+    """
+    blooms = _blooms
+    if blooms is not None:
+        blooms.wrote(nodes, [_pack_key(key) for key in keys])
+
+def _bloom_missed(told):
+    """
+    Count a key that turned out to be missing, if the Bloom filters
+    told it may have a value (see _bloom_missing).
+    """
+    blooms = _blooms
+    if told is False and blooms is not None:
+        blooms.false_positive()
+
+def _ring_replicas(nodes, ids, key):
+    """
+    Find the replicas of a hashed key in a ring: the node owning it
+    and the nodes of the next positions, skipping positions of the
+    storages already found.
+
+    @param nodes: The positions of the ring, in ring order
+    @type nodes: list
+
+    @param ids: The key_id:s of the positions
+    @type ids: list
+
+    @param key: A hashed key
+    @type key: long
+
+    @return: Up to REPLICAS nodes, the owner first
+    @rtype: list
+    """
+    replicas = []
+    addresses = []
+    index = bisect.bisect_right(ids, key) - 1
+    for step in xrange(len(nodes)):
+        node = nodes[(index + step) % len(nodes)]
+        address = _format_address(node)
+        if address not in addresses:
+            addresses.append(address)
+            replicas.append(node)
+            if len(replicas) == _replicas:
                 break
-            
-            current_index += 1
+    return replicas
+
+def _replicas_of(key):
+    """
+    Find the nodes a hashed key is kept on. Without replicas (or a
+    local ring) this is just the owner.
+
+    While join or remove moves the data the key is read from the
+    replicas of the ring as it was and also written to the nodes that
+    become replicas of it (the data they get from the others is
+    already written there too).
+
+    @param key: A hashed key
+    @type key: long
+
+    @return: The nodes to read the key from and write it to (the owner
+    first) and the nodes it is also written to
+    @rtype: tuple
+    """
+    if _replicas == 1 or not _node_list:
+        return [_owner(key)], []
+    if _rebalancing is None:
+        return _ring_replicas(_node_list, _ring_ids, key), []
+    (old_nodes, old_ids), (new_nodes, new_ids) = _rebalancing
+    nodes = _ring_replicas(old_nodes, old_ids, key)
+    addresses = [_format_address(node) for node in nodes]
+    return nodes, [node for node in _ring_replicas(new_nodes, new_ids, key)
+                   if _format_address(node) not in addresses]
+
+def _group_replicas(hashed_keys):
+    """
+    Group hashed keys by the nodes they are kept on (see _replicas_of).
+
+    @param hashed_keys: Hashed keys
+    @type hashed_keys: list
+
+    @return: Tuples of the replicas, the extra nodes written to and
+    the positions of the keys in hashed_keys
+    @rtype: list
+    """
+    if _replicas == 1 or not _node_list:
+        return [([node], [], positions) for node, positions in _group(hashed_keys)]
+    groups = {}
+    order = []
+    for position, key in enumerate(hashed_keys):
+        nodes, extras = _replicas_of(key)
+        name = (tuple(sorted([_format_address(node) for node in nodes])),
+                tuple(sorted([_format_address(node) for node in extras])))
+        if name not in groups:
+            groups[name] = (nodes, extras, [])
+            order.append(name)
+        groups[name][2].append(position)
+    return [groups[name] for name in order]
+
+def _timed(node, call):
+    """
+    Send a request to a node and record its latency (see
+    LatencyTracker). A KeyError is an answer too.
+
+    @param call: Sends the request to the node given to it
+    @type call: callable
+
+    @return: What call returns
+    """
+    address = _format_address(node)
+    began = time.time()
+    try:
+        result = call(node)
+    except KeyError:
+        _latencies.record(address, time.time() - began)
+        raise
+    except Exception:
+        _latencies.failed(address)
+        raise
+    _latencies.record(address, time.time() - began)
+    return result
+
+def _ask(node, call, answers):
+    """
+    Send a request in a replica thread and put the node, the result
+    and the error (None if there is none) in the answers queue.
+    """
+    try:
+        answers.put((node, _timed(node, call), None))
+    except Exception, e:
+        answers.put((node, None, e))
+
+def _read(nodes, call):
+    """
+    Read from the replica with the lowest latency. If it hasn't
+    answered by the hedge percentile of its latencies (see
+    configure_replication) the next replica is asked as well and the
+    first answer is used. Replicas that fail are skipped.
+
+    @param nodes: The replicas
+    @type nodes: list
+
+    @param call: Sends the read to the node given to it
+    @type call: callable
+
+    @return: What call returns for the first replica answering
+    """
+    nodes = _healthy_first(_latencies.rank(nodes))
+    if len(nodes) == 1:
+        return _timed(nodes[0], call)
+
+    answers = Queue.Queue()
+    waiting = nodes[1:]
+    _submit(_ask, nodes[0], call, answers)
+    asked = outstanding = 1
+    hedge = None
+    if _hedge_percentile is not None:
+        delay = _latencies.percentile(_format_address(nodes[0]), _hedge_percentile)
+        if delay is not None:
+            hedge = time.time() + delay
+
+    errors = []
+    while True:
+        if hedge is not None and asked == 1 and outstanding and waiting:
+            try:
+                node, result, error = answers.get(timeout=max(0.0, hedge - time.time()))
+            except Queue.Empty:
+                # The first replica is late, hedge
+                _submit(_ask, waiting.pop(0), call, answers)
+                asked += 1
+                outstanding += 1
+                continue
+        else:
+            node, result, error = answers.get()
+
+        outstanding -= 1
+        if error is None:
+            return result
+        elif isinstance(error, KeyError):
+            raise error
+        errors.append(error)
+        if waiting:
+            _submit(_ask, waiting.pop(0), call, answers)
+            asked += 1
+            outstanding += 1
+        elif not outstanding:
+            raise errors[0]
+
+def _write_error(replicas, needed, errors):
+    """
+    @return: The error of a write too many replicas failed
+    @rtype: NodeError
+    """
+    return NodeError("%d of %d replicas failed a write needing %d acknowledgements (%s)" % (
+        len(errors), replicas, needed, errors[0]))
+
+def _write(nodes, extras, call):
+    """
+    Write to every replica at once and wait for the acknowledgements
+    needed (see configure_replication). The extra nodes are written
+    after all the replicas have answered.
+
+    @param nodes: The replicas
+    @type nodes: list
+
+    @param extras: Nodes becoming replicas while join or remove moves
+    the data (see _replicas_of)
+    @type extras: list
+
+    @param call: Sends the write to the node given to it
+    @type call: callable
+
+    @return: What the nodes that acknowledged the write answered
+    @rtype: list
+    """
+    if len(nodes) == 1 and not extras:
+        return [_timed(nodes[0], call)]
+
+    needed = min(_write_acks or len(nodes), len(nodes))
+    answers = Queue.Queue()
+    for node in nodes:
+        _submit(_ask, node, call, answers)
+    results = []
+    errors = []
+    for answer in xrange(len(nodes)):
+        node, result, error = answers.get()
+        if error is None:
+            results.append(result)
+        else:
+            errors.append(error)
+        if not extras and (len(results) >= needed or len(nodes) - len(errors) < needed):
+            break
+    if len(results) < needed:
+        raise _write_error(len(nodes), needed, errors)
+    for node in extras:
+        results.append(_timed(node, call))
+    return results
+
+
+# Instead of using a previous pointer a _node_list is used to assisst
+# for this purpose. Useally these shouldn't mixed up but the next
+# pointer simplifies the lookup algorithm while the _node_list assists
+# with the joining and removing of nodes. Maybe this should be
+# re-written for clarity, but I didn't have any trouble reading the
+# code still.
+#
+_node_list = []
+
+# Sorted key_id:s of the nodes in _node_list (same order). This is the
+# index find_node uses to binary search the ring instead of following
+# the next pointers one hop at a time. Only _link and _unlink should
+# change it.
+#
+_ring_ids = []
+
+# A node of an existing ring that is used to route keys when no nodes
+# have joined the local ring (see set_entry).
+#
+_entry = None
+
+# The epoch of the ring membership this client has (see membership),
+# and the newer epoch and the address of the storage that answered
+# with it (see _saw_epoch) until the ring is refreshed. The epoch grows
+# with every join and remove.
+#
+_epoch = 0
+_newer = None
+
+# The positions and key_id:s of the ring before and after the change
+# join or remove is making, while they move the data of the replicas
+# (see _replicas_of). None the rest of the time.
+#
+_rebalancing = None
+
+def _link(node):
+    """
+    Insert a node in the ring index and update the next pointers
+    around it. No data is moved.
+
+    @param node: A node we want to add to the ring
+    @type node: Node
+
+    @return: The index the node got in the ring
+    @rtype: int
+    """
+    index = bisect.bisect_left(_ring_ids, node.key_id)
+    _ring_ids.insert(index, node.key_id)
+    _node_list.insert(index, node)
+    if len(_node_list) > 1:
+        _node_list[index-1].next = node
+        node.next = _node_list[(index+1) % len(_node_list)]
+    return index
+
+def _unlink(node):
+    """
+    Remove a node from the ring index and update the next pointers
+    around it. No data is moved.
+
+    @param node: A node we want to remove from the ring
+    @type node: Node
+
+    @return: The node that now owns the removed node's hashes (None if
+    the ring became empty)
+    @rtype: Node
+    """
+    index = _index(node)
+    previous = _node_list[index-1]
+    del _ring_ids[index]
+    del _node_list[index]
+    if len(_node_list) == 0:
+        return None
+    elif len(_node_list) == 1:
+        previous.next = None
+    else:
+        previous.next = node.next
+    node.next = None
+    return previous
+
+def _between(a, b):
+    """
+    Find the nodes with a key_id from a up to (but not including) b
+    going clockwise around the ring.
+
+    @param a: Starting hash (may be outside the ring, it is wrapped)
+    @type a: long
+
+    @param b: Ending hash (may be outside the ring, it is wrapped)
+    @type b: long
+
+    @rtype: list
+    """
+    a %= 2**MAXIMUM_BIT
+    b %= 2**MAXIMUM_BIT
+    first = bisect.bisect_left(_ring_ids, a)
+    last = bisect.bisect_left(_ring_ids, b)
+    if a <= b:
+        return _node_list[first:last]
+    return _node_list[first:] + _node_list[:last]
+
+def _fix_fingers(node, owner):
+    """
+    Point every finger whose target lies between node and the next
+    node of owner at owner.
+
+    Called after node has been linked (owner is the node itself, which
+    also gets a fresh finger table) or unlinked (owner is the node
+    that took over its hashes). Only the fingers targeting the changed
+    range are touched, like in Chord.
+
+    @param node: The node that was linked or unlinked
+    @type node: Node
+
+    @param owner: The node now responsible for the range of node
+    @type owner: Node
+
+    @return: The nodes whose finger tables changed
+    @rtype: list
+    """
+    if owner.next is None:
+        owner.fingers = [owner] * MAXIMUM_BIT
+        return [owner]
+
+    changed = []
+    if owner is node:
+        node.fingers = [find_node(node, (node.key_id + 2**i) % 2**MAXIMUM_BIT)
+                        for i in xrange(MAXIMUM_BIT)]
+        changed.append(node)
+
+    end = owner.next.key_id
+    for i in xrange(MAXIMUM_BIT):
+        for other in _between(node.key_id - 2**i, end - 2**i):
+            if other.fingers and other.fingers[i] is not owner:
+                other.fingers[i] = owner
+                if other not in changed:
+                    changed.append(other)
+    return changed
+
+def _publish(nodes):
+    """
+    Send the finger tables of nodes to their storages, one request per
+    storage.
+
+    @param nodes: Nodes (positions) whose routing changed
+    @type nodes: list
+    """
+    for node, positions in _by_storage(nodes):
+        node.publish_fingers(positions)
+
+def membership():
+    """
+    The membership of the ring: its epoch, the virtual nodes and the
+    address and weight of every storage. Enough to rebuild the ring
+    without moving any data (see attach).
+
+    @rtype: dict
+    """
+    return {'epoch': _epoch,
+            'virtual_nodes': VIRTUAL_NODES,
+            'nodes': [[node.ip, node.port, node.weight] for node, positions in _by_storage(_node_list)]}
+
+def _next_ring():
+    """
+    Start a new epoch of the ring membership, after join or remove
+    has changed the ring.
+
+    @return: The membership encoded as JSON
+    @rtype: str
+    """
+    global _epoch, _newer
+    _epoch = max(_epoch, _newer and _newer[0] or 0) + 1
+    _newer = None
+    return json.dumps(membership())
+
+def _publish_ring():
+    """
+    Send a new epoch of the ring membership to every storage in the
+    ring.
+    """
+    data = _next_ring()
+    for node, positions in _by_storage(_node_list):
+        node.publish_ring(data)
+
+def save_ring(path):
+    """
+    Save the ring membership to a file (see load_ring).
+
+    @param path: The file to write, replaced atomically
+    @type path: str
+    """
+    temporary = '%s.%d.tmp' % (path, os.getpid())
+    with open(temporary, 'w') as stream:
+        json.dump(membership(), stream)
+    os.rename(temporary, path)
+
+def load_ring(path):
+    """
+    Attach to the ring saved to a file (see save_ring). The ring is
+    refreshed from the storages once they answer with a newer epoch.
+
+    @param path: A file written by save_ring
+    @type path: str
+    """
+    with open(path) as stream:
+        _attach(json.load(stream))
+
+def attach(node):
+    """
+    Attach to the existing ring a storage belongs to, with the
+    membership the last join or remove sent it. Nothing is moved, the
+    ring is just rebuilt locally (see membership). Later changes are
+    picked up lazily: every storage answers with the epoch it has and
+    a newer one makes the next get or set refresh the ring.
+
+    @param node: Any node in the ring
+    @type node: Node
+    """
+    ring = node.ring()
+    if ring is None:
+        raise NodeError("Node '%s' hasn't been sent a ring" % node)
+    _attach(ring)
+
+def _attach(ring):
+    """
+    Replace the local ring with the one of a membership.
+
+    @param ring: The membership (see membership)
+    @type ring: dict
+    """
+    global VIRTUAL_NODES, _epoch, _newer
+    if _rebalancing is not None:
+        raise NodeError("The ring is changing")
+    del _node_list[:]
+    del _ring_ids[:]
+    VIRTUAL_NODES = ring['virtual_nodes']
+    for ip, port, weight in ring['nodes']:
+        for position in Node(str(ip), str(port), weight).positions():
+            _link(position)
+    _epoch = ring['epoch']
+    if _newer is not None and _newer[0] <= _epoch:
+        _newer = None
+    if _cache is not None:
+        _cache.clear()
+    if _blooms is not None:
+        _blooms.clear()
+
+def _saw_epoch(epoch, address):
+    """
+    Note the epoch a storage has answered with, a newer one than the
+    local ring has makes the next get or set refresh the ring (see
+    _refresh_ring).
+
+    @param epoch: The epoch of the storage
+    @type epoch: int
+
+    @param address: The address (ip, port) of the storage
+    @type address: tuple
+    """
+    global _newer
+    if epoch > _epoch and (_newer is None or epoch > _newer[0]):
+        _newer = (epoch, address)
+
+def _refresh_ring():
+    """
+    Fetch the membership from a storage that has answered with a newer
+    epoch than the local ring has. A storage that can't be asked is
+    asked again when an answer tells of the epoch again.
+    """
+    global _newer
+    newer = _newer
+    if newer is None or not _node_list or _rebalancing is not None:
+        return
+    _newer = None
+    try:
+        ring = Node(newer[1][0], str(newer[1][1])).ring()
+    except (NodeError, httplib.HTTPException, socket.error):
+        return
+    if ring is not None and ring['epoch'] > _epoch:
+        _attach(ring)
+
+def _complete_fingers():
+    """
+    Fill in the finger tables of positions linked by _attach, before
+    join or remove changes them.
+    """
+    for node in _node_list:
+        if node.fingers:
+            continue
+        if node.next is None:
+            node.fingers = [node] * MAXIMUM_BIT
+        else:
+            node.fingers = [find_node(node, (node.key_id + 2**i) % 2**MAXIMUM_BIT)
+                            for i in xrange(MAXIMUM_BIT)]
+
+def _by_storage(nodes):
+    """
+    Group positions by their storage.
+
+    @param nodes: Positions in the ring
+    @type nodes: list
+
+    @return: Tuples of the first of the positions of a storage and all
+    of them
+    @rtype: list
+    """
+    return [(nodes[positions[0]], [nodes[position] for position in positions])
+            for node, positions in _group_owners(nodes)]
+
+def _index(node):
+    """
+    Find the index of a node in the ring by its key_id.
+
+    @param node: A node in the ring
+    @type node: Node
+
+    @return: The index of the node
+    @rtype: int
+    """
+    index = bisect.bisect_left(_ring_ids, node.key_id)
+    if index == len(_ring_ids) or _ring_ids[index] != node.key_id:
+        raise ValueError("%s is not in the ring" % node)
+    return index
+
+def _linked(node):
+    """
+    Find the positions of a storage in the ring by its address, so a
+    fresh Node('ip', 'port') can be used to remove it.
+
+    @param node: A node in the ring
+    @type node: Node
+
+    @return: The linked positions in ring order
+    @rtype: list
+    """
+    address = _format_address(node)
+    positions = [other for other in _node_list if _format_address(other) == address]
+    if not positions:
+        raise ValueError("%s is not in the ring" % node)
+    return positions
+
+def _runs(node):
+    """
+    Find the runs of consecutive positions of a storage in the ring.
+    Each run owns the range from its first position up to the next
+    position of another storage, and that range belongs to the
+    position before the run when the storage isn't in the ring.
+
+    @param node: A node whose positions are linked
+    @type node: Node
+
+    @return: Tuples of the position before a run (of another storage)
+    and the range (from_id, to_id) of the run, which may wrap around
+    the ring
+    @rtype: list
+    """
+    address = _format_address(node)
+    mine = [_format_address(other) == address for other in _node_list]
+    if False not in mine:
+        # Only this storage, nothing belongs to anybody else
+        return []
+
+    runs = []
+    count = len(_node_list)
+    for index in xrange(count):
+        if mine[index] and not mine[index-1]:
+            end = index
+            while mine[end % count]:
+                end += 1
+            runs.append((_node_list[index-1], _node_list[index].key_id, _node_list[end % count].key_id))
+    return runs
+
+def _ranges(from_id, to_id):
+    """
+    Split a range that may wrap around the ring into ranges that
+    don't.
+
+    @return: Tuples of from_id and to_id
+    @rtype: list
+    """
+    if from_id < to_id:
+        return [(from_id, to_id)]
+    ranges = [(from_id, 2**MAXIMUM_BIT)]
+    if to_id > 0:
+        ranges.append((0, to_id))
+    return ranges
+
+def remove (node, progress=None):
+    """
+    Remove a node from the ring.
+
+    Please note that is a more official version of de-registration of
+    a node which makes sure that now values is lost from the ring by
+    transfering any removed data to other nodes when one node is
+    removed (unless it is the last node that is).
+
+    The hashes of each position of the removed node are transfered
+    to the previous position (of another node) since that is the node
+    find_node will point them to from now on. The node is kept in the
+    ring until the transfer is done since it keeps serving its hashes
+    (forwarding the ones already moved).
+
+    @param start: A node we want to remove from the ring
+    @type start: Node
+
+    @param progress: Called as progress(source, target, records,
+    bytes) while the data is moved (may be None)
+    @type progress: callable
+
+    @raise NodeError: If a range couldn't be moved. The ranges moved
+    already are moved back and the node stays in the ring.
+    """
+    # Look up the instance that is actually linked in the ring so a
+    # fresh Node('ip', 'port') can be used to remove it.
+    node = _linked(node)[0]
+    _check_storages_health()
+    _complete_fingers()
+    moves = _remove_moves(node)
+    _begin_rebalance(_node_list, _without(node))
+    done = []
+    try:
+        for move in moves:
+            target, source, from_id, to_id, copy = move
+            if not _hand_over(target, source, from_id, to_id, copy, progress):
+                raise _move_error(move)
+            done.append(move)
+        # else: No where transfer the data.
+    except Exception:
+        error = sys.exc_info()
+        _hand_back(done, progress)
+        raise error[0], error[1], error[2]
+    finally:
+        _end_rebalance()
+    _publish(_end_remove(node))
+    _publish_ring()
+
+def _without(node):
+    """
+    @return: The positions of the ring without those of a storage
+    @rtype: list
+    """
+    address = _format_address(node)
+    return [other for other in _node_list if _format_address(other) != address]
+
+def _remove_moves(node):
+    """
+    The data a removed node hands over (see _handovers), or with
+    replicas the data moved to keep every key on its replicas (see
+    _replica_moves).
+
+    @param node: The linked node being removed
+    @type node: Node
+
+    @return: The moves (see _replica_moves)
+    @rtype: list
+    """
+    if _replicas == 1:
+        return [(target, node, from_id, to_id, False) for target, from_id, to_id in _handovers(node)]
+    return _replica_moves(_node_list, _without(node))
+
+def _handovers(node):
+    """
+    The ranges a removed node hands over to the positions before its
+    runs (see _runs).
+
+    @param node: The linked node being removed
+    @type node: Node
+
+    @return: Tuples of the node to hand over to and the range (from_id,
+    to_id) to hand over. If everything goes to one node the range is
+    (None, None) and the whole storage is transfered.
+    @rtype: list
+    """
+    runs = _runs(node)
+    if len(runs) == 1:
+        return [(runs[0][0], None, None)]
+    handovers = []
+    for target, from_id, to_id in runs:
+        for range_from, range_to in _ranges(from_id, to_id):
+            handovers.append((target, range_from, range_to))
+    return handovers
+
+def _end_remove(node):
+    """
+    Unlink the positions of a removed node once its hashes have been
+    transfered and fix the finger tables.
+
+    @return: The nodes whose routing changed (see _publish)
+    @rtype: list
+    """
+    changed = []
+    for position in _linked(node):
+        _drop_cached(position)
+        previous = _unlink(position)
+        if previous is None:
+            return []
+        for other in _fix_fingers(position, previous) + [previous]:
+            if other not in changed:
+                changed.append(other)
+    # Unlinked positions may have changed before they were unlinked
+    return [other for other in changed if _linked_position(other)]
+
+def _linked_position(node):
+    """
+    @return: True if the position is linked in the ring
+    @rtype: bool
+    """
+    index = bisect.bisect_left(_ring_ids, node.key_id)
+    return index < len(_node_list) and _node_list[index] is node
+        
+def join(node, progress=None, since=None, compare=False):
+    """
+    Add a node to the node-ring.
+    
+    Useally nodes are added at the start but if a node is added at a
+    latter state hashes keys and values might need to be moved around
+    a bit. See the following example for how this works.
+    
+    Example of how hashes get stolen:
+    
+    How the recalculations are done.
+    node 1 > 2 3 4 5 6 7
+    node 8 > 8 9 10
+    
+    Get all values from node 1 that are useful to new node 4 and remove them from node 1
+    
+    node 1 > 2 3 
+    node 4 > 4 5 6 7
+    node 8 > 8 9 10
 
-        if current_index == len(_node_list):
-            # Insert the as the last node in the list
-            _node_list[current_index-1].next = node
-            _node_list.append(node)
-            node.next = _node_list[0]
-            
-            # Steal hash:es in the previous last node to the new last
-            # node.
-            node.steal_range(_node_list[current_index-1], node.key_id, 2**MAXIMUM_BIT)
+    Every position of the node (see Node.positions) steals its hashes
+    like this.
+    
+    @param start: A node we want to add to the ring
+    @type start: Node
+
+    @param progress: Called as progress(source, target, records,
+    bytes) while the data is moved (may be None)
+    @type progress: callable
+
+    @param since: The times of the snapshots the node was loaded with
+    by storage address, as returned by bootstrap. Only the changes
+    since are moved to the node.
+    @type since: dict
+
+    @param compare: Compare the digests of every range with the node
+    first and only send what it doesn't hold (see Node.steal_range),
+    for a storage joining again with the data it had. A storage that
+    holds nothing of the ranges is only slowed down by it.
+    @type compare: bool
+
+    @raise NodeError: If a range couldn't be moved. The ranges moved
+    already are moved back and the node isn't joined.
+    """
+    _check_ring_health(node)
+
+    _complete_fingers()
+    old = _node_list[:]
+    _begin_join(node)
+    moves = _join_moves(node, old)
+    _begin_rebalance(old, _node_list)
+    done = []
+    try:
+        for move in moves:
+            target, source, from_id, to_id, copy = move
+            changed = None
+            if since and _format_address(target) == _format_address(node):
+                changed = since.get(_format_address(source))
+            if not _hand_over(target, source, from_id, to_id, copy, progress, changed,
+                              compare and _format_address(target) == _format_address(node)):
+                raise _move_error(move)
+            done.append(move)
+    except Exception:
+        error = sys.exc_info()
+        try:
+            _hand_back(done, progress)
+        finally:
+            _unjoin(node)
+        raise error[0], error[1], error[2]
+    finally:
+        _end_steals(node)
+        _end_rebalance()
+    _publish(_end_join(node))
+    _publish_ring()
+
+def _unjoin(node):
+    """
+    Unlink the positions of a node whose join failed, the ring is as
+    it was before _begin_join.
+
+    @param node: The joining node
+    @type node: Node
+    """
+    for position in node.positions():
+        _unlink(position)
+
+def _join_moves(node, old):
+    """
+    The ranges a joining node steals (see _steals), or with replicas
+    the data moved to keep every key on its replicas (see
+    _replica_moves).
+
+    @param node: The joining node (see _begin_join)
+    @type node: Node
+
+    @param old: The positions of the ring before the node joined
+    @type old: list
+
+    @return: The moves (see _replica_moves)
+    @rtype: list
+    """
+    if _replicas == 1:
+        return [(node, previous, from_id, to_id, False) for previous, from_id, to_id in _steals(node)]
+    return _replica_moves(old, _node_list)
+
+def _replica_moves(old, new):
+    """
+    Find the data to move when the ring changes, so every key ends up
+    on its replicas (see _ring_replicas).
+
+    For every range between two positions (of either ring) the
+    storages that stop being replicas of it hand it over to the
+    storages that become replicas. If nobody stops (the ring had less
+    storages than replicas) the first replica copies it instead.
+    Neighbouring ranges moved between the same storages are moved at
+    once.
+
+    @param old: The positions of the ring before the change
+    @type old: list
+
+    @param new: The positions of the ring after the change
+    @type new: list
+
+    @return: Tuples of the node moved to, the node moved from, the
+    range (from_id, to_id) and a flag that is True if the data is
+    copied (it stays on the node moved from)
+    @rtype: list
+    """
+    if not old or not new:
+        return []
+    old_ids = [node.key_id for node in old]
+    new_ids = [node.key_id for node in new]
+    ids = sorted(dict.fromkeys(old_ids + new_ids).keys())
+
+    moves = []
+    last = {}
+    for index, from_id in enumerate(ids):
+        to_id = ids[(index + 1) % len(ids)]
+        before = _ring_replicas(old, old_ids, from_id)
+        after = _ring_replicas(new, new_ids, from_id)
+        before_addresses = [_format_address(node) for node in before]
+        after_addresses = [_format_address(node) for node in after]
+        added = [node for node in after if _format_address(node) not in before_addresses]
+        dropped = [node for node in before if _format_address(node) not in after_addresses]
+        for position, target in enumerate(added):
+            if position < len(dropped):
+                source, copy = dropped[position], False
+            else:
+                source, copy = before[0], True
+            name = (_format_address(target), _format_address(source), copy)
+            if name in last and moves[last[name]][3] == from_id:
+                moves[last[name]] = (target, source, moves[last[name]][2], to_id, copy)
+            else:
+                last[name] = len(moves)
+                moves.append((target, source, from_id, to_id, copy))
+
+    return [(target, source, range_from, range_to, copy)
+            for target, source, from_id, to_id, copy in moves
+            for range_from, range_to in _ranges(from_id, to_id)]
+
+def _hand_over(target, source, from_id, to_id, copy, progress, since=None, compare=False):
+    """
+    Move a range from one node to another (see _replica_moves). A
+    range of None moves the whole storage.
+
+    @param since: Only move the changes since this time (see
+    Node.steal_range)
+    @type since: float
+
+    @param compare: Compare the digests of the range first, so what the
+    target has already isn't sent again (not with since)
+    @type compare: bool
+
+    @return: If the transfer was ok we return True or False if not
+    @rtype: bool
+    """
+    if from_id is None:
+        return source.transfer(target, progress)
+    return target.steal_range(source, from_id, to_id, progress, copy, since, compare and since is None)
+
+def _move_error(move):
+    """
+    @param move: A move that failed (see _replica_moves)
+    @type move: tuple
+
+    @return: The error raised for it
+    @rtype: NodeError
+    """
+    target, source, from_id, to_id, copy = move
+    if from_id is None:
+        return NodeError("Node '%s' didn't transfer its hashes to '%s'" % (source, target))
+    return NodeError("Node '%s' didn't hand over the hashes %x-%x to '%s'" % (source, from_id,
+                                                                            to_id, target))
+
+def _hand_back(moves, progress):
+    """
+    Move the ranges of a failed join or remove back where they were,
+    the ones copied are left on both nodes. A storage transfered whole
+    is the only move of a remove so it's never handed back.
+
+    @param moves: The moves done (see _replica_moves)
+    @type moves: list
+
+    @param progress: Called as progress(source, target, records,
+    bytes) while the data is moved (may be None)
+    @type progress: callable
+
+    @raise NodeError: If a range couldn't be moved back
+    """
+    for target, source, from_id, to_id, copy in reversed(moves):
+        if copy or from_id is None:
+            continue
+        if not source.steal_range(target, from_id, to_id, progress):
+            raise NodeError("Node '%s' didn't hand back the hashes %x-%x to '%s'" % (
+                target, from_id, to_id, source))
+
+def repair(node, progress=None):
+    """
+    Copy to a storage what it has missed of the keys it is a replica
+    of, from the other replicas, for instance after it was down for a
+    while:
+
+    $python> sdht.repair(Node('127.0.0.1', '8001'))
+
+    The storages compare the digests of every range first and only
+    the records that differ are sent (see Node.steal_range), so a
+    storage that was down briefly catches up with a small copy. Keys
+    deleted meanwhile are left on it. Without replicas there is
+    nothing to copy from.
+
+    @param node: A storage of the ring
+    @type node: Node
+
+    @param progress: Called as progress(source, target, records,
+    bytes) while the data is copied (may be None)
+    @type progress: callable
+
+    @return: True if every range was copied
+    @rtype: bool
+    """
+    ok = True
+    for target, source, from_id, to_id in _repair_moves(_linked(node)[0]):
+        ok = target.steal_range(source, from_id, to_id, progress, True, compare=True) and ok
+    return ok
+
+def _repair_moves(node):
+    """
+    The ranges a storage is a replica of (see _ring_replicas), each
+    copied from the first other replica of it. Neighbouring ranges
+    copied from the same storage are copied at once.
+
+    @param node: The linked node being repaired
+    @type node: Node
+
+    @return: Tuples of the node, the node copied from and the range
+    (from_id, to_id)
+    @rtype: list
+    """
+    address = _format_address(node)
+    moves = []
+    for index, position in enumerate(_node_list):
+        from_id = position.key_id
+        to_id = _node_list[(index + 1) % len(_node_list)].key_id
+        replicas = _ring_replicas(_node_list, _ring_ids, from_id)
+        sources = [other for other in replicas if _format_address(other) != address]
+        if len(sources) == len(replicas) or not sources:
+            continue
+        if (moves and _format_address(moves[-1][1]) == _format_address(sources[0]) and
+            moves[-1][3] == from_id):
+            moves[-1] = (node, sources[0], moves[-1][2], to_id)
+        else:
+            moves.append((node, sources[0], from_id, to_id))
+    return [(target, source, range_from, range_to)
+            for target, source, from_id, to_id in moves
+            for range_from, range_to in _ranges(from_id, to_id)]
+
+def bootstrap(node, directory):
+    """
+    Load a storage that is about to join the ring with snapshots of the
+    ranges it will take over, so joining it afterwards only moves what
+    changed meanwhile:
+
+    $python> since = sdht.bootstrap(node, '/var/tmp/snapshots')
+    $python> sdht.join(node, since=since)
+
+    The ring must not change between the two.
+
+    @param node: The storage that will join
+    @type node: Node
+
+    @param directory: Where the snapshots are written (they are kept)
+    @type directory: str
+
+    @return: The time of the first snapshot taken of each storage, by
+    address (the since of join)
+    @rtype: dict
+    """
+    if not node.check():
+        raise NodeError ("Node '%s' isn't responding" % node)
+
+    # The moves of the join, found by joining the node for a moment
+    old = _node_list[:]
+    _begin_join(node)
+    try:
+        moves = _join_moves(node, old)
+    finally:
+        _end_steals(node)
+        for position in node.positions():
+            _unlink(position)
+
+    since = {}
+    address = _format_address(node)
+    for target, source, from_id, to_id, copy in moves:
+        if _format_address(target) != address or from_id is None:
+            continue
+        path = os.path.join(directory, '%s_%s_%x.snapshot' % (source.ip, source.port, from_id))
+        end = source.snapshot(path, from_id, to_id)
+        target.load(path)
+        source_address = _format_address(source)
+        since[source_address] = min(since.get(source_address, end['time']), end['time'])
+    return since
+
+def _begin_rebalance(old, new):
+    """
+    Keep the rings before and after a change while join or remove
+    moves the data of the replicas (see _replicas_of).
+
+    @param old: The positions of the ring before the change
+    @type old: list
+
+    @param new: The positions of the ring after the change
+    @type new: list
+    """
+    global _rebalancing
+    if old and new:
+        _rebalancing = ((old[:], [node.key_id for node in old]),
+                        (new[:], [node.key_id for node in new]))
+
+def _end_rebalance():
+    """
+    Forget the rings of a change once the data has been moved.
+    """
+    global _rebalancing
+    _rebalancing = None
+    if _blooms is not None:
+        # The keys have moved
+        _blooms.clear()
+
+def _begin_join(node):
+    """
+    Link the positions of a joining node into the ring. The node
+    owning the hashes of a position until now is kept as its source
+    and keeps serving them until they have been stolen (see
+    find_node).
+
+    @param node: The joining node
+    @type node: Node
+    """
+    positions = node.positions()
+    if _node_list:
+        for position in positions:
+            position.source = find_node(_node_list[0], position.key_id)
+    for position in positions:
+        _link(position)
+
+def _steals(node):
+    """
+    The ranges a joining node steals, from the position before each
+    run of its positions (see _runs). With virtual nodes these are
+    many small ranges spread over the other nodes.
+
+    @param node: The joining node (see _begin_join)
+    @type node: Node
+
+    @return: Tuples of the node stolen from and the range (from_id,
+    to_id) to steal
+    @rtype: list
+    """
+    steals = []
+    for previous, from_id, to_id in _runs(node):
+        for range_from, range_to in _ranges(from_id, to_id):
+            steals.append((previous, range_from, range_to))
+    return steals
+
+def _end_steals(node):
+    """
+    Stop serving the hashes of a joining node from its sources.
+    """
+    for position in node.positions():
+        position.source = None
+
+def _end_join(node):
+    """
+    Fix the finger tables once a joining node has stolen its hashes.
+
+    @return: The nodes whose routing changed (see _publish)
+    @rtype: list
+    """
+    changed = []
+    for position in node.positions():
+        _drop_cached(position)
+        for other in _fix_fingers(position, position) + [_node_list[_index(position)-1]]:
+            if other not in changed:
+                changed.append(other)
+    return changed
+
+def distribution():
+    """
+    Find how the hashes are shared between the nodes of the ring.
+
+    @return: Tuples of the first position of a node, its number of
+    positions, the share of the hashes it owns and the share it should
+    own going by the weights, in ring order
+    @rtype: list
+    """
+    if not _node_list:
+        return []
+    shares = {}
+    for position in _node_list:
+        if position.next is None:
+            arc = 2**MAXIMUM_BIT
+        else:
+            arc = distance(position.key_id, position.next.key_id)
+        address = _format_address(position)
+        shares[address] = shares.get(address, 0) + arc
+
+    storages = _by_storage(_node_list)
+    total_weight = float(sum([node.weight for node, positions in storages]))
+    return [(node, len(positions), float(shares[_format_address(node)]) / 2**MAXIMUM_BIT,
+             node.weight / total_weight)
+            for node, positions in storages]
+
+def distribution_report():
+    """
+    Format the distribution of the hashes (see distribution) as a
+    table with the load of every node compared to its fair share and
+    the imbalance of the whole ring.
+
+    @rtype: str
+    """
+    rows = distribution()
+    if not rows:
+        return "No nodes have joined the ring"
+    lines = ["%-22s %6s %9s %9s %9s" % ("node", "vnodes", "share %", "fair %", "load")]
+    loads = []
+    for node, positions, share, fair in rows:
+        loads.append(share / fair)
+        lines.append("%-22s %6d %9.2f %9.2f %9.2f" % (_format_address(node), positions,
+                                                     share * 100, fair * 100, share / fair))
+    mean = sum(loads) / len(loads)
+    deviation = (sum([(load - mean) ** 2 for load in loads]) / len(loads)) ** 0.5
+    lines.append("imbalance (max/min load) %.2f, highest load %.2f, deviation %.3f" % (
+        max(loads) / min(loads), max(loads), deviation))
+    return '\n'.join(lines)
+
+def storage_stats():
+    """
+    Get the counters of every storage in the ring (see Node.stats).
+
+    @return: The counters by 'ip:port'
+    @rtype: dict
+    """
+    return dict([(_format_address(node), node.stats()) for node, positions in _by_storage(_node_list)])
+
+def set_entry(node):
+    """
+    Use a single node of an existing ring as the entry point instead
+    of joining every node locally. Keys are then routed through the
+    finger tables of the storages (see route).
+
+    @param node: Any node in the ring
+    @type node: Node
+    """
+    global _entry
+    _entry = node
             
+def _drop_cached(node):
+    """
+    Drop the cached values of the range a node owns (it has just
+    joined or is being removed).
+
+    @param node: A node in the ring
+    @type node: Node
+    """
+    if _cache is None:
+        return
+    if node.next is None:
+        _cache.clear()
+    else:
+        _cache.drop_range(node.key_id, node.next.key_id)
+
+def _invalidate(keys):
+    """
+    Drop the cached values of keys that are written.
+
+    @param keys: Keys (not hashed)
+    @type keys: list
+    """
+    if _cache is not None:
+        _cache.invalidate(keys)
+
+def _cached(key):
+    """
+    @param key: A key (not hashed)
+    @type key: str
+
+    @return: The cached value of a key or MISSING
+    """
+    if _cache is None:
+        return MISSING
+    return _cache.get(key)
+
+def _load(key, hashed_key, serialized_value):
+    """
+    Deserialize a value and cache it. The chunks of a chunked value
+    are read first.
+
+    @param key: A key (not hashed)
+    @type key: str
+
+    @param hashed_key: The hashed key
+    @type hashed_key: long
+
+    @param serialized_value: The value as stored
+    @type serialized_value: str
+
+    @return: The value
+    """
+    manifest = _read_manifest(serialized_value)
+    if manifest is not None:
+        serialized_value = ''.join(_chunks(manifest))
+    return _keep(key, hashed_key, serialized_value, manifest)
+
+def _keep(key, hashed_key, serialized_value, manifest=None):
+    """
+    Deserialize a value (the chunks of it put together for a chunked
+    one) and cache it.
+
+    @param manifest: The manifest of a chunked value
+    @type manifest: dict
+
+    @return: The value
+    """
+    if manifest is not None and manifest['raw']:
+        value = serialized_value
+    else:
+        value = _decode(serialized_value)
+    if _cache is not None:
+        _cache.put(key, hashed_key, value, len(serialized_value))
+    return value
+
 def set(key, value):
     """
     Set a value in the storage
@@ -426,9 +4489,106 @@ def set(key, value):
     in the storage
     @type value: object
     """
-    hashed_key = long(sha.new(key).hexdigest(), 16)
-    serialized_value = pickle.dumps(value) # Use default protocol
-    _store(_node_list[0], hashed_key, serialized_value)
+    _refresh_ring()
+    hashed_key = _hash(key)
+    serialized_value = _encode(value)
+    if _chunk_threshold is not None and len(serialized_value) > _chunk_threshold:
+        _set_chunked(key, hashed_key, _split(serialized_value), False)
+        return
+    try:
+        answers = _store(hashed_key, serialized_value)
+    finally:
+        _invalidate([key])
+    _delete_replaced(answers)
+
+def _set_chunked(key, hashed_key, pieces, raw):
+    """
+    Store a value in chunks and its manifest under the key, then delete
+    the chunks of the value it replaces. Racing writes of the same key
+    can leave the chunks of the write that lost behind.
+
+    @param pieces: The chunks (see _store_chunks)
+    @type pieces: iterable
+
+    @return: The bytes stored in the chunks
+    @rtype: int
+    """
+    manifest = _store_chunks(pieces, raw)
+    try:
+        answers = _store(hashed_key, manifest)
+    except Exception:
+        _delete_chunks(_read_manifest(manifest))
+        raise
+    finally:
+        _invalidate([key])
+    _delete_replaced(answers)
+    return _read_manifest(manifest)['size']
+
+def set_stream(key, stream):
+    """
+    Store the bytes read from a file-like object, in chunks. Only a
+    few chunks are in memory at a time, whatever the size of the
+    stream (see configure_chunks). get returns the bytes as a str,
+    get_stream writes them to a file-like object.
+
+    @param key: The key to store the bytes under
+    @type key: str
+
+    @param stream: Read until it returns an empty string
+    @type stream: file
+
+    @return: The bytes stored
+    @rtype: int
+    """
+    _refresh_ring()
+    return _set_chunked(key, _hash(key), _read_stream(stream), True)
+
+def get_stream(key, stream):
+    """
+    Write a value set with set_stream (or any str value) to a
+    file-like object, a few chunks at a time. The chunks are read in
+    parallel (see configure_chunks).
+
+    @param key: The key of the value
+    @type key: str
+
+    @param stream: The file-like object to write the bytes to
+    @type stream: file
+
+    @return: The bytes written
+    @rtype: int
+
+    @raise TypeError: If the value isn't a str
+    """
+    _refresh_ring()
+    hashed_key = _hash(key)
+    serialized_value = _lookup(hashed_key)
+    manifest = _read_manifest(serialized_value)
+    if manifest is not None and manifest['raw']:
+        for data in _chunks(manifest):
+            stream.write(data)
+        return manifest['size']
+    value = _load(key, hashed_key, serialized_value)
+    if not isinstance(value, str):
+        raise TypeError("Only a str value can be streamed, not %s" % type(value).__name__)
+    stream.write(value)
+    return len(value)
+
+def delete(key):
+    """
+    Delete a value from the storage, with its chunks if it is chunked.
+
+    @param key: The key for the value we want to delete
+    @type key: str
+    """
+    _refresh_ring()
+    hashed_key = _hash(key)
+    nodes, extras = _replicas_of(hashed_key)
+    try:
+        answers = _write(nodes, extras, lambda node: node.delete_many([hashed_key]))
+    finally:
+        _invalidate([key])
+    _delete_replaced(answers)
     
 def get(key):
     """
@@ -441,9 +4601,288 @@ def get(key):
     @rtype: object
 
     """
-    hashed_key = long(sha.new(key).hexdigest(), 16)
-    serialized_value = _lookup(_node_list[0], hashed_key)
-    return pickle.loads(serialized_value)
+    _refresh_ring()
+    value = _cached(key)
+    if value is not MISSING:
+        return value
+    hashed_key = _hash(key)
+    told = _bloom_missing(hashed_key)
+    if told:
+        raise KeyError(hashed_key)
+    try:
+        serialized_value = _lookup(hashed_key)
+    except KeyError:
+        _bloom_missed(told)
+        raise
+    return _load(key, hashed_key, serialized_value)
+
+def get_many(keys, default=MISSING):
+    """
+    Get several values from the storage with one request per node
+
+    @param keys: The keys for the values we want get from the storage
+    @type keys: list
+
+    @param default: Returned in place of the value of keys that
+    doesn't have a value
+    @type default: object
+
+    @return: The values stored for the keys, in the same order
+    @rtype: list
+    """
+    _refresh_ring()
+    values = [_cached(key) for key in keys]
+    missing = [position for position, value in enumerate(values) if value is MISSING]
+    hashed_keys = [_hash(keys[position]) for position in missing]
+    told = [_bloom_missing(hashed_key) for hashed_key in hashed_keys]
+    asked = [position for position in xrange(len(missing)) if not told[position]]
+    for nodes, extras, positions in _group_replicas([hashed_keys[position] for position in asked]):
+        positions = [asked[position] for position in positions]
+        group = [hashed_keys[position] for position in positions]
+        serialized_values = _read(nodes, lambda node, group=group: node.get_many(group))
+        for position, serialized_value in zip(positions, serialized_values):
+            if serialized_value is not MISSING:
+                values[missing[position]] = _load(keys[missing[position]], hashed_keys[position],
+                                                  serialized_value)
+            else:
+                _bloom_missed(told[position])
+    for position in missing:
+        if values[position] is MISSING:
+            values[position] = default
+    return values
+
+def set_many(items):
+    """
+    Set several values in the storage with one request per node
+
+    @param items: A dict or a list of (key, value) tuples
+    @type items: dict
+    """
+    _refresh_ring()
+    if isinstance(items, dict):
+        items = items.items()
+    items = [(key, _hash(key), _encode(value)) for key, value in items]
+    if _chunk_threshold is not None:
+        for key, hashed_key, serialized_value in items:
+            if len(serialized_value) > _chunk_threshold:
+                _set_chunked(key, hashed_key, _split(serialized_value), False)
+        items = [item for item in items if len(item[2]) <= _chunk_threshold]
+    hashed_keys = [hashed_key for key, hashed_key, serialized_value in items]
+    answers = []
+    try:
+        for nodes, extras, positions in _group_replicas(hashed_keys):
+            group = [hashed_keys[position] for position in positions]
+            values = [items[position][2] for position in positions]
+            _bloom_wrote(nodes + extras, group)
+            answers.extend(_write(nodes, extras, lambda node, group=group, values=values: node.set_many(group, values)))
+    finally:
+        _invalidate([key for key, hashed_key, serialized_value in items])
+    _delete_replaced(answers)
+
+def delete_many(keys):
+    """
+    Delete several values from the storage with one request per node
+
+    @param keys: The keys for the values we want to delete
+    @type keys: list
+    """
+    _refresh_ring()
+    hashed_keys = [_hash(key) for key in keys]
+    answers = []
+    try:
+        for nodes, extras, positions in _group_replicas(hashed_keys):
+            group = [hashed_keys[position] for position in positions]
+            answers.extend(_write(nodes, extras, lambda node, group=group: node.delete_many(group)))
+    finally:
+        _invalidate(keys)
+    _delete_replaced(answers)
+
+def gets(key, default=MISSING):
+    """
+    Get a value and its version, for cas.
+
+    @param key: The key for a value we want get from the storage
+    @type key: str
+
+    @param default: Returned in place of the value if there is none
+    @type default: object
+
+    @return: The value and its version (None if there is no value)
+    @rtype: tuple
+    """
+    _refresh_ring()
+    hashed_key = _hash(key)
+    told = _bloom_missing(hashed_key)
+    if told:
+        return default, None
+    try:
+        serialized_value = _lookup(hashed_key)
+    except KeyError:
+        _bloom_missed(told)
+        return default, None
+    return _load(key, hashed_key, serialized_value), _version(serialized_value)
+
+def cas(key, value, version):
+    """
+    Set a value only if the value stored still has a version (compare
+    and set).
+
+    @param key: The key for a value we want to store in a storage
+    @type key: str
+
+    @param value: The new value
+    @type value: object
+
+    @param version: The version of the value as returned by gets, None
+    to only set the value if there is none
+    @type version: str
+
+    @return: True if the value was set
+    @rtype: bool
+    """
+    return cas_many([(key, value, version)])[0]
+
+def cas_many(items):
+    """
+    Compare and set several values (see cas) with one request per node.
+
+    @param items: Tuples of a key, a value and a version
+    @type items: list
+
+    @return: True for every value that was set, in the same order
+    @rtype: list
+    """
+    answers = _atomic('cas', [key for key, value, version in items],
+                      [_encode(value) for key, value, version in items],
+                      [version for key, value, version in items])
+    return [answer is not MISSING for answer in answers]
+
+def incr(key, delta=1):
+    """
+    Add to an integer value. A key without a value starts at 0.
+
+    @param key: The key of an integer value
+    @type key: str
+
+    @param delta: The number to add (may be negative)
+    @type delta: int
+
+    @return: The new value
+    @rtype: int
+    """
+    return incr_many([(key, delta)])[0]
+
+def incr_many(deltas):
+    """
+    Add to several integer values (see incr) with one request per
+    node.
+
+    @param deltas: A dict or a list of (key, delta) tuples
+    @type deltas: dict
+
+    @return: The new values, in the same order
+    @rtype: list
+
+    @raise TypeError: If a delta isn't an integer
+    """
+    if isinstance(deltas, dict):
+        deltas = deltas.items()
+    answers = _atomic('incr', [key for key, delta in deltas], _format_deltas(deltas), written=True)
+    return [_decode(answer) for answer in answers]
+
+def _format_deltas(deltas):
+    """
+    @param deltas: Tuples of a key and a delta (see incr_many)
+    @type deltas: list
+
+    @return: The deltas as the storages read them
+    @rtype: list
+
+    @raise TypeError: If a delta isn't an integer
+    """
+    for key, delta in deltas:
+        if not isinstance(delta, (int, long)) or isinstance(delta, bool):
+            raise TypeError("The delta of '%s' isn't an integer: %r" % (key, delta))
+    return ['%d' % delta for key, delta in deltas]
+
+def append(key, item):
+    """
+    Append an item to a list value. A key without a value starts as an
+    empty list.
+
+    Like incr this is done by the storage, which can only read values
+    made of the builtin types (see the storage), not instances of
+    classes.
+
+    @param key: The key of a list value
+    @type key: str
+
+    @param item: The item to append
+    @type item: object
+    """
+    append_many([(key, item)])
+
+def append_many(items):
+    """
+    Append to several list values (see append) with one request per
+    node.
+
+    @param items: Tuples of a key and an item
+    @type items: list
+    """
+    _atomic('append', [key for key, item in items], [_encode(item) for key, item in items])
+
+def _atomic(command, keys, values, versions=None, written=False):
+    """
+    Send an atomic command (see Node.atomic) to the owners of keys,
+    one request per node. The values written are copied to the other
+    replicas of the keys afterwards.
+
+    @return: The answers of the owners, in the same order as the keys
+    @rtype: list
+    """
+    _refresh_ring()
+    hashed_keys = [_hash(key) for key in keys]
+    answers = [None] * len(keys)
+    try:
+        for nodes, extras, positions in _group_replicas(hashed_keys):
+            group = [hashed_keys[position] for position in positions]
+            others = nodes[1:] + extras
+            _bloom_wrote(nodes + extras, group)
+            results = _timed(nodes[0], lambda node: node.atomic(
+                command, group, [values[position] for position in positions],
+                versions and [versions[position] for position in positions],
+                written or bool(others)))
+            for position, result in zip(positions, results):
+                answers[position] = result
+            copies = dict([(key, result) for key, result in zip(group, results) if result is not MISSING])
+            if others and copies:
+                _write(nodes[1:], extras, lambda node: node.set_many(copies.keys(), copies.values()))
+    finally:
+        _invalidate(keys)
+    return answers
+
+def _version(serialized_value):
+    """
+    The version of a stored value (see cas), a digest of it.
+
+    @param serialized_value: The value as stored
+    @type serialized_value: str
+
+    @rtype: str
+    """
+    return sha.new(serialized_value).hexdigest()
+
+def _hash(key):
+    """
+    Hash a key into the ring
+
+    @param key: A key
+    @type key: str
+
+    @rtype: long
+    """
+    return long(sha.new(key).hexdigest(), 16)
 
 def main():
     """
@@ -0,0 +1,1624 @@
+# -*- mode: python -*-
+
+"""
+A non-blocking client for the Simplified distributable hash table.
+
+The functions of the sdht module block for every request, so getting
+50 keys from 10 storages costs 50 round trips one after the other.
+Here every request goes through a single asyncore event loop instead
+and the storages are asked in parallel. The functions return a Future
+right away, run the loop to get the results:
+
+$python> import sdht, sdht_async
+$python> sdht.join(sdht.Node('127.0.0.1', '8000'))
+$python> futures = [sdht_async.get(key) for key in keys]
+$python> values = sdht_async.wait(futures)
+
+The ring (and the routing through the finger tables when only an entry
+node is known) is the one of the sdht module, so nodes joined with
+either module are used by both. The commands sent to the storages are
+the ones of sdht.Node, AsyncNode only sends them without blocking.
+
+At most IN_FLIGHT requests are sent to a single storage at the same
+time, the rest wait for their turn. Connections are kept alive and
+reused like the connection pool of the sdht module does.
+
+With replicas (see sdht.configure_replication) the reads are hedged
+and the writes acknowledged like in the sdht module, without threads.
+"""
+
+import asyncore, socket, sys, time, urllib, heapq, itertools
+from collections import deque
+import sdht
+
+# Requests sent to one storage at the same time
+IN_FLIGHT = 8
+
+# Bytes read from a connection at a time
+RECV_BYTES = 64 * 1024
+
+class Future(object):
+    """
+    The result of a request (or of several) that isn't done yet.
+
+    Callbacks added with add_callback are called with the future when
+    it is done. The result is read with result(), which raises the
+    error instead if the request failed.
+    """
+
+    def __init__(self):
+        self._done = False
+        self._result = None
+        self._error = None
+        self._callbacks = []
+
+    def done(self):
+        """
+        @return: True once there is a result or an error
+        @rtype: bool
+        """
+        return self._done
+
+    def result(self):
+        """
+        @return: The result of a done future (raises its error if it
+        failed)
+        """
+        if not self._done:
+            raise RuntimeError("The future isn't done yet, run the loop first")
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def exception(self):
+        """
+        @return: The error of a done future (None if it didn't fail)
+        @rtype: Exception
+        """
+        return self._error
+
+    def add_callback(self, callback):
+        """
+        Call callback(future) when the future is done (right away if
+        it already is).
+
+        @type callback: callable
+        """
+        if self._done:
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+    def set_result(self, result):
+        """
+        Finish the future with a result.
+        """
+        self._finish(result, None)
+
+    def set_exception(self, error):
+        """
+        Finish the future with an error.
+
+        @type error: Exception
+        """
+        self._finish(None, error)
+
+    def _finish(self, result, error):
+        if self._done:
+            raise RuntimeError("The future is already done")
+        self._done = True
+        self._result = result
+        self._error = error
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def then(self, function):
+        """
+        Chain a function on the result of the future.
+
+        @param function: Called with the result. It may return another
+        future, which is then waited for.
+        @type function: callable
+
+        @return: A future of what function returns (or of the error of
+        this future)
+        @rtype: Future
+        """
+        chained = Future()
+        def done(future):
+            if future._error is not None:
+                chained.set_exception(future._error)
+                return
+            try:
+                result = function(future._result)
+            except Exception, e:
+                chained.set_exception(e)
+                return
+            _forward(result, chained)
+        self.add_callback(done)
+        return chained
+
+def _forward(result, future):
+    """
+    Finish future with result, or with the outcome of result if it is
+    a future itself.
+    """
+    if isinstance(result, Future):
+        result.add_callback(lambda done: future._finish(done._result, done._error))
+    else:
+        future.set_result(result)
+
+def succeed(result):
+    """
+    @return: A future that is already done
+    @rtype: Future
+    """
+    future = Future()
+    future.set_result(result)
+    return future
+
+def fail(error):
+    """
+    @return: A future that has already failed
+    @rtype: Future
+    """
+    future = Future()
+    future.set_exception(error)
+    return future
+
+def gather(futures):
+    """
+    Wait for several futures.
+
+    @param futures: Futures
+    @type futures: list
+
+    @return: A future of the list of their results, in the same order
+    (or of the first error)
+    @rtype: Future
+    """
+    gathered = Future()
+    results = [None] * len(futures)
+    left = [len(futures)]
+    def done(position, future):
+        if gathered.done():
+            return
+        if future.exception() is not None:
+            gathered.set_exception(future.exception())
+            return
+        results[position] = future.result()
+        left[0] -= 1
+        if not left[0]:
+            gathered.set_result(results)
+    if not futures:
+        gathered.set_result(results)
+    for position, future in enumerate(futures):
+        future.add_callback(lambda future, position=position: done(position, future))
+    return gathered
+
+class Return(Exception):
+    """
+    Raised by a coroutine (see coroutine) to finish with a value.
+    """
+
+    def __init__(self, value=None):
+        Exception.__init__(self)
+        self.value = value
+
+def coroutine(function):
+    """
+    Turn a generator function into a function returning a Future.
+
+    The generator yields futures and gets their results back (or
+    their errors raised) when they are done, so a sequence of requests
+    reads like the blocking code of the sdht module. It finishes with
+    raise Return(value), or None when it ends.
+    """
+    def start(*args, **kwargs):
+        future = Future()
+        generator = function(*args, **kwargs)
+        def step(result, error):
+            try:
+                if error is None:
+                    waiting = generator.send(result)
+                else:
+                    waiting = generator.throw(error)
+            except StopIteration:
+                future.set_result(None)
+            except Return, e:
+                future.set_result(e.value)
+            except Exception, e:
+                future.set_exception(e)
+            else:
+                waiting.add_callback(lambda done: step(done._result, done._error))
+        step(None, None)
+        return future
+    start.__name__ = function.__name__
+    start.__doc__ = function.__doc__
+    return start
+
+class _Request(object):
+    """
+    A request waiting for (or being sent to) a storage.
+    """
+
+    def __init__(self, data, content_type, line):
+        """
+        @param data: The request body
+        @type data: str
+
+        @param content_type: Content type of the body
+        @type content_type: str
+
+        @param line: Called with every line of a streamed response as
+        it arrives (may be None)
+        @type line: callable
+        """
+        self.data = data
+        self.content_type = content_type
+        self.line = line
+        self.future = Future()
+
+    def message(self, address):
+        """
+        @return: The HTTP request
+        @rtype: str
+        """
+        return ('POST / HTTP/1.1\r\n'
+                'Host: %s:%s\r\n'
+                'Content-Type: %s\r\n'
+                'Content-Length: %d\r\n'
+                '\r\n%s' % (address[0], address[1], self.content_type, len(self.data), self.data))
+
+class _Connection(asyncore.dispatcher):
+    """
+    A keep-alive HTTP/1.1 connection to a storage, sending one request
+    at a time on the event loop of a Client.
+
+    A response with a length is done when the body has been read, a
+    response without one (a streamed transfer) when the storage closes
+    the connection. A request fails when the storage doesn't accept
+    the connection or stays silent for longer then the timeouts of the
+    client (see Client._expire).
+    """
+
+    def __init__(self, queue):
+        """
+        @param queue: The queue of the storage
+        @type queue: _NodeQueue
+        """
+        asyncore.dispatcher.__init__(self, map=queue.client._map)
+        self.queue = queue
+        self.request = None
+        self.reused = False
+        self.used = time.time()
+        # When the request times out if nothing happens
+        self.deadline = None
+        self._out = ''
+        self._in = ''
+        self._head = None
+        self._received = False
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            self.connect(queue.address)
+        except socket.error:
+            self.close()
+            raise
+
+    def start(self, request):
+        """
+        Send a request.
+
+        @type request: _Request
+        """
+        self.request = request
+        client = self.queue.client
+        self.deadline = time.time() + (self.connected and client.read_timeout or client.connect_timeout)
+        self._out = request.message(self.queue.address)
+        self._in = ''
+        self._head = None
+        self._received = False
+
+    def writable(self):
+        return not self.connected or bool(self._out)
+
+    def handle_connect(self):
+        self.deadline = time.time() + self.queue.client.read_timeout
+
+    def handle_write(self):
+        sent = self.send(self._out)
+        self._out = self._out[sent:]
+        self.deadline = time.time() + self.queue.client.read_timeout
+
+    def handle_read(self):
+        data = self.recv(RECV_BYTES)
+        if data and self.request is not None:
+            self.deadline = time.time() + self.queue.client.read_timeout
+            self._received = True
+            self._in += data
+            self._parse()
+
+    def handle_close(self):
+        self.close()
+        if self.request is None:
+            # An idle connection the storage timed out
+            self.queue.discard(self)
+        elif self._head is not None and self._head[2] is None:
+            # The end of a streamed response
+            if self._in and self.request.line is not None:
+                self.request.line(self._in)
+            self._done(self._body + self._in, True)
+        else:
+            self._fail(sdht.NodeError("Storage %s:%s closed the connection" % self.queue.address))
+
+    def handle_error(self):
+        error = sys.exc_info()[1]
+        self.close()
+        if self.request is None:
+            self.queue.discard(self)
+        else:
+            self._fail(error)
+
+    def timed_out(self):
+        """
+        Fail the request, the storage has been silent for too long.
+        """
+        self.close()
+        self._fail(socket.timeout("Storage %s:%s timed out" % self.queue.address), False)
+
+    def _parse(self):
+        """
+        Parse what has been read of the response so far.
+        """
+        if self._head is None:
+            end = self._in.find('\r\n\r\n')
+            if end < 0:
+                return
+            lines = self._in[:end].split('\r\n')
+            self._in = self._in[end + 4:]
+            self._body = ''
+            version, status, reason = (lines[0].split(' ', 2) + [''])[:3]
+            headers = {}
+            for line in lines[1:]:
+                name, value = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+            length = headers.get('content-length')
+            if length is not None:
+                length = int(length)
+            will_close = version == 'HTTP/1.0' or headers.get('connection', '').lower() == 'close'
+            self._head = (int(status), reason, length, will_close)
+            if self._head[0] != 200:
+                self.close()
+                self._fail(sdht.NodeError("Storage %s:%s answered '%s %s'" % (
+                    self.queue.address + (status, reason))), False, False)
+                return
+            epoch = headers.get(sdht.EPOCH_HEADER.lower())
+            if epoch:
+                sdht._saw_epoch(int(epoch), self.queue.address)
+
+        status, reason, length, will_close = self._head
+        if length is None:
+            # Streamed, hand over the complete lines as they arrive
+            end = self._in.rfind('\n') + 1
+            if end:
+                lines, self._in = self._in[:end], self._in[end:]
+                self._body += lines
+                if self.request.line is not None:
+                    for line in lines.splitlines():
+                        self.request.line(line)
+        elif len(self._in) >= length:
+            self._done(self._in[:length], will_close)
+
+    def _done(self, body, will_close):
+        request, self.request = self.request, None
+        if will_close:
+            self.close()
+        self.queue.finished(self, request, body, not will_close)
+
+    def _fail(self, error, retry=True, down=True):
+        request, self.request = self.request, None
+        self.queue.failed(self, request, error, retry and self.reused and not self._received, down)
+
+class _NodeQueue(object):
+    """
+    The requests and connections of one storage. At most in_flight
+    requests are sent at the same time, the others wait in line.
+    """
+
+    def __init__(self, client, address):
+        """
+        @type client: Client
+
+        @param address: (ip, port) of the storage
+        @type address: tuple
+        """
+        self.client = client
+        self.address = address
+        self.active = 0
+        self.pending = deque()
+        self.idle = []
+
+    @property
+    def breaker(self):
+        """
+        The circuit breaker of the storage (see sdht.CircuitBreaker).
+        """
+        return sdht._breaker('%s:%s' % self.address)
+
+    def submit(self, request):
+        """
+        Send a request when there is room for it.
+
+        @type request: _Request
+        """
+        self.pending.append(request)
+        self._next()
+
+    def _next(self):
+        while self.pending and self.active < self.client.in_flight:
+            request = self.pending.popleft()
+            self.active += 1
+            try:
+                connection = self._connection()
+            except socket.error, e:
+                self.active -= 1
+                self.breaker.failed()
+                request.future.set_exception(e)
+                continue
+            connection.start(request)
+
+    def _connection(self):
+        """
+        Get an idle connection or a new one.
+
+        @rtype: _Connection
+        """
+        now = time.time()
+        while self.idle:
+            connection = self.idle.pop()
+            if now - connection.used < self.client.idle_timeout:
+                connection.reused = True
+                return connection
+            connection.close()
+        return _Connection(self)
+
+    def discard(self, connection):
+        """
+        Forget an idle connection that has been closed.
+        """
+        if connection in self.idle:
+            self.idle.remove(connection)
+
+    def clear(self):
+        """
+        Close the idle connections.
+        """
+        for connection in self.idle:
+            connection.close()
+        self.idle = []
+
+    def finished(self, connection, request, body, keep):
+        """
+        A request got its response.
+
+        @param keep: The connection can be used again
+        @type keep: bool
+        """
+        self.active -= 1
+        if keep:
+            connection.used = time.time()
+            self.idle.append(connection)
+        self.breaker.succeeded()
+        request.future.set_result(body)
+        self._next()
+
+    def failed(self, connection, request, error, retry, down):
+        """
+        A request failed.
+
+        @param retry: Send it again on a fresh connection (the reused
+        connection was probably closed by the storage)
+        @type retry: bool
+
+        @param down: The storage couldn't be reached or timed out (it
+        answered with an error otherwise)
+        @type down: bool
+        """
+        self.active -= 1
+        if retry:
+            # The other idle connections are probably just as stale
+            self.clear()
+            self.pending.appendleft(request)
+        else:
+            if down:
+                self.breaker.failed()
+            else:
+                self.breaker.succeeded()
+            request.future.set_exception(error)
+        self._next()
+
+class Client(object):
+    """
+    The event loop and the connections to the storages.
+    """
+
+    def __init__(self, in_flight=IN_FLIGHT, idle_timeout=sdht.POOL_IDLE_TIMEOUT,
+                 connect_timeout=sdht.CONNECT_TIMEOUT, read_timeout=sdht.READ_TIMEOUT):
+        """
+        @param in_flight: Requests sent to one storage at the same time
+        @type in_flight: int
+
+        @param idle_timeout: Seconds before an idle connection is closed
+        @type idle_timeout: float
+
+        @param connect_timeout: Seconds to wait for a connection
+        @type connect_timeout: float
+
+        @param read_timeout: Seconds a storage may stay silent while it
+        is sent a request or answers it
+        @type read_timeout: float
+        """
+        self.in_flight = in_flight
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._map = {}
+        self._queues = {}
+        self._nodes = {}
+        # (when, sequence, callback) heap of the calls waiting to run
+        self._timers = []
+        self._sequence = itertools.count()
+
+    def post(self, ip, port, data, content_type='application/x-www-form-urlencoded', line=None):
+        """
+        Post data to a storage.
+
+        @param line: Called with every line of a streamed response as
+        it arrives (may be None)
+        @type line: callable
+
+        @return: A future of the response body
+        @rtype: Future
+        """
+        address = (ip, int(port))
+        queue = self._queues.get(address)
+        if queue is None:
+            queue = self._queues[address] = _NodeQueue(self, address)
+        if not queue.breaker.allow():
+            # The circuit breaker is open (see sdht.CircuitBreaker)
+            return fail(sdht.NodeError("Storage %s:%s is down" % address))
+        request = _Request(data, content_type, line)
+        queue.submit(request)
+        return request.future
+
+    def node(self, node):
+        """
+        The AsyncNode of this client with the address of a node.
+
+        @param node: A node (sync or not)
+        @type node: sdht.Node
+
+        @rtype: AsyncNode
+        """
+        address = sdht._format_address(node)
+        if address not in self._nodes:
+            self._nodes[address] = AsyncNode(node.ip, node.port, self)
+        return self._nodes[address]
+
+    def call_later(self, delay, callback):
+        """
+        Call callback() from the event loop after delay seconds.
+
+        @type delay: float
+
+        @type callback: callable
+        """
+        heapq.heappush(self._timers, (time.time() + delay, self._sequence.next(), callback))
+
+    def _fire(self):
+        """
+        Call the callbacks whose time has come.
+        """
+        now = time.time()
+        while self._timers and self._timers[0][0] <= now:
+            heapq.heappop(self._timers)[2]()
+
+    def _expire(self):
+        """
+        Fail the requests of the connections that have been silent for
+        longer then the timeouts.
+        """
+        now = time.time()
+        for connection in self._map.values():
+            if connection.request is not None and connection.deadline < now:
+                connection.timed_out()
+
+    def run(self, future, timeout=None):
+        """
+        Run the event loop until a future is done.
+
+        @param timeout: Seconds to wait at most (None to wait for ever)
+        @type timeout: float
+
+        @return: The result of the future
+        """
+        deadline = timeout is not None and time.time() + timeout or None
+        while not future.done():
+            if not self._map and not self._timers:
+                raise RuntimeError("Nothing is running that could finish the future")
+            if deadline is not None and time.time() > deadline:
+                raise sdht.NodeError("Timed out waiting for the storages")
+            wait = 0.1
+            if self._timers:
+                wait = max(0.0, min(wait, self._timers[0][0] - time.time()))
+            if self._map:
+                asyncore.loop(wait, False, self._map, 1)
+                self._expire()
+            else:
+                time.sleep(wait)
+            self._fire()
+        return future.result()
+
+    def close(self):
+        """
+        Close every connection of the client.
+        """
+        for queue in self._queues.values():
+            queue.clear()
+        asyncore.close_all(self._map)
+
+class AsyncNode(sdht.Node):
+    """
+    A node that sends its commands through the event loop of a Client.
+    The commands are the ones of sdht.Node but return a Future of
+    their result instead of blocking. Also has get and set for the
+    [] operators.
+    """
+
+    def __init__(self, ip, port, client=None):
+        """
+        @param client: The client sending the requests (the default
+        client of the module if None)
+        @type client: Client
+        """
+        sdht.Node.__init__(self, ip, port)
+        self._client = client or _client
+
+    def _command(self, values, parse):
+        """
+        Post a command without blocking.
+
+        @return: A future of what parse returns
+        @rtype: Future
+        """
+        data = urllib.urlencode(values, True)
+        return self._timed(values['cmd'], self._client.post(self.ip, self.port, data).then(parse))
+
+    def _timed(self, command, future):
+        """
+        Call the timing hooks of the sdht module (see
+        sdht.add_timing_hook) when a request is done.
+
+        @return: The future of the request
+        @rtype: Future
+        """
+        began = time.time()
+        future.add_callback(lambda done: sdht._timing(self, command, began, done.exception()))
+        return future
+
+    def _stream(self, values, line, parse):
+        """
+        Post a command without blocking, line is called with the lines
+        of the response as they arrive.
+
+        @return: A future of what parse returns for the last line
+        @rtype: Future
+        """
+        lines = ['']
+        def follow(text):
+            lines[0] = text
+            line(text)
+        data = urllib.urlencode(values, True)
+        future = self._client.post(self.ip, self.port, data, line=follow).then(lambda body: parse(lines[0]))
+        return self._timed(values['cmd'], future)
+
+    def _frames(self, command, keys, values, parse):
+        """
+        Send a data command as binary frames without blocking.
+
+        @return: A future of what parse returns
+        @rtype: Future
+        """
+        data = sdht._pack_frames(command, keys, values)
+        future = self._client.post(self.ip, self.port, data, sdht.FRAME_TYPE)
+        return self._timed(sdht.FRAME_COMMANDS[command], future.then(sdht._unpack_answers).then(parse))
+
+    def _protocol(self):
+        """
+        The protocol the storage agreed on. Never blocks to ask, forms
+        are sent until check has been run on a node with the address.
+
+        @return: 'frame' or 'form'
+        @rtype: str
+        """
+        return sdht._protocols.get((self.ip, str(self.port)), 'form')
+
+    def steal_range(self, other_node, from_id, to_id, progress=None, copy=False, since=None,
+                    compare=False):
+        """
+        Steal (or copy) a range of hashed keys from another node (only
+        the changes since a snapshot with since, or only what differs
+        with compare).
+
+        @return: A future that is True if the transfer was ok
+        @rtype: Future
+        """
+        return sdht.Node.steal_range(self, self._client.node(other_node), from_id, to_id,
+                                     progress, copy, since, compare)
+
+    def ingest(self, records):
+        """
+        Write packed records straight into the storage.
+
+        @return: A future of the number of records the storage
+        acknowledged
+        @rtype: Future
+        """
+        def parse(result):
+            if not result.startswith('OK '):
+                raise sdht.NodeError("Node '%s' didn't accept the records" % self)
+            return int(result[3:])
+        return self._timed('ingest', self._client.post(self.ip, self.port, records, sdht.RECORDS_TYPE).then(parse))
+
+    def get(self, key):
+        """
+        Get an item from the storage.
+
+        @param key: Hashed key to get
+        @type key: long
+
+        @return: A future of the serialized value (failing with a
+        KeyError if there is none)
+        @rtype: Future
+        """
+        return self.__getitem__(key)
+
+    def set(self, key, value):
+        """
+        Set an item in the storage.
+
+        @param key: Hashed key to set
+        @type key: long
+
+        @param value: Serialized data to set
+        @type value: str
+
+        @return: A future that is done when the item is set
+        @rtype: Future
+        """
+        return self.__setitem__(key, value)
+
+    def __repr__(self):
+        """
+        Makes it simple to print out a Node.
+        """
+        return "<AsyncNode '%s', port '%s'>" % (self.key_id, self.port)
+
+_client = Client()
+
+def configure(in_flight=IN_FLIGHT, idle_timeout=sdht.POOL_IDLE_TIMEOUT,
+              connect_timeout=sdht.CONNECT_TIMEOUT, read_timeout=sdht.READ_TIMEOUT):
+    """
+    Replace the default client (closing its connections).
+
+    @param in_flight: Requests sent to one storage at the same time
+    @type in_flight: int
+
+    @param idle_timeout: Seconds before an idle connection is closed
+    @type idle_timeout: float
+
+    @param connect_timeout: Seconds to wait for a connection
+    @type connect_timeout: float
+
+    @param read_timeout: Seconds a storage may stay silent
+    @type read_timeout: float
+    """
+    global _client
+    _client.close()
+    _client = Client(in_flight, idle_timeout, connect_timeout, read_timeout)
+
+def run(future, timeout=None):
+    """
+    Run the default client until a future is done (see Client.run).
+
+    @return: The result of the future
+    """
+    return _client.run(future, timeout)
+
+def wait(futures, timeout=None):
+    """
+    Run the default client until several futures are done.
+
+    @param futures: Futures
+    @type futures: list
+
+    @return: Their results, in the same order
+    @rtype: list
+    """
+    return _client.run(gather(futures), timeout)
+
+@coroutine
+def route(start, key):
+    """
+    Find the node responsible for a hashed key by following the finger
+    tables of the storages (see sdht.route).
+
+    @return: A future of the node
+    @rtype: Future
+    """
+    node = start
+    for hop in xrange(sdht.MAXIMUM_BIT):
+        owner, node = yield _client.node(node).find_successor(key)
+        if owner:
+            raise Return(node)
+    raise sdht.NodeError("Could not route key '%s' from '%s'" % (key, start))
+
+def _owner(key):
+    """
+    Find the node responsible for a hashed key (see sdht._owner).
+
+    @return: A future of the node
+    @rtype: Future
+    """
+    if sdht._node_list:
+        return succeed(sdht.find_node(sdht._node_list[0], key))
+    elif sdht._entry is not None:
+        return route(sdht._entry, key)
+    return fail(sdht.NodeError("No nodes have joined the ring"))
+
+def _group(hashed_keys):
+    """
+    Group hashed keys by the node responsible for them, routing the
+    keys in parallel.
+
+    @return: A future of the groups (see sdht._group)
+    @rtype: Future
+    """
+    return gather([_owner(key) for key in hashed_keys]).then(sdht._group_owners)
+
+def _replicas_of(key):
+    """
+    Find the nodes a hashed key is kept on (see sdht._replicas_of),
+    routing it when only an entry node is known.
+
+    @return: A future of the replicas and the extra nodes written to
+    @rtype: Future
+    """
+    if sdht._replicas == 1 or not sdht._node_list:
+        return _owner(key).then(lambda node: ([node], []))
+    return succeed(sdht._replicas_of(key))
+
+def _group_replicas(hashed_keys):
+    """
+    Group hashed keys by the nodes they are kept on (see
+    sdht._group_replicas).
+
+    @return: A future of the groups
+    @rtype: Future
+    """
+    if sdht._replicas == 1 or not sdht._node_list:
+        return _group(hashed_keys).then(lambda groups: [([node], [], positions) for node, positions in groups])
+    return succeed(sdht._group_replicas(hashed_keys))
+
+def _timed(node, request):
+    """
+    Send a request to a node and record its latency (see
+    sdht.LatencyTracker). A KeyError is an answer too.
+
+    @param request: Sends the request to the AsyncNode given to it and
+    returns a future
+    @type request: callable
+
+    @return: The future of the request
+    @rtype: Future
+    """
+    address = sdht._format_address(node)
+    began = time.time()
+    def done(future):
+        if future.exception() is None or isinstance(future.exception(), KeyError):
+            sdht._latencies.record(address, time.time() - began)
+        else:
+            sdht._latencies.failed(address)
+    future = request(_client.node(node))
+    future.add_callback(done)
+    return future
+
+def _read(nodes, request):
+    """
+    Read from the replica with the lowest latency, hedged and skipping
+    the replicas that fail like sdht._read does.
+
+    @param nodes: The replicas
+    @type nodes: list
+
+    @param request: Sends the read to the AsyncNode given to it and
+    returns a future
+    @type request: callable
+
+    @return: A future of the first answer
+    @rtype: Future
+    """
+    nodes = sdht._healthy_first(sdht._latencies.rank(nodes))
+    if len(nodes) == 1:
+        return _timed(nodes[0], request)
+
+    result = Future()
+    waiting = nodes[1:]
+    counts = {'asked': 0, 'outstanding': 0}
+    errors = []
+    def ask(node):
+        counts['asked'] += 1
+        counts['outstanding'] += 1
+        _timed(node, request).add_callback(answered)
+    def answered(future):
+        counts['outstanding'] -= 1
+        if result.done():
+            return
+        error = future.exception()
+        if error is None or isinstance(error, KeyError):
+            result._finish(future._result, error)
+            return
+        errors.append(error)
+        if waiting:
+            ask(waiting.pop(0))
+        elif not counts['outstanding']:
+            result.set_exception(errors[0])
+    def hedge():
+        # The first replica is late
+        if not result.done() and counts['asked'] == 1 and waiting:
+            ask(waiting.pop(0))
+
+    ask(nodes[0])
+    if sdht._hedge_percentile is not None:
+        delay = sdht._latencies.percentile(sdht._format_address(nodes[0]), sdht._hedge_percentile)
+        if delay is not None:
+            _client.call_later(delay, hedge)
+    return result
+
+def _write(nodes, extras, request):
+    """
+    Write to every replica at once and finish when the acknowledgements
+    needed are in, like sdht._write does.
+
+    @param nodes: The replicas
+    @type nodes: list
+
+    @param extras: Nodes written to after all the replicas have
+    answered (see sdht._replicas_of)
+    @type extras: list
+
+    @param request: Sends the write to the AsyncNode given to it and
+    returns a future
+    @type request: callable
+
+    @return: A future of what the nodes that acknowledged the write
+    answered (a list)
+    @rtype: Future
+    """
+    if len(nodes) == 1 and not extras:
+        return _timed(nodes[0], request).then(lambda answer: [answer])
+
+    result = Future()
+    needed = min(sdht._write_acks or len(nodes), len(nodes))
+    acks = []
+    errors = []
+    def answered(future):
+        if future.exception() is None:
+            acks.append(future)
+        else:
+            errors.append(future.exception())
+        if result.done():
+            return
+        if len(acks) + len(errors) == len(nodes) or not extras:
+            if len(acks) >= needed:
+                answers = [ack.result() for ack in acks]
+                if extras:
+                    _forward(gather([_timed(node, request) for node in extras]).then(
+                        lambda extra: answers + extra), result)
+                else:
+                    result.set_result(answers)
+            elif len(nodes) - len(errors) < needed:
+                result.set_exception(sdht._write_error(len(nodes), needed, errors))
+
+    for node in nodes:
+        _timed(node, request).add_callback(answered)
+    return result
+
+def _lookup(key):
+    """
+    Get the value stored for a hashed key (see sdht._lookup).
+
+    @return: A future of the value as stored
+    @rtype: Future
+    """
+    return _replicas_of(key).then(lambda (nodes, extras): _read(nodes, lambda node: node.get(key)))
+
+def _store(key, value):
+    """
+    Store a serialized value with a hashed key (see sdht._store).
+
+    @return: A future of what the replicas answered (see
+    sdht._replaced)
+    @rtype: Future
+    """
+    def write((nodes, extras)):
+        sdht._bloom_wrote(nodes + extras, [key])
+        return _write(nodes, extras, lambda node: node.set_many([key], [value]))
+    return _replicas_of(key).then(write)
+
+def _bloom_missing(key):
+    """
+    Check a hashed key in the Bloom filters of the sdht module (see
+    sdht._bloom_missing) without blocking. The filters that need
+    refreshing are fetched in the background and used by later gets.
+
+    @type key: long
+
+    @return: True if the key has no value for sure, False if it may
+    have one and None if there are no filters to tell
+    @rtype: bool
+    """
+    blooms = sdht._blooms
+    if blooms is None or not sdht._node_list or sdht._rebalancing is not None:
+        return None
+    nodes, extras = sdht._replicas_of(key)
+    for node, version in blooms.stale(nodes):
+        _refresh_bloom(blooms, node, version)
+    return blooms.missing(nodes, sdht._pack_key(key), False)
+
+def _refresh_bloom(blooms, node, version):
+    """
+    Fetch the Bloom filter of a storage in the background (see
+    sdht.BloomFilters.stale).
+    """
+    began = time.time()
+    def fetched(future):
+        error = future.exception()
+        if error is None:
+            blooms.refreshed(node, future.result(), began)
+        elif isinstance(error, sdht.NodeError):
+            blooms.without(node)
+        else:
+            blooms.failed(node)
+    _client.node(node).bloom(version, True).add_callback(fetched)
+
+@coroutine
+def _load(key, hashed_key, serialized_value):
+    """
+    Deserialize a value and cache it, reading the chunks of a chunked
+    value first (see sdht._load). The chunks are read
+    sdht._chunk_fetches at a time.
+
+    @return: A future of the value
+    @rtype: Future
+    """
+    manifest = sdht._read_manifest(serialized_value)
+    if manifest is not None:
+        keys = sdht._chunk_keys(manifest['id'], manifest['chunks'])
+        chunks = []
+        for start in xrange(0, len(keys), sdht._chunk_fetches):
+            chunks.extend((yield gather([_fetch_chunk(chunk_key)
+                                         for chunk_key in keys[start:start + sdht._chunk_fetches]])))
+        serialized_value = ''.join(chunks)
+    raise Return(sdht._keep(key, hashed_key, serialized_value, manifest))
+
+def _fetch_chunk(key):
+    """
+    @return: A future of a chunk of a value (see sdht._fetch_chunk)
+    @rtype: Future
+    """
+    result = Future()
+    def answered(future):
+        if isinstance(future.exception(), KeyError):
+            result.set_exception(sdht._chunk_missing())
+        else:
+            result._finish(future._result, future._error)
+    _lookup(key).add_callback(answered)
+    return result
+
+@coroutine
+def _delete_replaced(answers):
+    """
+    Delete the chunks of the chunked values a write replaced or deleted
+    (see sdht._delete_replaced).
+
+    @return: A future that is done when the chunks are deleted
+    @rtype: Future
+    """
+    yield gather([_delete_chunks(manifest) for manifest in sdht._replaced(answers)])
+
+@coroutine
+def _set_chunked(key, hashed_key, serialized_value):
+    """
+    Store a value in chunks, sdht._chunk_fetches of them at a time,
+    then its manifest (see sdht._set_chunked).
+
+    @return: A future that is done when the value is stored
+    @rtype: Future
+    """
+    chunks = list(sdht._split(serialized_value))
+    ident = sdht._chunk_id()
+    keys = sdht._chunk_keys(ident, len(chunks))
+    manifest = {'id': ident, 'chunks': len(chunks)}
+    try:
+        for start in xrange(0, len(keys), sdht._chunk_fetches):
+            end = start + sdht._chunk_fetches
+            yield gather([_store(chunk_key, data) for chunk_key, data in zip(keys[start:end], chunks[start:end])])
+        answers = yield _store(hashed_key, sdht._manifest(ident, len(serialized_value), len(chunks), False))
+    except Exception, e:
+        sdht._invalidate([key])
+        yield _delete_chunks(manifest)
+        raise e
+    sdht._invalidate([key])
+    yield _delete_replaced(answers)
+
+@coroutine
+def _delete_chunks(manifest):
+    """
+    Delete the chunks of a value that is replaced (see
+    sdht._delete_chunks).
+
+    @return: A future that is done when the chunks are deleted
+    @rtype: Future
+    """
+    keys = sdht._chunk_keys(manifest['id'], manifest['chunks'])
+    try:
+        groups = yield _group_replicas(keys)
+        yield gather([_write(nodes, extras, lambda node, positions=positions: node.delete_many(
+                                 [keys[position] for position in positions]))
+                      for nodes, extras, positions in groups])
+    except (sdht.NodeError, socket.error):
+        pass
+
+def get(key):
+    """
+    Get a value from the storage.
+
+    @return: A future of the value (failing with a KeyError if there
+    is none)
+    @rtype: Future
+    """
+    sdht._refresh_ring()
+    value = sdht._cached(key)
+    if value is not sdht.MISSING:
+        return succeed(value)
+    hashed_key = sdht._hash(key)
+    told = _bloom_missing(hashed_key)
+    if told:
+        return fail(KeyError(hashed_key))
+    result = Future()
+    def answered(future):
+        if isinstance(future.exception(), KeyError):
+            sdht._bloom_missed(told)
+            result.set_exception(future.exception())
+        else:
+            _forward(future.then(lambda serialized_value: _load(key, hashed_key, serialized_value)), result)
+    _lookup(hashed_key).add_callback(answered)
+    return result
+
+def set(key, value):
+    """
+    Set a value in the storage.
+
+    @return: A future that is done when the value is stored
+    @rtype: Future
+    """
+    sdht._refresh_ring()
+    hashed_key = sdht._hash(key)
+    serialized_value = sdht._encode(value)
+    if sdht._chunk_threshold is not None and len(serialized_value) > sdht._chunk_threshold:
+        return _set_chunked(key, hashed_key, serialized_value)
+    result = Future()
+    def stored(future):
+        sdht._invalidate([key])
+        if future.exception() is not None:
+            result.set_exception(future.exception())
+        else:
+            _forward(_delete_replaced(future.result()), result)
+    _store(hashed_key, serialized_value).add_callback(stored)
+    return result
+
+@coroutine
+def get_many(keys, default=sdht.MISSING):
+    """
+    Get several values from the storage with one request per node,
+    all of them sent in parallel.
+
+    @param default: Returned in place of the value of keys that
+    doesn't have a value
+    @type default: object
+
+    @return: A future of the values, in the same order as the keys
+    @rtype: Future
+    """
+    sdht._refresh_ring()
+    values = [sdht._cached(key) for key in keys]
+    missing = [position for position, value in enumerate(values) if value is sdht.MISSING]
+    hashed_keys = [sdht._hash(keys[position]) for position in missing]
+    told = [_bloom_missing(hashed_key) for hashed_key in hashed_keys]
+    asked = [position for position in xrange(len(missing)) if not told[position]]
+    groups = yield _group_replicas([hashed_keys[position] for position in asked])
+    groups = [(nodes, extras, [asked[position] for position in positions]) for nodes, extras, positions in groups]
+    answers = yield gather([_read(nodes, lambda node, positions=positions: node.get_many(
+                                      [hashed_keys[position] for position in positions]))
+                            for nodes, extras, positions in groups])
+    found = []
+    for (nodes, extras, positions), serialized_values in zip(groups, answers):
+        for position, serialized_value in zip(positions, serialized_values):
+            if serialized_value is not sdht.MISSING:
+                found.append((position, serialized_value))
+            else:
+                sdht._bloom_missed(told[position])
+    loaded = yield gather([_load(keys[missing[position]], hashed_keys[position], serialized_value)
+                           for position, serialized_value in found])
+    for (position, serialized_value), value in zip(found, loaded):
+        values[missing[position]] = value
+    for position in missing:
+        if values[position] is sdht.MISSING:
+            values[position] = default
+    raise Return(values)
+
+@coroutine
+def set_many(items):
+    """
+    Set several values in the storage with one request per node, all
+    of them sent in parallel.
+
+    @param items: A dict or a list of (key, value) tuples
+    @type items: dict
+
+    @return: A future that is done when the values are stored
+    @rtype: Future
+    """
+    sdht._refresh_ring()
+    if isinstance(items, dict):
+        items = items.items()
+    items = [(key, sdht._hash(key), sdht._encode(value)) for key, value in items]
+    if sdht._chunk_threshold is not None:
+        yield gather([_set_chunked(key, hashed_key, serialized_value)
+                      for key, hashed_key, serialized_value in items
+                      if len(serialized_value) > sdht._chunk_threshold])
+        items = [item for item in items if len(item[2]) <= sdht._chunk_threshold]
+    hashed_keys = [hashed_key for key, hashed_key, serialized_value in items]
+    try:
+        groups = yield _group_replicas(hashed_keys)
+        for nodes, extras, positions in groups:
+            sdht._bloom_wrote(nodes + extras, [hashed_keys[position] for position in positions])
+        answers = yield gather([_write(nodes, extras, lambda node, positions=positions: node.set_many(
+                                           [hashed_keys[position] for position in positions],
+                                           [items[position][2] for position in positions]))
+                                for nodes, extras, positions in groups])
+    finally:
+        sdht._invalidate([key for key, hashed_key, serialized_value in items])
+    yield _delete_replaced([answer for group in answers for answer in group])
+
+@coroutine
+def delete_many(keys):
+    """
+    Delete several values from the storage with one request per node,
+    all of them sent in parallel.
+
+    @return: A future that is done when the values are deleted
+    @rtype: Future
+    """
+    sdht._refresh_ring()
+    hashed_keys = [sdht._hash(key) for key in keys]
+    try:
+        groups = yield _group_replicas(hashed_keys)
+        answers = yield gather([_write(nodes, extras, lambda node, positions=positions: node.delete_many(
+                                           [hashed_keys[position] for position in positions]))
+                                for nodes, extras, positions in groups])
+    finally:
+        sdht._invalidate(keys)
+    yield _delete_replaced([answer for group in answers for answer in group])
+
+def gets(key, default=sdht.MISSING):
+    """
+    Get a value and its version, for cas (see sdht.gets).
+
+    @return: A future of the value (default if there is none) and its
+    version (None if there is no value)
+    @rtype: Future
+    """
+    sdht._refresh_ring()
+    hashed_key = sdht._hash(key)
+    told = _bloom_missing(hashed_key)
+    if told:
+        return succeed((default, None))
+    result = Future()
+    def answered(future):
+        error = future.exception()
+        if isinstance(error, KeyError):
+            sdht._bloom_missed(told)
+            result.set_result((default, None))
+        elif error is not None:
+            result.set_exception(error)
+        else:
+            serialized_value = future.result()
+            _forward(_load(key, hashed_key, serialized_value).then(
+                lambda value: (value, sdht._version(serialized_value))), result)
+    _lookup(hashed_key).add_callback(answered)
+    return result
+
+def cas(key, value, version):
+    """
+    Set a value only if the value stored still has a version (see
+    sdht.cas).
+
+    @return: A future of True if the value was set
+    @rtype: Future
+    """
+    return cas_many([(key, value, version)]).then(lambda answers: answers[0])
+
+def cas_many(items):
+    """
+    Compare and set several values with one request per node, all of
+    them sent in parallel.
+
+    @param items: Tuples of a key, a value and a version
+    @type items: list
+
+    @return: A future of True for every value that was set
+    @rtype: Future
+    """
+    return _atomic('cas', [key for key, value, version in items],
+                   [sdht._encode(value) for key, value, version in items],
+                   [version for key, value, version in items]).then(
+        lambda answers: [answer is not sdht.MISSING for answer in answers])
+
+def incr(key, delta=1):
+    """
+    Add to an integer value (see sdht.incr).
+
+    @return: A future of the new value
+    @rtype: Future
+    """
+    return incr_many([(key, delta)]).then(lambda answers: answers[0])
+
+def incr_many(deltas):
+    """
+    Add to several integer values with one request per node, all of
+    them sent in parallel.
+
+    @param deltas: A dict or a list of (key, delta) tuples
+    @type deltas: dict
+
+    @return: A future of the new values, in the same order
+    @rtype: Future
+
+    @raise TypeError: If a delta isn't an integer
+    """
+    if isinstance(deltas, dict):
+        deltas = deltas.items()
+    return _atomic('incr', [key for key, delta in deltas], sdht._format_deltas(deltas),
+                   written=True).then(lambda answers: [sdht._decode(answer) for answer in answers])
+
+def append(key, item):
+    """
+    Append an item to a list value (see sdht.append).
+
+    @return: A future that is done when the item is appended
+    @rtype: Future
+    """
+    return append_many([(key, item)])
+
+def append_many(items):
+    """
+    Append to several list values with one request per node, all of
+    them sent in parallel.
+
+    @param items: Tuples of a key and an item
+    @type items: list
+
+    @return: A future that is done when the items are appended
+    @rtype: Future
+    """
+    return _atomic('append', [key for key, item in items],
+                   [sdht._encode(item) for key, item in items]).then(lambda answers: None)
+
+@coroutine
+def _atomic(command, keys, values, versions=None, written=False):
+    """
+    Send an atomic command to the owners of keys in parallel and copy
+    the values written to the other replicas (see sdht._atomic).
+
+    @return: A future of the answers of the owners, in the same order
+    as the keys
+    @rtype: Future
+    """
+    sdht._refresh_ring()
+    hashed_keys = [sdht._hash(key) for key in keys]
+    answers = [None] * len(keys)
+    try:
+        groups = yield _group_replicas(hashed_keys)
+        for nodes, extras, positions in groups:
+            sdht._bloom_wrote(nodes + extras, [hashed_keys[position] for position in positions])
+        results = yield gather([_timed(nodes[0], lambda node, positions=positions: node.atomic(
+                                    command, [hashed_keys[position] for position in positions],
+                                    [values[position] for position in positions],
+                                    versions and [versions[position] for position in positions],
+                                    written or len(nodes) > 1 or bool(extras)))
+                                for nodes, extras, positions in groups])
+        copies = []
+        for (nodes, extras, positions), group in zip(groups, results):
+            changed = {}
+            for position, answer in zip(positions, group):
+                answers[position] = answer
+                if answer is not sdht.MISSING:
+                    changed[hashed_keys[position]] = answer
+            if changed and (len(nodes) > 1 or extras):
+                request = lambda node, changed=changed: node.set_many(changed.keys(), changed.values())
+                if len(nodes) > 1:
+                    copies.append(_write(nodes[1:], extras, request))
+                else:
+                    copies.append(gather([_timed(node, request) for node in extras]))
+        yield gather(copies)
+    finally:
+        sdht._invalidate(keys)
+    raise Return(answers)
+
+def _publish(nodes):
+    """
+    Send the finger tables of nodes to their storages in parallel.
+
+    @return: A future that is done when they are sent
+    @rtype: Future
+    """
+    return gather([_client.node(node).publish_fingers(positions)
+                   for node, positions in sdht._by_storage(nodes)])
+
+def _publish_ring():
+    """
+    Send a new epoch of the ring membership to every storage in the
+    ring in parallel (see sdht.membership).
+
+    @return: A future that is done when it is sent
+    @rtype: Future
+    """
+    data = sdht._next_ring()
+    return gather([_client.node(node).publish_ring(data)
+                   for node, positions in sdht._by_storage(sdht._node_list)])
+
+@coroutine
+def join(node, progress=None, since=None, compare=False):
+    """
+    Add a node to the ring of the sdht module (see sdht.join) without
+    blocking the loop while its hashes are stolen.
+
+    @param node: A node to add to the ring, an AsyncNode is joined as
+    a plain sdht.Node
+    @type node: sdht.Node
+
+    @param since: The times of the snapshots the node was loaded with
+    (see sdht.bootstrap)
+    @type since: dict
+
+    @param compare: Only send what the node doesn't hold (see
+    sdht.join)
+    @type compare: bool
+
+    @return: A future that is done when the node has joined, it fails
+    with a NodeError if a range couldn't be moved (the node isn't
+    joined then)
+    @rtype: Future
+    """
+    if isinstance(node, AsyncNode):
+        node = sdht.Node(node.ip, node.port, node.weight)
+    healthy = sdht._known_health(node)
+    if healthy is None:
+        healthy = yield _client.node(node).check()
+    if not healthy:
+        raise sdht.NodeError ("Node '%s' isn't responding" % node)
+    sdht._check_storages_health()
+
+    sdht._complete_fingers()
+    old = sdht._node_list[:]
+    sdht._begin_join(node)
+    moves = sdht._join_moves(node, old)
+    sdht._begin_rebalance(old, sdht._node_list)
+    done = []
+    try:
+        for move in moves:
+            target, source, from_id, to_id, copy = move
+            changed = None
+            if since and sdht._format_address(target) == sdht._format_address(node):
+                changed = since.get(sdht._format_address(source))
+            moved = yield sdht._hand_over(_client.node(target), _client.node(source), from_id, to_id,
+                                          copy, progress, changed,
+                                          compare and sdht._format_address(target) == sdht._format_address(node))
+            if not moved:
+                raise sdht._move_error(move)
+            done.append(move)
+    except Exception:
+        error = sys.exc_info()
+        try:
+            yield _hand_back(done, progress)
+        finally:
+            sdht._unjoin(node)
+        raise error[0], error[1], error[2]
+    finally:
+        sdht._end_steals(node)
+        sdht._end_rebalance()
+    yield _publish(sdht._end_join(node))
+    yield _publish_ring()
+
+@coroutine
+def remove(node, progress=None):
+    """
+    Remove a node from the ring of the sdht module (see sdht.remove)
+    without blocking the loop while its hashes are transfered.
+
+    @return: A future that is done when the node is removed, it fails
+    with a NodeError if a range couldn't be moved (the node stays in
+    the ring then)
+    @rtype: Future
+    """
+    node = sdht._linked(node)[0]
+    sdht._check_storages_health()
+    sdht._complete_fingers()
+    moves = sdht._remove_moves(node)
+    sdht._begin_rebalance(sdht._node_list, sdht._without(node))
+    done = []
+    try:
+        for move in moves:
+            target, source, from_id, to_id, copy = move
+            moved = yield sdht._hand_over(_client.node(target), _client.node(source), from_id, to_id,
+                                          copy, progress)
+            if not moved:
+                raise sdht._move_error(move)
+            done.append(move)
+    except Exception:
+        error = sys.exc_info()
+        yield _hand_back(done, progress)
+        raise error[0], error[1], error[2]
+    finally:
+        sdht._end_rebalance()
+    yield _publish(sdht._end_remove(node))
+    yield _publish_ring()
+
+@coroutine
+def _hand_back(moves, progress):
+    """
+    Move the ranges of a failed join or remove back where they were
+    (see sdht._hand_back).
+
+    @return: A future that fails with a NodeError if a range couldn't
+    be moved back
+    @rtype: Future
+    """
+    for target, source, from_id, to_id, copy in reversed(moves):
+        if copy or from_id is None:
+            continue
+        moved = yield _client.node(source).steal_range(_client.node(target), from_id, to_id, progress)
+        if not moved:
+            raise sdht.NodeError("Node '%s' didn't hand back the hashes %x-%x to '%s'" % (
+                target, from_id, to_id, source))
+
+@coroutine
+def repair(node, progress=None):
+    """
+    Copy to a storage what it has missed of the keys it is a replica
+    of, from the other replicas (see sdht.repair), without blocking
+    the loop.
+
+    @return: A future that is True if every range was copied
+    @rtype: Future
+    """
+    ok = True
+    for target, source, from_id, to_id in sdht._repair_moves(sdht._linked(node)[0]):
+        copied = yield _client.node(target).steal_range(_client.node(source), from_id, to_id,
+                                                        progress, True, compare=True)
+        ok = copied and ok
+    raise Return(ok)
@@ -0,0 +1,874 @@
+# -*- mode: python -*-
+
+"""
+Storage engines of the minor-wsgi-storage.
+
+An engine keeps the records of one storage: packed keys (see
+sdht._pack_key) and serialized values. Every engine answers the same
+calls, so the storage doesn't care which one it runs on:
+
+$python> engine = sdht_engines.open_engine('log', '/tmp/records')
+$python> engine.write([(key, value)], [])
+$python> engine.get(key)
+$python> for key, value in engine.range(from_key, to_key): ...
+
+These engines are available (see ENGINES):
+* 'bdb' - A Berkeley DB B-tree in a transactional environment, the
+  storage as it always was. Needs the bsddb module.
+* 'sqlite' - A SQLite table in WAL mode, readers don't wait for the
+  writer.
+* 'log' - A log-structured append-only file. Every write is appended,
+  an in-memory hash index points at the latest value of each key and
+  reads are served from a memory map of the file. The space of
+  overwritten and deleted records is reclaimed by compacting the log in
+  a background thread.
+* 'memory' - A dict, for tests and benchmarks. Nothing is kept when
+  the storage stops.
+
+The 'bdb' and 'sqlite' engines can be opened by several worker
+processes at the same time (see Engine.shared), the others are owned
+by a single process.
+
+Writes are not flushed to disk when they return, the operating system
+writes them back when it likes. Engine.sync flushes every write done
+so far, the storage calls it as often as its durability asks for.
+"""
+
+import os, struct, threading, bisect, mmap, zlib, sqlite3
+from contextlib import contextmanager
+
+try:
+    from bsddb import db
+except ImportError:
+    # Gone from newer Pythons, the other engines don't need it
+    db = None
+
+# Bytes the log file of the 'log' engine grows by. The file is sparse
+# and only the written part of it takes space on disk.
+LOG_GROW_BYTES = 64 * 1024 * 1024
+
+# The log is compacted once the overwritten and deleted records take
+# more then COMPACT_RATIO of it and at least COMPACT_MIN_BYTES
+COMPACT_RATIO = 0.5
+COMPACT_MIN_BYTES = 16 * 1024 * 1024
+
+# Keys copied to the compacted log while holding the lock once
+COMPACT_BATCH = 1000
+
+# Seconds a SQLite connection waits for the writer of another worker
+SQLITE_TIMEOUT = 30.0
+
+# Keys looked up by a single SQLite statement
+SQLITE_BATCH = 500
+
+# Idle SQLite connections kept open for the next requests, the others
+# are closed when they are given back (see SQLiteEngine._connected)
+SQLITE_IDLE = 8
+
+class EngineError(Exception):
+    """
+    An engine can't be opened or used the way it was asked to.
+    """
+
+class Engine(object):
+    """
+    The records of a storage.
+
+    Keys are packed keys, values serialized values (both str). Ranges
+    are iterated in key order, which is the order of the ring.
+    """
+
+    # Whether several worker processes may open the same engine
+    shared = False
+
+    def get(self, key):
+        """
+        @param key: Packed key
+        @type key: str
+
+        @return: The value or None if the key isn't stored
+        @rtype: str
+        """
+        raise NotImplementedError
+
+    def get_many(self, keys):
+        """
+        @param keys: Packed keys
+        @type keys: list
+
+        @return: The values found by key
+        @rtype: dict
+        """
+        found = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                found[key] = value
+        return found
+
+    def get_heads(self, keys, length):
+        """
+        Read the start of the values of keys, without reading the rest
+        of them where the engine can.
+
+        @param keys: Packed keys
+        @type keys: list
+
+        @param length: Bytes to read of each value
+        @type length: int
+
+        @return: The first bytes of the values found by key
+        @rtype: dict
+        """
+        return dict([(key, value[:length]) for key, value in self.get_many(keys).iteritems()])
+
+    def write(self, puts, deletes):
+        """
+        Write a batch of records and delete a batch of keys at once.
+        Keys that aren't stored are ignored by the deletes.
+
+        @param puts: Tuples of a packed key and a serialized value
+        @type puts: list
+
+        @param deletes: Packed keys
+        @type deletes: list
+        """
+        raise NotImplementedError
+
+    def put(self, key, value):
+        """
+        Write a single record.
+        """
+        self.write([(key, value)], [])
+
+    def delete(self, key):
+        """
+        Delete a single key.
+        """
+        self.write([], [key])
+
+    def range(self, from_key='', to_key=None):
+        """
+        Iterate over the records of a range in key order. Close the
+        iterator when leaving it early.
+
+        @param from_key: First packed key of the range ('' for the
+        first key)
+        @type from_key: str
+
+        @param to_key: Packed key to stop before (None for no end)
+        @type to_key: str
+
+        @return: Tuples of a key and a value
+        @rtype: generator
+        """
+        raise NotImplementedError
+
+    def sync(self):
+        """
+        Flush every write done so far to disk, so it survives a crash
+        of the box and not only of the storage.
+        """
+
+    def close(self):
+        """
+        Close the engine, it can't be used afterwards.
+        """
+
+class BerkeleyEngine(Engine):
+    """
+    A B-tree in a Berkeley DB environment. The environment does the
+    locking and logging needed for several threads and worker
+    processes to use the database at the same time. It is kept in
+    <path>.env.
+    """
+
+    shared = True
+
+    def __init__(self, path, recover=False):
+        """
+        @param path: Database file
+        @type path: str
+
+        @param recover: Run recovery first, only the process that opens
+        the environment before the workers are forked may do that
+        @type recover: bool
+        """
+        if db is None:
+            raise EngineError("The bdb engine needs the bsddb module")
+
+        home = path + '.env'
+        if not os.path.isdir(home):
+            os.makedirs(home)
+
+        self._env = db.DBEnv()
+        self._env.set_lk_detect(db.DB_LOCK_DEFAULT)
+        # Commits aren't flushed to disk, like the plain database before
+        self._env.set_flags(db.DB_TXN_NOSYNC, 1)
+        flags = (db.DB_CREATE | db.DB_INIT_MPOOL | db.DB_INIT_LOCK |
+                 db.DB_INIT_LOG | db.DB_INIT_TXN | db.DB_THREAD)
+        if recover:
+            flags |= db.DB_RECOVER
+        self._env.open(home, flags)
+
+        self._db = db.DB(self._env)
+        self._db.set_get_returns_none(2)
+        self._db.open(path, None, db.DB_BTREE,
+                      db.DB_CREATE | db.DB_THREAD | db.DB_AUTO_COMMIT)
+
+    def _in_transaction(self, work):
+        """
+        Run database work in a transaction. The work is run again if
+        Berkeley DB aborts the transaction to break a deadlock with
+        another thread or worker.
+
+        @param work: Does the work with the transaction given to it
+        @type work: function
+
+        @return: What the work returns
+        """
+        while True:
+            txn = self._env.txn_begin()
+            try:
+                result = work(txn)
+            except db.DBLockDeadlockError:
+                txn.abort()
+                continue
+            except:
+                txn.abort()
+                raise
+            txn.commit()
+            return result
+
+    def get(self, key):
+        return self._db.get(key)
+
+    def get_many(self, keys):
+        # Sorted lookups with a single cursor
+        def read(txn):
+            found = {}
+            cursor = self._db.cursor(txn)
+            try:
+                for key in sorted(set(keys)):
+                    record = cursor.set(key)
+                    if record:
+                        found[key] = record[1]
+            finally:
+                cursor.close()
+            return found
+        return self._in_transaction(read)
+
+    def get_heads(self, keys, length):
+        # Partial reads of the records
+        def read(txn):
+            found = {}
+            cursor = self._db.cursor(txn)
+            try:
+                for key in sorted(set(keys)):
+                    record = cursor.set(key, dlen=length, doff=0)
+                    if record:
+                        found[key] = record[1]
+            finally:
+                cursor.close()
+            return found
+        return self._in_transaction(read)
+
+    def write(self, puts, deletes):
+        def write(txn):
+            # Sorted puts keep the B-tree pages we touch close together
+            for key, value in sorted(puts):
+                self._db.put(key, value, txn=txn)
+            for key in sorted(deletes):
+                try:
+                    self._db.delete(key, txn=txn)
+                except db.DBNotFoundError:
+                    pass
+        self._in_transaction(write)
+
+    def range(self, from_key='', to_key=None):
+        cursor = self._db.cursor()
+        try:
+            if not from_key:
+                record = cursor.first()
+            else:
+                record = cursor.set_range(from_key)
+            while record and (to_key is None or record[0] < to_key):
+                yield record
+                record = cursor.next()
+        finally:
+            cursor.close()
+
+    def sync(self):
+        # The commits are in the log already, unflushed
+        self._env.log_flush()
+
+    def close(self):
+        self._db.close()
+        self._env.close()
+
+class SQLiteEngine(Engine):
+    """
+    A SQLite table in WAL mode. Every read or write borrows a
+    connection of its own from a small pool (the server starts a
+    thread per client connection, they don't each keep one open),
+    readers work on a snapshot while the writer appends to the
+    write-ahead log.
+    """
+
+    shared = True
+
+    def __init__(self, path, recover=False):
+        """
+        @param path: Database file (the write-ahead log is kept next to
+        it)
+        @type path: str
+
+        @param recover: Ignored, SQLite recovers when the file is opened
+        @type recover: bool
+        """
+        self._path = path
+        self._idle = []
+        self._lock = threading.Lock()
+
+        with self._connected() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS records '
+                               '(key BLOB PRIMARY KEY, value BLOB NOT NULL) WITHOUT ROWID')
+
+    @contextmanager
+    def _connected(self):
+        """
+        Borrow an idle connection (or a new one) in a with statement.
+        It is given back afterwards, or closed if SQLITE_IDLE are idle
+        already.
+        """
+        with self._lock:
+            connection = self._idle and self._idle.pop() or None
+        if connection is None:
+            # Transactions are begun explicitly (see write)
+            connection = sqlite3.connect(self._path, timeout=SQLITE_TIMEOUT,
+                                         isolation_level=None, check_same_thread=False)
+            connection.text_factory = str
+            # Commits are flushed with the checkpoints only, like the
+            # commits of the bdb engine
+            connection.execute('PRAGMA synchronous=NORMAL')
+        try:
+            yield connection
+        finally:
+            with self._lock:
+                if len(self._idle) < SQLITE_IDLE:
+                    self._idle.append(connection)
+                    connection = None
+            if connection is not None:
+                connection.close()
+
+    def get(self, key):
+        with self._connected() as connection:
+            row = connection.execute('SELECT value FROM records WHERE key = ?',
+                                     (buffer(key),)).fetchone()
+        if row is None:
+            return None
+        return str(row[0])
+
+    def get_many(self, keys):
+        return self._select('value', keys, [])
+
+    def get_heads(self, keys, length):
+        return self._select('substr(value, 1, ?)', keys, [length])
+
+    def _select(self, column, keys, parameters):
+        """
+        Look up keys SQLITE_BATCH at a time.
+
+        @param column: What to select of the values
+        @type column: str
+
+        @param parameters: The parameters of the column
+        @type parameters: list
+
+        @return: What was selected by key
+        @rtype: dict
+        """
+        found = {}
+        keys = sorted(set(keys))
+        with self._connected() as connection:
+            for start in xrange(0, len(keys), SQLITE_BATCH):
+                batch = keys[start:start + SQLITE_BATCH]
+                rows = connection.execute('SELECT key, %s FROM records WHERE key IN (%s)'
+                                          % (column, ','.join('?' * len(batch))),
+                                          parameters + [buffer(key) for key in batch])
+                for key, value in rows:
+                    found[str(key)] = str(value)
+        return found
+
+    def write(self, puts, deletes):
+        with self._connected() as connection:
+            # Taking the write lock up front keeps two workers from
+            # deadlocking on upgrading their read locks
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                connection.executemany('INSERT OR REPLACE INTO records VALUES (?, ?)',
+                                       [(buffer(key), buffer(value)) for key, value in sorted(puts)])
+                connection.executemany('DELETE FROM records WHERE key = ?',
+                                       [(buffer(key),) for key in sorted(deletes)])
+            except:
+                connection.execute('ROLLBACK')
+                raise
+            connection.execute('COMMIT')
+
+    def range(self, from_key='', to_key=None):
+        # The connection is borrowed until the iterator is closed
+        with self._connected() as connection:
+            if to_key is None:
+                rows = connection.execute(
+                    'SELECT key, value FROM records WHERE key >= ? ORDER BY key',
+                    (buffer(from_key),))
+            else:
+                rows = connection.execute(
+                    'SELECT key, value FROM records WHERE key >= ? AND key < ? ORDER BY key',
+                    (buffer(from_key), buffer(to_key)))
+            try:
+                for key, value in rows:
+                    yield str(key), str(value)
+            finally:
+                rows.close()
+
+    def sync(self):
+        # The commits are in the write-ahead log, which is only synced
+        # by checkpoints (that sync the database too) with
+        # synchronous=NORMAL
+        try:
+            fd = os.open(self._path + '-wal', os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def close(self):
+        with self._lock:
+            for connection in self._idle:
+                connection.close()
+            del self._idle[:]
+
+class _SortedKeys(object):
+    """
+    The keys of an index in key order, for iterating over ranges of an
+    engine that keeps its keys in a dict. The order is sorted once and
+    kept until a new key is added, deleted keys are skipped when the
+    range is iterated.
+    """
+
+    def __init__(self):
+        self._keys = None
+
+    def added(self):
+        """
+        A key was added to the index.
+        """
+        self._keys = None
+
+    def keys(self, index):
+        """
+        @param index: The keys of the engine
+        @type index: dict
+
+        @return: The keys in order
+        @rtype: list
+        """
+        if self._keys is None:
+            self._keys = sorted(index)
+        return self._keys
+
+class MemoryEngine(Engine):
+    """
+    The records in a dict, gone when the storage stops.
+    """
+
+    def __init__(self, path=None, recover=False):
+        """
+        @param path: Ignored
+        @param recover: Ignored
+        """
+        self._records = {}
+        self._sorted = _SortedKeys()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        return self._records.get(key)
+
+    def write(self, puts, deletes):
+        with self._lock:
+            for key, value in puts:
+                if key not in self._records:
+                    self._sorted.added()
+                self._records[key] = value
+            for key in deletes:
+                self._records.pop(key, None)
+
+    def range(self, from_key='', to_key=None):
+        with self._lock:
+            keys = self._sorted.keys(self._records)
+        for i in xrange(bisect.bisect_left(keys, from_key), len(keys)):
+            key = keys[i]
+            if to_key is not None and key >= to_key:
+                break
+            value = self._records.get(key)
+            if value is not None:
+                yield key, value
+
+class _LogFile(object):
+    """
+    The log file of the 'log' engine. Records are appended to a memory
+    map of the file, which is grown (sparsely) when it is full.
+
+    A record is a header (checksum, kind, lengths of the key and the
+    value) followed by the key and the value. The checksum covers the
+    rest of the record so a record torn by a crash ends the log when
+    it is read again.
+    """
+
+    HEADER = struct.Struct('!IBHI')
+
+    PUT = 1
+    DELETE = 2
+
+    def __init__(self, path):
+        """
+        @param path: Log file, created if it doesn't exist
+        @type path: str
+        """
+        self.path = path
+        if not os.path.exists(path):
+            open(path, 'wb').close()
+        self._file = open(path, 'r+b')
+        size = os.fstat(self._file.fileno()).st_size
+        if size == 0:
+            size = LOG_GROW_BYTES
+            self._file.truncate(size)
+        self.map = mmap.mmap(self._file.fileno(), size)
+        self.end = 0
+        # Records up to here are flushed to disk
+        self.synced = 0
+
+    def scan(self):
+        """
+        Read the log from the start and leave its end after the last
+        whole record.
+
+        @return: Tuples of the kind of a record, its key, the offset
+        and the length of its value
+        @rtype: generator
+        """
+        header = self.HEADER
+        offset = 0
+        size = len(self.map)
+        while offset + header.size <= size:
+            checksum, kind, key_length, value_length = header.unpack_from(self.map, offset)
+            start = offset + header.size
+            stop = start + key_length + value_length
+            if kind not in (self.PUT, self.DELETE) or stop > size:
+                break
+            if zlib.crc32(self.map[offset + 4:stop]) & 0xffffffff != checksum:
+                break
+            yield kind, self.map[start:start + key_length], start + key_length, value_length
+            offset = stop
+            self.end = offset
+
+    def append(self, puts, deletes):
+        """
+        Append records.
+
+        @param puts: Tuples of a key and a value
+        @type puts: list
+
+        @param deletes: Keys
+        @type deletes: list
+
+        @return: The offset of the value of each put
+        @rtype: list
+        """
+        parts = []
+        offsets = []
+        offset = self.end
+        for kind, records in ((self.PUT, puts), (self.DELETE, [(key, '') for key in deletes])):
+            for key, value in records:
+                body = struct.pack('!BHI', kind, len(key), len(value)) + key + value
+                parts.append(struct.pack('!I', zlib.crc32(body) & 0xffffffff))
+                parts.append(body)
+                offset += self.HEADER.size + len(key)
+                if kind == self.PUT:
+                    offsets.append(offset)
+                offset += len(value)
+        data = ''.join(parts)
+
+        if offset > len(self.map):
+            # Grow by whole steps so the map is seldom resized
+            steps = (offset - len(self.map)) / LOG_GROW_BYTES + 1
+            self.map.resize(len(self.map) + steps * LOG_GROW_BYTES)
+        self.map[self.end:offset] = data
+        self.end = offset
+        return offsets
+
+    def read(self, offset, length):
+        return self.map[offset:offset + length]
+
+    def sync(self, end=None):
+        """
+        Flush the records appended since the last sync.
+
+        @param end: Where the records to flush end (the end of the log
+        by default)
+        @type end: int
+        """
+        if end is None:
+            end = self.end
+        if end > self.synced:
+            # Flushes the pages of the map too, unlike mmap.flush it
+            # lets the other threads run meanwhile
+            os.fsync(self._file.fileno())
+            self.synced = end
+
+    def close(self):
+        self.map.flush()
+        self.map.close()
+        self._file.close()
+
+class LogEngine(Engine):
+    """
+    A log-structured append-only file with an in-memory hash index.
+
+    Writes are appended to the log and the index is pointed at the new
+    values, reads look the key up in the index and slice the value out
+    of the memory map. The index is built again by reading the whole
+    log when the engine is opened.
+
+    Overwritten and deleted records stay in the log until it is
+    compacted: the live records are copied to a new log by a background
+    thread, in batches so the lock is only held shortly, and the new
+    log replaces the old one. Keys written meanwhile are copied again
+    at the end, so the compacted log has their latest values.
+    """
+
+    def __init__(self, path, recover=False):
+        """
+        @param path: Directory of the log, created if it doesn't exist
+        @type path: str
+
+        @param recover: Ignored, the log is always read to its last
+        whole record
+        @type recover: bool
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._path = os.path.join(path, 'records.log')
+        if os.path.exists(self._path + '.compact'):
+            # Left behind by a compaction that didn't finish
+            os.remove(self._path + '.compact')
+
+        self._lock = threading.Lock()
+        self._log = _LogFile(self._path)
+        self._index = {}
+        self._sorted = _SortedKeys()
+        # Bytes of overwritten and deleted records
+        self._dead = 0
+        # Keys written while compacting (None when not compacting)
+        self._dirty = None
+        self._compactor = None
+        # Held while the log is synced, the lock only while it is
+        # looked at so writes and reads go on during the flush
+        self._sync_lock = threading.Lock()
+
+        header = _LogFile.HEADER.size
+        for kind, key, offset, length in self._log.scan():
+            old = self._index.pop(key, None)
+            if old is not None:
+                self._dead += header + len(key) + old[1]
+            if kind == _LogFile.PUT:
+                self._index[key] = (offset, length)
+            else:
+                self._dead += header + len(key)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._index.get(key)
+            if entry is None:
+                return None
+            return self._log.read(*entry)
+
+    def get_many(self, keys):
+        found = {}
+        with self._lock:
+            for key in keys:
+                entry = self._index.get(key)
+                if entry is not None:
+                    found[key] = self._log.read(*entry)
+        return found
+
+    def get_heads(self, keys, length):
+        found = {}
+        with self._lock:
+            for key in keys:
+                entry = self._index.get(key)
+                if entry is not None:
+                    found[key] = self._log.read(entry[0], min(entry[1], length))
+        return found
+
+    def write(self, puts, deletes):
+        header = _LogFile.HEADER.size
+        with self._lock:
+            deletes = [key for key in deletes if key in self._index]
+            offsets = self._log.append(puts, deletes)
+            for (key, value), offset in zip(puts, offsets):
+                old = self._index.get(key)
+                if old is None:
+                    self._sorted.added()
+                else:
+                    self._dead += header + len(key) + old[1]
+                self._index[key] = (offset, len(value))
+            for key in deletes:
+                old = self._index.pop(key, None)
+                if old is not None:
+                    self._dead += 2 * header + 2 * len(key) + old[1]
+            if self._dirty is not None:
+                self._dirty.update([key for key, value in puts])
+                self._dirty.update(deletes)
+            if (self._compactor is None and self._dead >= COMPACT_MIN_BYTES and
+                self._dead >= self._log.end * COMPACT_RATIO):
+                self._compactor = threading.Thread(target=self.compact)
+                self._compactor.daemon = True
+                self._compactor.start()
+
+    def range(self, from_key='', to_key=None):
+        with self._lock:
+            keys = self._sorted.keys(self._index)
+        for i in xrange(bisect.bisect_left(keys, from_key), len(keys)):
+            key = keys[i]
+            if to_key is not None and key >= to_key:
+                break
+            with self._lock:
+                entry = self._index.get(key)
+                if entry is None:
+                    continue
+                value = self._log.read(*entry)
+            yield key, value
+
+    def compact(self):
+        """
+        Copy the live records to a new log and replace the old log with
+        it. Run by a background thread when enough of the log is dead,
+        writes and reads go on meanwhile.
+
+        @return: Bytes reclaimed
+        @rtype: int
+        """
+        with self._lock:
+            if self._dirty is not None:
+                return 0
+            self._dirty = set()
+            keys = list(self._index)
+
+        log = None
+        try:
+            log = _LogFile(self._path + '.compact')
+            index = {}
+
+            def copy(keys):
+                live = []
+                for key in keys:
+                    entry = self._index.get(key)
+                    if entry is None:
+                        index.pop(key, None)
+                    else:
+                        live.append((key, self._log.read(*entry)))
+                offsets = log.append(live, [])
+                for (key, value), offset in zip(live, offsets):
+                    index[key] = (offset, len(value))
+
+            for start in xrange(0, len(keys), COMPACT_BATCH):
+                with self._lock:
+                    copy(keys[start:start + COMPACT_BATCH])
+
+            with self._sync_lock:
+                with self._lock:
+                    # The keys written meanwhile have changed since they
+                    # where copied (or are new)
+                    copy(self._dirty)
+                    # The old log is only replaced by a log on disk
+                    log.sync()
+                    os.rename(log.path, self._path)
+                    _sync_directory(os.path.dirname(self._path))
+                    log.path = self._path
+                    old, self._log = self._log, log
+                    reclaimed = old.end - log.end
+                    self._index = index
+                    self._dead = 0
+                    self._dirty = None
+                    log = None
+                    old.close()
+            return reclaimed
+        finally:
+            if log is not None:
+                log.close()
+                os.remove(log.path)
+            with self._lock:
+                self._dirty = None
+                self._compactor = None
+
+    def sync(self):
+        with self._sync_lock:
+            with self._lock:
+                log = self._log
+                end = log.end
+            log.sync(end)
+
+    def close(self):
+        compactor = self._compactor
+        if compactor is not None:
+            compactor.join()
+        with self._lock:
+            self._log.close()
+
+def _sync_directory(path):
+    """
+    Flush the entries of a directory, so a file renamed in it stays
+    renamed after a crash.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+# The engines by name (see open_engine)
+ENGINES = {'bdb': BerkeleyEngine,
+           'sqlite': SQLiteEngine,
+           'log': LogEngine,
+           'memory': MemoryEngine}
+
+# Engine used when none is choosen, Berkeley DB when it is installed
+DEFAULT_ENGINE = 'bdb' if db is not None else 'sqlite'
+
+def open_engine(name, path, recover=False):
+    """
+    Open an engine.
+
+    @param name: One of ENGINES
+    @type name: str
+
+    @param path: Where the engine keeps its records (a file or, for
+    the 'log' engine, a directory)
+    @type path: str
+
+    @param recover: Recover the records of a crashed storage (only the
+    'bdb' engine needs to be told)
+    @type recover: bool
+
+    @rtype: Engine
+    """
+    try:
+        engine_class = ENGINES[name]
+    except KeyError:
+        raise EngineError("Unknown engine %r" % name)
+    return engine_class(path, recover)
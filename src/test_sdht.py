@@ -0,0 +1,150 @@
+# -*- mode: python -*-
+"""
+Tests of the sdht client against storages started on free ports: the
+chunks of a large value are cleaned up when it is overwritten or
+deleted, and join and remove move the keys without losing any.
+
+Run them from this directory with:
+
+  python -m unittest discover -p 'test_*.py'
+"""
+import imp
+import os
+import unittest
+
+import sdht
+
+# The storages are started the way the benchmarks start them
+_bench = imp.load_source('sdht_bench',
+                         os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sdht-bench.py'))
+
+def _held(node):
+    """
+    The number of records a storage holds.
+    """
+    return len(sdht.Node(node.ip, node.port).hashes([(0, 2**sdht.MAXIMUM_BIT)]))
+
+class _ClusterTest(unittest.TestCase):
+    """
+    Starts storages on the memory engine and forgets the ring after
+    each test.
+    """
+
+    # Storages started before each test
+    storages = 2
+
+    def setUp(self):
+        # Don't let the refused connections of a starting storage open
+        # its breaker for long
+        sdht.configure_breakers(reset_timeout=0.1)
+        self.addCleanup(sdht.configure_breakers)
+        self.cluster = _bench._Cluster(['--engine', 'memory'])
+        self.addCleanup(self.cluster.stop)
+        self.addCleanup(_bench._reset_ring)
+        _bench._reset_ring()
+        for i in xrange(self.storages):
+            self.cluster.start()
+
+    def _records(self):
+        return sum([_held(node) for node in self.cluster.nodes])
+
+class ChunkTest(_ClusterTest):
+
+    def setUp(self):
+        _ClusterTest.setUp(self)
+        sdht.configure_chunks(threshold=100, chunk_bytes=64)
+        self.addCleanup(sdht.configure_chunks)
+        for node in self.cluster.nodes:
+            sdht.join(node)
+
+    def test_overwrite(self):
+        first = os.urandom(1000)
+        sdht.set('big', first)
+        self.assertEqual(sdht.get('big'), first)
+        chunked = self._records()
+        self.assertTrue(chunked > 1)
+        second = os.urandom(500)
+        sdht.set('big', second)
+        self.assertEqual(sdht.get('big'), second)
+        self.assertTrue(1 < self._records() < chunked)
+        sdht.set('big', 'small')
+        self.assertEqual(sdht.get('big'), 'small')
+        self.assertEqual(self._records(), 1)
+
+    def test_set_many(self):
+        sdht.set_many([('big%d' % i, os.urandom(1000)) for i in xrange(3)])
+        sdht.set_many([('big%d' % i, 'small') for i in xrange(3)])
+        self.assertEqual(sdht.get_many(['big%d' % i for i in xrange(3)]), ['small'] * 3)
+        self.assertEqual(self._records(), 3)
+
+    def test_delete(self):
+        sdht.set('big', os.urandom(1000))
+        sdht.set('other', 'small')
+        sdht.delete('big')
+        self.assertEqual(sdht.get_many(['big', 'other'], None), [None, 'small'])
+        self.assertEqual(self._records(), 1)
+
+class MoveTest(_ClusterTest):
+
+    storages = 3
+
+    # Copies of every key
+    replicas = 1
+
+    # The call of steal_range that fails in test_join_failed
+    failing_move = 1
+
+    def setUp(self):
+        _ClusterTest.setUp(self)
+        sdht.configure_replication(self.replicas)
+        self.addCleanup(sdht.configure_replication)
+        self.keys = ['key%d' % i for i in xrange(300)]
+        for node in self.cluster.nodes[:2]:
+            sdht.join(node)
+        sdht.set_many([(key, 'value-' + key) for key in self.keys])
+
+    def _values(self):
+        return sdht.get_many(self.keys, None)
+
+    def test_join(self):
+        joined = self.cluster.nodes[2]
+        sdht.join(joined)
+        self.assertEqual(self._values(), ['value-' + key for key in self.keys])
+        self.assertTrue(_held(joined) > 0)
+        self.assertEqual(self._records(), self.replicas * len(self.keys))
+
+    def test_remove(self):
+        sdht.join(self.cluster.nodes[2])
+        removed = self.cluster.nodes[0]
+        sdht.remove(removed)
+        self.assertEqual(self._values(), ['value-' + key for key in self.keys])
+        self.assertEqual([node for node in sdht._node_list if node.port == removed.port], [])
+        self.assertEqual(sum([_held(node) for node in self.cluster.nodes[1:]]),
+                         self.replicas * len(self.keys))
+
+    def test_join_failed(self):
+        # The ranges moved before the failing one are handed back
+        steal_range = sdht.Node.steal_range
+        self.addCleanup(setattr, sdht.Node, 'steal_range', steal_range)
+        calls = []
+        def failing(node, *args, **kwargs):
+            calls.append(args)
+            if len(calls) == self.failing_move:
+                return False
+            return steal_range(node, *args, **kwargs)
+        sdht.Node.steal_range = failing
+        ring = list(sdht._node_list)
+        held = [_held(node) for node in self.cluster.nodes[:2]]
+        self.assertRaises(sdht.NodeError, sdht.join, self.cluster.nodes[2])
+        self.assertEqual(sdht._node_list, ring)
+        self.assertEqual([_held(node) for node in self.cluster.nodes[:2]], held)
+        self.assertEqual(self._values(), ['value-' + key for key in self.keys])
+
+class ReplicatedMoveTest(MoveTest):
+
+    replicas = 2
+
+    failing_move = 2
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+# -*- mode: python -*-
+"""
+Tests of the storage engines: records written to an engine read back
+the same, by key and by range, and are still there when it is opened
+again.
+
+Run them from this directory with:
+
+  python -m unittest discover -p 'test_*.py'
+"""
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import sdht_engines
+
+def _key(number):
+    """
+    A packed key of the ring (20 bytes, big endian).
+    """
+    return ('%040x' % number).decode('hex')
+
+class _EngineTest(object):
+    """
+    The tests every engine passes. Mixed into a TestCase per engine.
+    """
+
+    # One of sdht_engines.ENGINES
+    engine = None
+
+    # Whether the records survive closing the engine
+    persistent = True
+
+    def setUp(self):
+        if self.engine == 'bdb' and sdht_engines.db is None:
+            self.skipTest("Berkeley DB isn't installed")
+        self.directory = tempfile.mkdtemp(prefix='sdht-test-')
+        self.path = os.path.join(self.directory, 'storage.db')
+        self.records = self._open()
+
+    def tearDown(self):
+        self.records.close()
+        shutil.rmtree(self.directory)
+
+    def _open(self):
+        return sdht_engines.open_engine(self.engine, self.path)
+
+    def _reopen(self):
+        self.records.close()
+        self.records = self._open()
+
+    def test_round_trip(self):
+        self.records.write([(_key(i), 'value%d' % i) for i in xrange(100)], [])
+        self.records.write([(_key(3), 'changed')], [_key(4), _key(1000)])
+        self.assertEqual(self.records.get(_key(3)), 'changed')
+        self.assertEqual(self.records.get(_key(4)), None)
+        self.assertEqual(self.records.get(_key(1000)), None)
+        self.assertEqual(self.records.get_many([_key(2), _key(4), _key(5)]),
+                         {_key(2): 'value2', _key(5): 'value5'})
+        self.assertEqual(self.records.get_heads([_key(10), _key(4)], 6), {_key(10): 'value1'})
+
+    def test_range(self):
+        numbers = [7, 2**100, 3, 2**159 + 1, 42]
+        self.records.write([(_key(i), str(i)) for i in numbers], [])
+        self.assertEqual(list(self.records.range()),
+                         [(_key(i), str(i)) for i in sorted(numbers)])
+        self.assertEqual(list(self.records.range(_key(4), _key(2**159 + 1))),
+                         [(_key(i), str(i)) for i in (7, 42, 2**100)])
+        records = self.records.range(_key(5))
+        self.assertEqual(records.next(), (_key(7), '7'))
+        records.close()
+        self.records.delete(_key(42))
+        self.assertEqual([key for key, value in self.records.range(_key(5), _key(100))], [_key(7)])
+
+    def test_reopen(self):
+        if not self.persistent:
+            self.skipTest("The %s engine forgets its records" % self.engine)
+        self.records.write([(_key(i), 'value%d' % i) for i in xrange(50)], [])
+        self.records.put(_key(7), 'changed')
+        self.records.delete(_key(8))
+        self.records.sync()
+        self._reopen()
+        self.assertEqual(self.records.get(_key(7)), 'changed')
+        self.assertEqual(self.records.get(_key(8)), None)
+        self.assertEqual(len(list(self.records.range())), 49)
+        self.records.put(_key(8), 'back')
+        self._reopen()
+        self.assertEqual(self.records.get(_key(8)), 'back')
+
+class BerkeleyEngineTest(_EngineTest, unittest.TestCase):
+    engine = 'bdb'
+
+class SQLiteEngineTest(_EngineTest, unittest.TestCase):
+    engine = 'sqlite'
+
+    def test_threads(self):
+        # Every thread borrows its own connection
+        errors = []
+        def writer(first):
+            try:
+                for i in xrange(first, first + 20):
+                    self.records.put(_key(i), str(i))
+                    self.assertEqual(self.records.get(_key(i)), str(i))
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=writer, args=(i * 20,)) for i in xrange(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(list(self.records.range())), 80)
+
+class LogEngineTest(_EngineTest, unittest.TestCase):
+    engine = 'log'
+
+class MemoryEngineTest(_EngineTest, unittest.TestCase):
+    engine = 'memory'
+    persistent = False
+
+class OpenEngineTest(unittest.TestCase):
+
+    def test_unknown(self):
+        self.assertRaises(sdht_engines.EngineError, sdht_engines.open_engine, 'nope', 'x')
+
+if __name__ == '__main__':
+    unittest.main()